@@ -0,0 +1,121 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Benchmark: how fast can N taxis claim (and finalize) tasks from one dispatch DB?
+
+Builds a dispatch of independent zero-length tasks, then starts N writer processes,
+each of which claims tasks and immediately marks them complete, exactly as taxis do
+in run_taxi.py, until no tasks are left.  Optionally also runs reader processes that
+repeatedly look over the whole dispatch, like taxi-summary or a taxi deciding which
+other taxis to spawn.  Reports claims per second for each journaling configuration.
+
+Usage:
+    python benchmarks/claim_throughput.py --writers 1 4 8 --readers 1 --tasks 2000
+
+By default, runs in a temporary directory; use --dir to benchmark a particular
+filesystem (e.g., an NFS-mounted scratch directory, where WAL is not available
+and the "wal" configuration falls back to the rollback journal).
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import multiprocessing
+
+import taxi
+import taxi.dispatcher
+from taxi.tasks import Task
+from taxi._utility import tuned_sqlite_pragmas
+
+journal_configs = {
+    'rollback' : dict(use_wal=False, pragmas=None),
+    'wal' : dict(use_wal=True, pragmas=tuned_sqlite_pragmas),
+}
+
+
+def build_dispatch(db_path, n_tasks, config):
+    task_pool = [Task(req_time=0) for ii in range(n_tasks)]
+    dispatch = taxi.dispatcher.SQLiteDispatcher(db_path, **config)
+    with dispatch:
+        dispatch.initialize_new_task_pool(task_pool, priority_method='anarchy', imports=[])
+
+
+def writer(db_path, config, taxi_name, start_event, claim_counts):
+    dispatch = taxi.dispatcher.SQLiteDispatcher(db_path, **config)
+    dispatch.open_session()
+    my_taxi = taxi.Taxi(name=taxi_name, time_limit=1e6, cores=1, nodes=1)
+    my_taxi.start_time = time.time()
+
+    start_event.wait()
+    n_claimed = 0
+    while True:
+        task = dispatch.claim_next_task(my_taxi)
+        if getattr(task, 'id', None) is None:
+            break # Die/Sleep: nothing left
+        dispatch.finalize_task_run(my_taxi, task)
+        n_claimed += 1
+    dispatch.close_session()
+    claim_counts.put(n_claimed)
+
+
+def reader(db_path, config, start_event, stop_event):
+    dispatch = taxi.dispatcher.SQLiteDispatcher(db_path, **config)
+    start_event.wait()
+    while not stop_event.is_set():
+        with dispatch:
+            dispatch.conn.execute("""SELECT status, COUNT(*) FROM tasks GROUP BY status""").fetchall()
+            dispatch.conn.execute("""SELECT id, status, by_taxi FROM tasks""").fetchall()
+
+
+def run_benchmark(work_dir, n_tasks, n_writers, n_readers, config_name):
+    config = journal_configs[config_name]
+    db_path = os.path.join(work_dir, 'bench_{0}_{1}w.sqlite'.format(config_name, n_writers))
+    build_dispatch(db_path, n_tasks, config)
+
+    start_event = multiprocessing.Event()
+    stop_event = multiprocessing.Event()
+    claim_counts = multiprocessing.Queue()
+    writers = [multiprocessing.Process(target=writer, args=(db_path, config, 'taxi%d'%ii, start_event, claim_counts))
+               for ii in range(n_writers)]
+    readers = [multiprocessing.Process(target=reader, args=(db_path, config, start_event, stop_event))
+               for ii in range(n_readers)]
+    for p in writers + readers:
+        p.start()
+
+    time.sleep(0.5) # Let everybody connect
+    t0 = time.time()
+    start_event.set()
+    n_claimed = sum([claim_counts.get() for ii in range(n_writers)])
+    elapsed = time.time() - t0
+    stop_event.set()
+    for p in writers + readers:
+        p.join()
+
+    assert n_claimed == n_tasks, "Claimed {0} tasks, expected {1}".format(n_claimed, n_tasks)
+    return n_claimed / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark task claim throughput with concurrent taxis.")
+    parser.add_argument('--tasks', type=int, default=2000, help='Number of tasks in the dispatch.')
+    parser.add_argument('--writers', type=int, nargs='+', default=[1, 2, 4, 8], help='Numbers of concurrent claiming processes to try.')
+    parser.add_argument('--readers', type=int, default=1, help='Number of concurrent reader processes.')
+    parser.add_argument('--configs', type=str, nargs='+', default=sorted(journal_configs.keys()),
+                        choices=sorted(journal_configs.keys()), help='Journaling configurations to try.')
+    parser.add_argument('--dir', type=str, default=None, help='Directory for the benchmark dispatch DBs (default: temporary directory).')
+    parg = parser.parse_args(sys.argv[1:])
+
+    work_dir = tempfile.mkdtemp(dir=parg.dir)
+    print "Benchmark DBs in", work_dir, "(filesystem: {0})".format(taxi._utility.filesystem_type(work_dir))
+    print "{0:>10s} {1:>8s} {2:>8s} {3:>12s}".format('config', 'writers', 'readers', 'claims/s')
+    try:
+        for n_writers in parg.writers:
+            for config_name in parg.configs:
+                rate = run_benchmark(work_dir, parg.tasks, n_writers, parg.readers, config_name)
+                print "{0:>10s} {1:>8d} {2:>8d} {3:>12.1f}".format(config_name, n_writers, parg.readers, rate)
+                sys.stdout.flush()
+    finally:
+        shutil.rmtree(work_dir)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Benchmark: how long does a campaign take to finish (its makespan) under each
+priority_method of Dispatcher._assign_priorities?
+
+Builds synthetic task forests shaped like typical lattice campaigns: several
+HMC streams (chains of long trunk tasks) of varying length, with a few short
+measurement tasks hanging off of each configuration, plus some standalone
+short tasks.  Then simulates N taxis pulling tasks the way the dispatcher
+hands them out -- the highest-priority ready task first -- with every task
+taking exactly its req_time, and reports the time to finish everything.
+
+Usage:
+    python benchmarks/priority_makespan.py --taxis 4 16 --streams 8 --seeds 5
+"""
+
+import sys
+import heapq
+import random
+import argparse
+
+from taxi.dispatcher import Dispatcher, task_priority_sort_key
+from taxi.tasks import Task
+
+
+def build_forest(rng, n_streams, max_stream_length, n_measurements, n_standalone):
+    """Synthetic campaign: HMC streams of random length with measurements on every config."""
+    task_pool = []
+    for ss in range(n_streams):
+        stream_length = rng.randint(1, max_stream_length)
+        hmc_time = rng.choice([1800, 3600, 7200])
+        previous = None
+        for ii in range(stream_length):
+            hmc = Task(req_time=hmc_time)
+            hmc.trunk = True
+            if previous is not None:
+                hmc.depends_on = [previous]
+            task_pool.append(hmc)
+            for mm in range(n_measurements):
+                measurement = Task(req_time=rng.choice([300, 600, 1200]))
+                measurement.depends_on = [hmc]
+                task_pool.append(measurement)
+            previous = hmc
+    for ii in range(n_standalone):
+        task_pool.append(Task(req_time=rng.choice([300, 600, 1200, 3600])))
+
+    rng.shuffle(task_pool) # Don't let pool order do the scheduling
+    return task_pool
+
+
+def simulate(task_pool, n_taxis):
+    """List-schedules task_pool on n_taxis taxis, in priority order. Returns the makespan."""
+    dispatch = Dispatcher()
+    graph = dispatch._build_dependency_graph(task_pool)
+    n_unresolved = [len(deps) for deps in graph['dependencies']]
+
+    # Ready tasks, highest priority (then lowest index, like lowest id) first
+    ready = [(task_priority_sort_key(task_pool[jj]), jj) for jj, n in enumerate(n_unresolved) if n == 0]
+    heapq.heapify(ready)
+
+    running = [] # (finish time, task index)
+    now = 0.
+    free_taxis = n_taxis
+    while len(ready) > 0 or len(running) > 0:
+        while free_taxis > 0 and len(ready) > 0:
+            key, jj = heapq.heappop(ready)
+            heapq.heappush(running, (now + task_pool[jj].req_time, jj))
+            free_taxis -= 1
+        now, jj = heapq.heappop(running)
+        free_taxis += 1
+        for kk in graph['dependents'][jj]:
+            n_unresolved[kk] -= 1
+            if n_unresolved[kk] == 0:
+                heapq.heappush(ready, (task_priority_sort_key(task_pool[kk]), kk))
+    return now
+
+
+def makespan(seed, priority_method, n_taxis, parg):
+    rng = random.Random(seed)
+    task_pool = build_forest(rng, parg.streams, parg.stream_length, parg.measurements, parg.standalone)
+    dispatch = Dispatcher()
+    dispatch.trees = dispatch.find_branches(task_pool)
+    dispatch._assign_priorities(task_pool, priority_method=priority_method)
+    return simulate(task_pool, n_taxis)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare campaign makespans for dispatcher priority methods.")
+    parser.add_argument('--taxis', type=int, nargs='+', default=[4, 16], help='Numbers of concurrent taxis to try.')
+    parser.add_argument('--streams', type=int, default=8, help='Number of HMC streams per forest.')
+    parser.add_argument('--stream_length', type=int, default=40, help='Maximum number of configurations per stream.')
+    parser.add_argument('--measurements', type=int, default=3, help='Number of measurement tasks per configuration.')
+    parser.add_argument('--standalone', type=int, default=200, help='Number of standalone short tasks.')
+    parser.add_argument('--seeds', type=int, default=5, help='Number of random forests to average over.')
+    parser.add_argument('--methods', type=str, nargs='+', default=['canvas', 'trunk', 'critical_path'],
+                        help='Priority methods to compare.')
+    parg = parser.parse_args(sys.argv[1:])
+
+    print "{0:>15s} {1:>6s} {2:>15s} {3:>10s}".format('method', 'taxis', 'makespan (h)', 'vs canvas')
+    for n_taxis in parg.taxis:
+        mean_makespans = {}
+        for method in parg.methods:
+            makespans = [makespan(seed, method, n_taxis, parg) for seed in range(parg.seeds)]
+            mean_makespans[method] = sum(makespans) / len(makespans)
+        for method in parg.methods:
+            relative = mean_makespans[method] / mean_makespans['canvas'] if mean_makespans.has_key('canvas') else float('nan')
+            print "{0:>15s} {1:>6d} {2:>15.2f} {3:>10.3f}".format(method, n_taxis, mean_makespans[method]/3600., relative)
@@ -108,5 +108,6 @@ setuptools.setup(
              'src/taxi/tools/taxi-edit-task',
              'src/taxi/tools/taxi-unabandon',
              'src/taxi/tools/taxi-rollback',
+             'src/taxi/tools/taxi-archive',
              'src/taxi/tools/taxi-spawn-idle-taxis']
 )
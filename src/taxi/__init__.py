@@ -7,5 +7,6 @@ from _utility import flush_output, print_traceback
 from _utility import all_subclasses_of
 from _utility import fixable_dynamic_attribute
 from _utility import copy_nested_list
+from _utility import connect_sqlite
 
 from file import should_save_file, should_load_file
\ No newline at end of file
@@ -4,10 +4,11 @@ import time
 
 class Taxi(object):
 
-    def __init__(self, name=None, time_limit=None, cores=None, nodes=None):
+    def __init__(self, name=None, time_limit=None, cores=None, nodes=None, memory=None):
         self.time_limit = time_limit
         self.cores = cores
         self.nodes = nodes
+        self.memory = memory ## Per node; None if unknown
         self.time_last_submitted = None
         self.start_time = None  ## Not currently saved to DB, but maybe it should be?
         self.status = 'I'
@@ -30,12 +31,18 @@ class Taxi(object):
     def taxi_name(self):
         return '{0:s}_{1:d}'.format(self.pool_name, self.name)
     
-    def enough_time_for_task(self, task):
-        """Checks if this taxi has enough time left to execute this task."""
-        
+    def time_remaining(self):
+        """Number of seconds left before this taxi runs out of its time budget."""
         elapsed_time = time.time() - self.start_time
-        time_remaining = self.time_limit - elapsed_time
-        return time_remaining > task.req_time
+        return self.time_limit - elapsed_time
+    
+    def enough_time_for_task(self, task, req_time=None):
+        """Checks if this taxi has enough time left to execute this task.
+        If specified, req_time (e.g., a run time estimate) is used instead of task.req_time."""
+        
+        if req_time is None:
+            req_time = task.req_time
+        return self.time_remaining() > req_time
 
     def rebuild_from_dict(self, taxi_dict):
         try:
@@ -44,6 +51,7 @@ class Taxi(object):
             self.time_limit = taxi_dict['time_limit']
             self.nodes = taxi_dict['nodes']
             self.cores = taxi_dict['cores']
+            self.memory = taxi_dict.get('memory', None) # Not in older pool DBs
             self.time_last_submitted = taxi_dict['time_last_submitted']
             self.status = taxi_dict['status']
             self.dispatch_path = taxi_dict['dispatch']
@@ -63,6 +71,7 @@ class Taxi(object):
             'time_limit': self.time_limit,
             'cores': self.cores,
             'nodes' : self.nodes,
+            'memory' : self.memory,
             'time_last_submitted': self.time_last_submitted,
             'start_time': self.start_time,
             'status': self.status
@@ -73,6 +73,84 @@ def all_subclasses_of(my_class):
         valid_task_classes += valid_task_class.__subclasses__()
     return class_dict
 
+## Filesystems that are shared between hosts. SQLite's write-ahead log relies on shared
+## memory between all processes using the DB, so WAL can't be used on these.
+network_filesystem_types = ['nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'afs', 'lustre', 'gpfs',
+                            'panfs', 'ceph', 'fuse.ceph', 'beegfs', 'glusterfs', 'fuse.glusterfs', 'fuse.sshfs']
+
+def filesystem_type(path, mounts_path='/proc/mounts'):
+    """Returns the type of the filesystem (e.g., 'ext4', 'nfs') that path lives on, according to
+    the longest matching mount point in mounts_path, or None if it can't be determined."""
+    path = os.path.realpath(path)
+    try:
+        with open(mounts_path, 'r') as f:
+            mount_lines = f.readlines()
+    except IOError:
+        return None
+    
+    best_mount_point, best_fs_type = None, None
+    for line in mount_lines:
+        fields = line.split()
+        if len(fields) < 3:
+            continue
+        mount_point = fields[1].replace('\\040', ' ') # Spaces are escaped in /proc/mounts
+        fs_type = fields[2]
+        if path == mount_point or path.startswith(mount_point.rstrip('/') + '/'):
+            if best_mount_point is None or len(mount_point) > len(best_mount_point):
+                best_mount_point, best_fs_type = mount_point, fs_type
+    return best_fs_type
+
+def is_network_filesystem(path):
+    """Does path live on a filesystem shared between hosts, like NFS (see network_filesystem_types)?"""
+    fs_type = filesystem_type(path)
+    return fs_type is not None and fs_type.lower() in network_filesystem_types
+
+## Suggested per-connection tuning for connect_sqlite: fewer fsyncs (safe with WAL), a 16MB page
+## cache, and memory-mapped reads of the first 256MB of the DB
+tuned_sqlite_pragmas = {
+    'synchronous' : 'NORMAL',
+    'cache_size' : -16000,
+    'mmap_size' : 268435456,
+}
+
+import sqlite3
+def connect_sqlite(db_path, use_wal=False, pragmas=None, timeout=30.0):
+    """Opens a connection to the SQLite DB at db_path, returning rows as sqlite3.Row.
+    
+    If use_wal=True, switches the DB to write-ahead-log journaling, so that readers
+    don't block writers (and vice versa). WAL doesn't work for DBs shared between
+    hosts, so if db_path is on a network filesystem like NFS, falls back to the
+    default rollback journal instead.  The journal mode is stored in the DB, so
+    later connections keep using WAL even if they don't ask for it.
+    
+    pragmas is a dict like {pragma name : value} of pragmas to set on the new connection,
+    e.g. tuned_sqlite_pragmas.  mmap_size is skipped on network filesystems.
+    """
+    conn = sqlite3.connect(db_path, timeout=timeout) # Creates file if it doesn't exist
+    conn.row_factory = sqlite3.Row # Row factory for return-as-dict
+    
+    if not use_wal and not pragmas:
+        return conn
+    
+    on_network_fs = is_network_filesystem(os.path.dirname(os.path.abspath(db_path)))
+    
+    if use_wal:
+        if on_network_fs:
+            print "WARNING: {0} is on a network filesystem; can't use WAL journaling, using rollback journal".format(db_path)
+            conn.execute("""PRAGMA journal_mode=DELETE""")
+        else:
+            conn.execute("""PRAGMA journal_mode=WAL""")
+    
+    if pragmas:
+        for name, value in pragmas.items():
+            if name == 'mmap_size' and on_network_fs:
+                continue
+            if not name.replace('_', '').isalnum():
+                raise ValueError("Invalid pragma name {0}".format(name))
+            conn.execute("""PRAGMA {0}={1}""".format(name, value))
+    
+    return conn
+
 import json   
 class LocalEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -4,13 +4,23 @@
 
 import os
 import json
-from taxi._utility import LocalEncoder
+import math
+import copy
+import hashlib
+import time
+import threading
+from contextlib import contextmanager
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from taxi._utility import LocalEncoder, connect_sqlite
 
 import imp # For dynamical imports
 import __main__ # To get filename of calling script
 
 import taxi
 import taxi.tasks as tasks
+import taxi.runtime_model as runtime_model
+import taxi.mcmc as mcmc
 
 ## Need to be able to make blank objects to reconstruct Tasks from JSON payloads
 class BlankObject(object):
@@ -18,6 +28,25 @@ class BlankObject(object):
         pass # Need an __init__ function to have a __dict__
         
         
+def copy_rebuilt_task(task):
+    """Cheap copy of a task reconstructed by rebuild_json_task, for handing out
+    cached tasks without decoding their payloads again. Mutable attributes (lists
+    and dicts from the JSON payload) are copied, so changes to the copy don't
+    reach the cached task. Instance-level File overrides live in the File
+    descriptors' interfaces (see taxi.file.File), not in the task's __dict__,
+    so they are copied over to new interfaces for the copy."""
+    copied = BlankObject()
+    copied.__class__ = task.__class__
+    copied.__dict__ = dict([(k, (copy.deepcopy(v) if isinstance(v, (list, dict)) else v))
+                            for k, v in task.__dict__.items() if k != '_file_interfaces'])
+    for interface in task.__dict__.get('_file_interfaces', []):
+        new_interface = interface.file_in_class._get_instance_interface(copied)
+        for k, v in interface.__dict__.items():
+            if k not in ('task_instance', 'file_in_class'):
+                setattr(new_interface, k, v)
+    return copied
+    
+    
 def task_priority_sort_key(task):
     """For use as argument in sorted(..., key=task_priority_sort_key).
     
@@ -31,13 +60,128 @@ def task_priority_sort_key(task):
     return (task.priority < 0, task.priority)
 
 
+def task_content_hash(compiled_task):
+    """Canonical hash of the work that the compiled task compiled_task (see Task.compiled) does:
+    its task type and the rest of its attributes, except for those in unhashed_keys.
+    Tasks with the same hash do the same work (see Dispatcher.deduplicate_tasks).
+    Returns a hex string."""
+    content = dict([(k, v) for (k, v) in compiled_task.items() if k not in unhashed_keys and k != 'payload'])
+    content.update([(k, v) for (k, v) in compiled_task.get('payload', {}).items() if k not in unhashed_keys])
+    return hashlib.sha1(json.dumps(content, sort_keys=True, cls=LocalEncoder)).hexdigest()
+
+
 class TaskClaimException(Exception):
     pass
 
 
+class DependencyCycleException(Exception):
+    pass
+
+
+## Columns of the SQLite tasks table that are maintained by the dispatcher itself, rather
+## than stored from Task attributes; these are not restored as attributes when rebuilding tasks
+bookkeeping_columns = ['n_unresolved', 'n_failed', 'version', 'model_key', 'est_time', 'lease_expiry',
+                       'content_hash']
+
+## Columns of the SQLite tasks table with copies of information from the payload, so it can be
+## read without decoding the payload (see SQLiteDispatcher._payload_column_values)
+payload_columns = ['by_taxi', 'trunk', 'start_time', 'run_time', 'model_key', 'cores', 'binary',
+                   'nodes', 'memory', 'min_walltime']
+
+## Resources that tasks may require, as (task attribute, Taxi attribute that must be at least
+## as large) pairs (see Dispatcher.task_fits_taxi)
+task_requirements = [('cores', 'cores'), ('nodes', 'nodes'), ('memory', 'memory'), ('min_walltime', 'time_limit')]
+
+## Columns of the SQLite tasks table kept for archived tasks (see SQLiteDispatcher.archive_complete_tasks)
+archived_columns = ['id', 'task_type', 'depends_on', 'status', 'for_taxi', 'by_taxi', 'is_recurring',
+                    'req_time', 'start_time', 'run_time', 'priority', 'trunk', 'payload', 'cores', 'binary',
+                    'nodes', 'memory', 'min_walltime', 'model_key', 'content_hash']
+
+## Attributes of compiled tasks that don't change what work a task does: how it's scheduled, and
+## the record of running it (see task_content_hash)
+unhashed_keys = ['id', 'status', 'priority', 'depends_on', 'for_taxi', 'req_time', 'trunk', 'branch_root',
+                 'by_taxi', 'start_time', 'run_time', 'output_files']
+
+## Dispatcher attributes that set policy for every taxi working on a dispatch; taxis build their
+## own dispatchers, so SQLiteDispatcher stores these in the dispatch DB (see SQLiteDispatcher.store_settings)
+dispatch_settings = ['concurrent_tasks', 'max_bundle_size', 'sleep_wait_time', 'lease_time', 'deduplicate_tasks']
+
+## Columns of the SQLite tasks table needed for scheduling; everything but the payload
+view_columns = ['id', 'task_type', 'depends_on', 'status', 'for_taxi', 'by_taxi', 'is_recurring',
+                'req_time', 'start_time', 'run_time', 'priority', 'trunk', 'cores', 'nodes', 'memory',
+                'min_walltime'] + bookkeeping_columns
+
+
+class TaskView(object):
+    """Lightweight stand-in for a Task, with only the attributes needed for
+    scheduling: those stored in view_columns (id, status, priority, req_time,
+    for_taxi, trunk, depends_on, ...).  The payload is not decoded.
+    
+    Task views are what Dispatcher.get_all_tasks(..., lazy=True) returns; use
+    Dispatcher.materialize_tasks to get the full Task instances, e.g. to run,
+    edit, or roll back the tasks.
+    """
+    
+    def __init__(self, r):
+        for k in view_columns:
+            if k in bookkeeping_columns:
+                continue
+            setattr(self, k, r.get(k, None))
+        
+        if self.depends_on is not None:
+            self.depends_on = json.loads(self.depends_on)
+        self.trunk = bool(self.trunk)
+        
+        # Dependency resolution as of the time the view was read from the dispatch DB
+        if r.has_key('n_unresolved') and r.has_key('n_failed'):
+            self._dependency_counts = (r['n_unresolved'], r['n_failed'])
+        
+        # Estimated run time from the runtime model (see SQLiteDispatcher.enable_runtime_estimates)
+        self._est_time = r.get('est_time', None)
+            
+            
+    def __repr__(self):
+        return "TaskView({0}, {1}, {2})".format(self.id, self.task_type, self.status)
+
+
 
 class Dispatcher(object):
 
+    ## What to run when the highest-priority ready task doesn't fit in the time a taxi has left:
+    ## - 'best_fit': the ready task that best fills the remaining time (longest req_time that
+    ##   fits; highest priority among equals), packing short tasks in to the end of the taxi's walltime
+    ## - 'priority': the highest-priority ready task that fits
+    backfill_policy = 'best_fit'
+    
+    ## If True, when the highest-priority ready task is a ConfigGenerator that doesn't fit in
+    ## the time a taxi has left, splits off as many of its trajectories as fit (at least
+    ## min_split_traj) in to a new ConfigGenerator for the taxi to run (see ConfigGenerator.split)
+    split_config_generators = False
+    min_split_traj = 1
+    
+    ## If True, taxis run several tasks at once, as long as the cores the tasks need add up to
+    ## no more than the taxi's cores (see run_taxi.py).  Tasks that don't specify cores need all of them.
+    ## This and the other policy settings listed in dispatch_settings can be stored in the
+    ## dispatch DB, so that taxis see them (see SQLiteDispatcher.store_settings).
+    concurrent_tasks = False
+    
+    ## Maximum number of tasks to hand out in one claim (see claim_next_tasks): the next task,
+    ## plus ready tasks of the same type and binary to run back-to-back after it
+    max_bundle_size = 1
+    
+    ## How long (in seconds) a taxi that is told to Sleep waits for a task to become ready
+    ## (see wait_for_ready_task) before giving up its queue slot and going idle; 0 means right away
+    sleep_wait_time = 0
+    
+    ## If set, claims on tasks are leases that expire lease_time seconds after they are taken or
+    ## last renewed; taxis renew their leases while running the tasks (see lease_heartbeat), and
+    ## active tasks with expired leases are marked abandoned (see reclaim_expired_leases)
+    lease_time = None
+    
+    ## If True, Runners (tasks that run a program) identical to a stored task (see task_content_hash)
+    ## aren't stored again: tasks that depend on them depend on the stored task instead
+    deduplicate_tasks = False
+
     def __init__(self):
         pass
 
@@ -75,13 +219,40 @@ class Dispatcher(object):
         print "Loaded Task subclasses:", taxi.all_subclasses_of(taxi.tasks.Task)
         
 
-    def get_all_tasks(self, my_taxi=None, include_complete=True):
+    def get_all_tasks(self, my_taxi=None, include_complete=True, lazy=False, include_archived=False):
         """Retrieve tasks from dispatch (i.e., stored task information). If my_taxi
         is specified, retrieves tasks that my_taxi can run; otherwise, retrieves all tasks.
-        If include_complete=False, retrieves only incomplete tasks.
+        If include_complete=False, retrieves only incomplete tasks.  Archived tasks (see
+        archive_complete_tasks) are only retrieved if include_archived=True.
+        
+        If lazy=True, the dispatcher may return lightweight TaskView instances, which
+        only have the attributes needed for scheduling, in place of full Task instances
+        (see materialize_tasks).
         
         Returns a dictionary like {id : (Task instance)}."""
         raise NotImplementedError
+    
+    
+    def archive_complete_tasks(self):
+        """Moves complete tasks that nothing unfinished depends on out of the way, so that
+        retrieving tasks (see get_all_tasks) doesn't slow down as a campaign's history grows.
+        Archived tasks still count as complete dependencies.  Returns the ids of the
+        tasks archived."""
+        raise NotImplementedError
+    
+    
+    def count_archived_tasks(self):
+        """Returns the number of archived tasks (see archive_complete_tasks)."""
+        return 0
+    
+    
+    def materialize_tasks(self, tasks):
+        """Returns a list of the full Task instances for the tasks in list tasks, which
+        may be Task or TaskView instances (see get_all_tasks).
+        
+        By default, get_all_tasks always returns full Task instances, so the tasks
+        are returned as they are."""
+        return list(tasks)
 
 
     def check_task_status(self, task):
@@ -92,19 +263,65 @@ class Dispatcher(object):
         raise NotImplementedError
 
 
+    def task_cores(self, task, for_taxi):
+        """Number of cores that task needs when run by taxi for_taxi: task.cores if
+        the task specifies it, otherwise all of the taxi's cores."""
+        task_cores = getattr(task, 'cores', None)
+        if task_cores is None:
+            return for_taxi.cores
+        return task_cores
+
+
+    def task_fits_taxi(self, task, for_taxi):
+        """Checks whether taxi for_taxi has the resources that task requires (see
+        task_requirements): at least as many cores, nodes, and as much memory as the
+        task declares, and a time limit of at least task.min_walltime.  Requirements
+        the task doesn't declare, or that the taxi doesn't specify, always fit."""
+        for task_attr, taxi_attr in task_requirements:
+            required = getattr(task, task_attr, None)
+            available = getattr(for_taxi, taxi_attr, None)
+            if required is not None and available is not None and required > available:
+                return False
+        return True
+
+
+    def estimated_time(self, task):
+        """Time in seconds that task is expected to need to run, for deciding whether
+        a taxi has enough time left to run it.  By default, the task's req_time;
+        dispatchers with a model of task run times may override this."""
+        return task.req_time
+
+
+    def count_unresolved_dependencies(self, task):
+        """Counts up the number of dependencies of task that are not complete,
+        and the number that are failed.  Returns tuple (n_unresolved, n_failed).
+        
+        By default, inspects the dependencies of task (see Task.count_unresolved_dependencies);
+        dispatchers that keep track of dependency resolution themselves may override this."""
+        return task.count_unresolved_dependencies()
+
+
     ## Taxi interface
-    def request_next_task(self, for_taxi):
+    def request_next_task(self, for_taxi, max_cores=None):
         """Determines the next task to be executed by taxi for_taxi.
         
         Returns a Task instance to be run by the taxi for_taxi.  Tasks are selected
-        based on whether or not for_taxi can run the task, whether for_taxi has
+        based on whether or not for_taxi can run the task (it is for for_taxi or any
+        taxi, and for_taxi has the resources it requires; see task_fits_taxi), whether for_taxi has
         enough time remaining to run a task before needing to resubmit, and whether
         task dependencies are satisfied. If work is complete,
         tells taxi to die by returning an instance of Die.  If no tasks for the taxi
         for_taxi are available to run, but there are tasks that it could run if it
         had more time remaining, tells the taxi to Respawn.  If no tasks for the taxi
         for_taxi are available to run given infinite time, but there are incomplete
-        tasks remaining, tells the taxi to Sleep."""
+        tasks remaining, tells the taxi to Sleep.
+        
+        If the highest-priority ready task doesn't fit in the time for_taxi has left,
+        splits it if possible (see split_config_generators), or else picks another ready
+        task to fill the time according to backfill_policy.
+        
+        If max_cores is specified, only considers tasks that need at most max_cores cores
+        (see task_cores), e.g. to fill the cores left over by tasks already running."""
         
         task_blob = self.get_all_tasks(for_taxi, include_complete=False)
 
@@ -114,10 +331,9 @@ class Dispatcher(object):
         else:
             task_priority_ids = [ t.id for t in sorted(task_blob.values(), key=task_priority_sort_key) ]
         
-        # Find highest-priority task that can be completed
+        # Find ready tasks, in priority order
         N_pending_tasks = 0
-        N_blocked_by_time = 0 # Tasks 'blocked by time' are ready to go, but not enough time to run
-        found_ready_task = False
+        ready_tasks = []
         for task_id in task_priority_ids:
             task = task_blob[task_id]
 
@@ -127,21 +343,20 @@ class Dispatcher(object):
             
             N_pending_tasks += 1
                 
-            # Check whether task is ready to go, and taxi can run it
-            N_unresolved, N_failed = task.count_unresolved_dependencies()
-            sufficient_time = for_taxi.enough_time_for_task(task)
-            
-            if not sufficient_time and N_unresolved == 0:
-                N_blocked_by_time += 1
-            
-            # Look deeper in priority list if task not ready
-            if N_unresolved > 0 or not sufficient_time:
-                continue
-            
-            # Task ready; stop looking for new task to run
-            found_ready_task = True
-            break
-
+            # Check whether task is ready to go
+            N_unresolved, N_failed = self.count_unresolved_dependencies(task)
+            if N_unresolved == 0 and self.task_fits_taxi(task, for_taxi) \
+                    and (max_cores is None or self.task_cores(task, for_taxi) <= max_cores):
+                ready_tasks.append(task)
+        
+        # Tasks 'blocked by time' are ready to go, but not enough time to run
+        fitting_tasks = [t for t in ready_tasks if for_taxi.enough_time_for_task(t, req_time=self.estimated_time(t))]
+        
+        # Run as much of the highest-priority ready task as fits, if it can be split
+        if len(ready_tasks) > 0 and (len(fitting_tasks) == 0 or fitting_tasks[0] is not ready_tasks[0]):
+            split_task = self._split_to_fit(ready_tasks[0], for_taxi)
+            if split_task is not None:
+                return split_task
 
         # If there are no tasks, finish up
         if N_pending_tasks == 0:
@@ -149,7 +364,7 @@ class Dispatcher(object):
             ## but add a test case!
             return tasks.Die(message="WORK COMPLETE: no tasks pending")
             
-        if not found_ready_task:
+        if len(fitting_tasks) == 0:
             ## TODO: we could add another status code that puts the taxi to sleep,
             ## but allows it to restart after some amount of time...
             ## Either that, or another script somewhere that checks the Pool
@@ -157,15 +372,45 @@ class Dispatcher(object):
             ## once it sees that it's happened.
             ## Also need to be wary of interaction with insufficient time check,
             ## which we should maybe track separately.
-            if N_blocked_by_time > 0:
+            if len(ready_tasks) > 0:
                 # Just need more time -- tell this taxi to resubmit itself!
                 return tasks.Respawn()
             else:
                 # Something is wrong other than not having enough time.
                 return tasks.Sleep(message="WORK COMPLETE: no tasks ready, but %d pending"%N_pending_tasks)
         
+        # Highest-priority ready task fits; or else, backfill (see backfill_policy)
+        task = fitting_tasks[0]
+        if task is not ready_tasks[0] and self.backfill_policy == 'best_fit':
+            task = max(fitting_tasks, key=self.estimated_time) # First of equals, i.e. highest priority
+        
         # If we've gotten this far, successfully found a pending task.
         return task
+    
+    
+    def _split_to_fit(self, task, for_taxi):
+        """If split_config_generators is set and task is a ConfigGenerator, splits off as
+        many of its trajectories as for_taxi has time for in to a new ConfigGenerator, using
+        the estimated time per trajectory (see estimated_time), and writes both to the
+        dispatch.  Returns the new ConfigGenerator, or None if task can't be split to fit."""
+        if not self.split_config_generators or not isinstance(task, mcmc.ConfigGenerator):
+            return None
+        
+        traj_time = float(self.estimated_time(task)) / task.n_traj
+        if traj_time <= 0:
+            return None
+        n_traj = min(int(math.ceil(for_taxi.time_remaining() / traj_time)) - 1, task.n_traj - 1)
+        if n_traj < max(self.min_split_traj, 1):
+            return None
+        
+        split_task = task.split(n_traj)
+        split_task.id = self._get_max_task_id() + 1
+        split_task.req_time = traj_time * n_traj
+        self.write_tasks([split_task, task])
+        
+        print "Split task {tid} to fit: new task {sid} runs trajectories {start}-{end}".format(
+            tid=task.id, sid=split_task.id, start=split_task.start_traj, end=split_task.final_traj)
+        return split_task
         
 
     def write_tasks(self, tasks):
@@ -180,7 +425,87 @@ class Dispatcher(object):
         raise NotImplementedError
 
 
-    def finalize_task_run(self, my_taxi, task):
+    def claim_next_task(self, my_taxi, max_cores=None):
+        """Determines the next task to be executed by my_taxi (see request_next_task,
+        including max_cores) and claims it for my_taxi (see claim_task).
+        
+        Returns the claimed Task instance, or an instance of Die, Sleep, or Respawn.
+        
+        Generically, this is just request_next_task followed by claim_task, so it
+        raises a TaskClaimException if another taxi claims the same task in between.
+        Dispatchers that can select and claim a task atomically should override this."""
+        task = self.request_next_task(for_taxi=my_taxi, max_cores=max_cores)
+        self.claim_task(my_taxi, task)
+        return task
+
+
+    def claim_next_tasks(self, my_taxi, max_cores=None):
+        """Like claim_next_task, but hands out a bundle of tasks for my_taxi to run back-to-back:
+        the next task, plus up to max_bundle_size-1 more (see request_task_bundle).  Saves the
+        round trips to the dispatch between many short tasks.
+        
+        Returns a list of the claimed Task instances, or a list of one instance of Die,
+        Sleep, or Respawn.  Only raises a TaskClaimException if the first task can't be
+        claimed; bundled tasks claimed by another taxi in the meantime are just left out,
+        since the tasks already claimed have to be run anyway."""
+        task = self.claim_next_task(my_taxi, max_cores=max_cores)
+        task_bundle = [task]
+        if self.max_bundle_size > 1 and getattr(task, 'id', None) is not None:
+            for bundled_task in self.request_task_bundle(my_taxi, task, max_cores=max_cores):
+                try:
+                    self.claim_task(my_taxi, bundled_task)
+                except TaskClaimException, e:
+                    print str(e)
+                    continue
+                task_bundle.append(bundled_task)
+        return task_bundle
+
+
+    def request_task_bundle(self, for_taxi, first_task, max_cores=None):
+        """Finds ready tasks for taxi for_taxi to run back-to-back after first_task: up to
+        max_bundle_size-1 tasks of the same type with the same binary that all fit in the
+        time for_taxi has left after first_task, highest priority first.  Returns a list of tasks.
+        
+        The bundle runs on the cores given to first_task, so bundled tasks may need at most
+        as many cores as first_task does (and at most max_cores cores, if specified)."""
+        time_left = for_taxi.time_remaining() - self.estimated_time(first_task)
+        bundle_cores = self._bundle_cores(for_taxi, first_task, max_cores)
+        task_type = first_task.__class__.__name__
+        binary = getattr(first_task, 'binary', None)
+        
+        task_blob = self.get_all_tasks(for_taxi, include_complete=False)
+        if task_blob is None:
+            return []
+        
+        task_bundle = []
+        for task in sorted(task_blob.values(), key=task_priority_sort_key):
+            if len(task_bundle) >= self.max_bundle_size - 1:
+                break
+            if task.id == first_task.id or task.status != 'pending':
+                continue
+            if task.__class__.__name__ != task_type or getattr(task, 'binary', None) != binary:
+                continue
+            if self.count_unresolved_dependencies(task)[0] > 0 or not self.task_fits_taxi(task, for_taxi):
+                continue
+            if self.task_cores(task, for_taxi) > bundle_cores:
+                continue
+            if not self.estimated_time(task) < time_left:
+                continue
+            time_left -= self.estimated_time(task)
+            task_bundle.append(task)
+            
+        return task_bundle
+    
+    
+    def _bundle_cores(self, for_taxi, first_task, max_cores=None):
+        """Most cores a task bundled with first_task may need (see request_task_bundle)."""
+        bundle_cores = self.task_cores(first_task, for_taxi)
+        if max_cores is not None:
+            bundle_cores = min(bundle_cores, max_cores)
+        return bundle_cores
+
+
+    def finalize_task_run(self, my_taxi, task, pool=None, queue=None):
         """Called by my_taxi when it has completed running task. Any information
         stored in the Task instance task while my_taxi was executing it will
         be stored in the dispatch for later inspection. Also marks the task
@@ -188,40 +513,206 @@ class Dispatcher(object):
         
         If a task is recurring (task.recurring == True), then the task will be set
         to pending instead of complete, but may still fail.
+        
+        If pool is provided, also launches the idle taxis in pool (on batch queue queue)
+        needed to run the tasks that are ready now that task is done (see wake_idle_taxis).
         """
+        self.finalize_task_runs(my_taxi, [task], pool=pool, queue=queue)
         
-        if task.status != 'failed':
-            if task.is_recurring:
-                task.status = 'pending'
-            else:
-                task.status = 'complete'
+        
+    def finalize_task_runs(self, my_taxi, task_bundle, pool=None, queue=None):
+        """Called by my_taxi when it has completed running all of the tasks in the list
+        task_bundle (e.g., a bundle from claim_next_tasks).  Same as finalize_task_run for
+        each task, but writes all of the tasks to the dispatch at once."""
+        
+        for task in task_bundle:
+            if task.status != 'failed':
+                if task.is_recurring:
+                    task.status = 'pending'
+                else:
+                    task.status = 'complete'
 
-        # Write local (completed) version of the task to the dispatch DB
-        # ...unless we don't have an id for it, in which case it's not in the DB or we can't find it
-        if getattr(task, 'id', None) is not None:
-            self.write_tasks([task])
+        # Write local (completed) versions of the tasks to the dispatch DB
+        # ...except ones we don't have an id for, which are not in the DB or we can't find them
+        tasks_to_write = [task for task in task_bundle if getattr(task, 'id', None) is not None]
+        if len(tasks_to_write) > 0:
+            self.write_tasks(tasks_to_write)
+        
+        if pool is not None:
+            self.wake_idle_taxis(my_taxi, task_bundle, pool, queue=queue)
+    
+    
+    def wait_for_ready_task(self, for_taxi, timeout, min_poll_interval=1., max_poll_interval=60.):
+        """Blocks until taxi for_taxi has something to do other than Sleep (a task is ready for it
+        to run, or there are no pending tasks left), or until timeout seconds have passed.
+        Returns True if for_taxi has something to do, False if timed out.
+        
+        Polls the dispatch, backing off exponentially from min_poll_interval to max_poll_interval
+        seconds between polls while nothing changes; the tasks are only looked over when the
+        dispatch has changed since the last poll (see _change_token)."""
+        deadline = time.time() + timeout
+        poll_interval = min_poll_interval
+        change_token = self._change_token()
+        
+        if self._has_work_for(for_taxi):
+            return True
+        
+        while time.time() < deadline:
+            time.sleep(max(min(poll_interval, deadline - time.time()), 0))
+            
+            new_change_token = self._change_token()
+            if new_change_token is None or new_change_token != change_token:
+                change_token = new_change_token
+                if self._has_work_for(for_taxi):
+                    return True
+                poll_interval = min_poll_interval # Things are happening; look again soon
+            else:
+                poll_interval = min(2*poll_interval, max_poll_interval)
+        
+        return False
+    
+    
+    def _change_token(self):
+        """Value that changes whenever the dispatch is changed (e.g., a task is finalized),
+        for cheaply checking whether anything has happened while waiting (see wait_for_ready_task).
+        Returns None if the dispatcher can't tell, in which case every poll looks over the tasks."""
+        return None
+    
+    
+    def _has_work_for(self, for_taxi):
+        """Checks whether taxi for_taxi would be told to do something other than Sleep by
+        request_next_task: some task it can run is ready (whether or not it fits in the time
+        for_taxi has left), or no tasks for it are pending."""
+        task_blob = self.get_all_tasks(for_taxi, include_complete=False)
+        if task_blob is None:
+            return True
+        
+        pending_tasks = [t for t in task_blob.values() if t.status == 'pending']
+        if len(pending_tasks) == 0:
+            return True
+        for task in pending_tasks:
+            if self.count_unresolved_dependencies(task)[0] == 0 and self.task_fits_taxi(task, for_taxi):
+                return True
+        return False
+    
+    
+    def wake_idle_taxis(self, my_taxi, task_bundle, pool, queue=None):
+        """Launches the idle taxis in pool (on batch queue queue, see Pool.submit_taxi_to_queue)
+        needed to run the tasks that are ready now that the tasks in task_bundle, just finalized
+        by my_taxi, are done (see newly_ready_tasks and taxis_to_wake).  Otherwise, idle taxis
+        are only launched when some running taxi next calls Pool.spawn_idle_taxis, which may be
+        a long time from now, or never, if no other taxis are running.
+        
+        Returns the list of launched taxis."""
+        ready_tasks = self.newly_ready_tasks(task_bundle)
+        if len(ready_tasks) == 0:
+            return []
+        
+        idle_taxis = self.taxis_to_wake(pool.get_all_taxis_in_pool(), ready_tasks, by_taxi=my_taxi)
+        for idle_taxi in idle_taxis:
+            pool.submit_taxi_to_queue(idle_taxi, queue=queue)
+        return idle_taxis
+    
+    
+    def newly_ready_tasks(self, task_bundle):
+        """Finds the pending tasks that depend on any of the (complete) tasks in task_bundle,
+        and are now ready to run.  Returns a list of tasks, highest priority first."""
+        finished_ids = set([task.id for task in task_bundle
+                            if getattr(task, 'id', None) is not None and task.status == 'complete'])
+        if len(finished_ids) == 0:
+            return []
+        
+        task_blob = self.get_all_tasks(None, include_complete=False)
+        if task_blob is None:
+            return []
+        
+        ready_tasks = []
+        for task in task_blob.values():
+            if task.status != 'pending':
+                continue
+            dependency_ids = set([getattr(dependency, 'id', dependency) for dependency in (task.depends_on or [])])
+            if len(dependency_ids.intersection(finished_ids)) > 0 and self.count_unresolved_dependencies(task)[0] == 0:
+                ready_tasks.append(task)
+        return sorted(ready_tasks, key=task_priority_sort_key)
+    
+    
+    def taxis_to_wake(self, taxi_list, ready_tasks, by_taxi=None):
+        """Picks which idle taxis in taxi_list to launch to run the tasks in ready_tasks (see
+        newly_ready_tasks).  Going through ready_tasks in order, each task is handed to the first
+        taxi on this dispatch that can run it (see task_fits_taxi) and doesn't have a task yet.
+        by_taxi (e.g., the taxi that just finished the tasks the ready tasks were waiting on) and
+        queued taxis will run ready tasks without being woken, so are handed tasks first.
+        
+        Returns the list of idle taxis that were handed a task."""
+        # We only care about taxis on this dispatch
+        taxi_list = [t for t in taxi_list if getattr(t, 'dispatch_path', None) is not None
+                     and taxi.expand_path(t.dispatch_path) == taxi.expand_path(self.db_path)]
+        if by_taxi is not None:
+            taxi_list = [t for t in taxi_list if str(t) != str(by_taxi)]
+        
+        available_taxis = [by_taxi] if by_taxi is not None else []
+        available_taxis += [t for t in taxi_list if t.status == 'Q']
+        available_taxis += [t for t in taxi_list if t.status == 'I']
+        
+        idle_taxis = []
+        for task in ready_tasks:
+            for my_taxi in available_taxis:
+                if task.for_taxi is not None and task.for_taxi != str(my_taxi):
+                    continue
+                if not self.task_fits_taxi(task, my_taxi):
+                    continue
+                # by_taxi has to make do with the time it has left; the others haven't started yet
+                if my_taxi is by_taxi and not my_taxi.enough_time_for_task(task, req_time=self.estimated_time(task)):
+                    continue
+                if my_taxi is not by_taxi and not self.estimated_time(task) < my_taxi.time_limit:
+                    continue
+                
+                available_taxis.remove(my_taxi)
+                if my_taxi is not by_taxi and my_taxi.status == 'I':
+                    idle_taxis.append(my_taxi)
+                break
+        
+        return idle_taxis
             
             
     def mark_abandoned_task(self, by_taxi):
         """Method to handle the case when a Taxi has died unexpectedly.  When this occurs, it often means
         a task is left marked 'active', but has in fact failed(/been abandoned).  This method marks that task
         abandoned.
+        
+        A taxi running several tasks at once (see concurrent_tasks) leaves all of them
+        active, so every task still active for by_taxi is marked abandoned.
         """
         
         by_taxi = str(by_taxi)
         assert by_taxi is not None # This should never happen, but would be catastrophically inconvenient if it did.
         
-        tasks = self.get_all_tasks()
-        abandoned_tasks = []
-        for task_id, task in tasks.items():
-            if task.status == 'active' and task.by_taxi == by_taxi:
-                task.status = 'abandoned'
-                print "WARNING: Task {tid} was abandoned by taxi {tn}.".format(tid=task_id, tn=by_taxi)
-                abandoned_tasks.append(task)
+        tasks = self.get_all_tasks(lazy=True)
+        if tasks is None:
+            return
+        abandoned_tasks = [task for task in tasks.values() if task.status == 'active' and task.by_taxi == by_taxi]
+        
+        abandoned_tasks = self.materialize_tasks(abandoned_tasks)
+        for task in abandoned_tasks:
+            task.status = 'abandoned'
+            print "WARNING: Task {tid} was abandoned by taxi {tn}.".format(tid=task.id, tn=by_taxi)
         
-        # NOTE: At present, a taxi shouldn't be able to run multiple tasks at once
-        # ...but this way, if we allow them to do so, this routine will still work.
         self.write_tasks(abandoned_tasks)
+    
+    
+    @contextmanager
+    def lease_heartbeat(self, my_taxi, task_bundle):
+        """Context (e.g., for my_taxi to run the tasks in task_bundle in) in which my_taxi's
+        leases on the tasks in task_bundle are kept from expiring (see lease_time).
+        By default, does nothing; dispatchers that support leases override this."""
+        yield
+        
+        
+    def reclaim_expired_leases(self):
+        """Marks abandoned all active tasks whose leases have expired (see lease_time), i.e.,
+        whose taxis have stopped renewing them, probably because they died.  Returns the list
+        of the ids of the abandoned tasks."""
+        raise NotImplementedError
         
         
     def _trunk_number(self, task_blob, for_taxi=None):
@@ -237,7 +728,7 @@ class Dispatcher(object):
         
         # If we're asking about a particular taxi, filter for tasks that taxi can run
         if for_taxi is not None:
-            for_taxi = str(taxi)
+            for_taxi = str(for_taxi)
             task_blob = [t for t in task_blob if t.for_taxi==for_taxi]
         
         N_active_trunks = 0
@@ -250,7 +741,7 @@ class Dispatcher(object):
                 continue
                 
             # Check whether task is ready to go, and taxi can run it
-            N_unresolved, N_failed = task.count_unresolved_dependencies()
+            N_unresolved, N_failed = self.count_unresolved_dependencies(task)
             if N_unresolved == 0:
                 N_active_trunks += 1
 
@@ -274,12 +765,43 @@ class Dispatcher(object):
         N_ready_tasks = 0
         for task in task_blob:
             # Check whether task is ready to go, and taxi can run it
-            N_unresolved, N_failed = task.count_unresolved_dependencies()
+            N_unresolved, N_failed = self.count_unresolved_dependencies(task)
             if N_unresolved == 0:
                 N_ready_tasks += 1
         return N_ready_tasks
     
     
+    def _count_trunks_and_ready_tasks(self):
+        """Counts, in one pass over the incomplete tasks, the trunks available to work on
+        (see _trunk_number) and the ready tasks (see _N_ready_tasks), bucketed by the
+        taxi the tasks are for.
+        
+        Returns two dictionaries like {for_taxi : count}, for trunks and for ready tasks;
+        tasks that any taxi can run are counted under for_taxi=None.
+        """
+        task_blob = self.get_all_tasks(None, include_complete=False, lazy=True) # dict(id:task view)
+        if task_blob is None:
+            return {}, {}
+        
+        trunk_counts = {}
+        ready_counts = {}
+        for task in task_blob.values():
+            if task.status == 'active':
+                is_ready = False
+            elif task.status == 'pending':
+                N_unresolved, N_failed = self.count_unresolved_dependencies(task)
+                is_ready = (N_unresolved == 0)
+            else:
+                continue
+            
+            if is_ready:
+                ready_counts[task.for_taxi] = ready_counts.get(task.for_taxi, 0) + 1
+            if task.trunk and (is_ready or task.status == 'active'):
+                trunk_counts[task.for_taxi] = trunk_counts.get(task.for_taxi, 0) + 1
+                
+        return trunk_counts, ready_counts
+    
+    
     def should_taxis_be_running(self, taxi_list):
         """Determines whether tasks are available for each taxi to run.
         
@@ -293,7 +815,7 @@ class Dispatcher(object):
             Dictionary like {(taxi object) : (should taxi be running?)}
         """
         
-        task_blob = self.get_all_tasks(None, include_complete=False) # dict(id:task)
+        trunk_counts, ready_counts = self._count_trunks_and_ready_tasks() # dicts(for_taxi:count)
     
         # There's nothing we can do with errored E or held H taxis
         taxi_list = [t for t in taxi_list if t.status in ['Q', 'R', 'I']] # Only want queued, running, or idle taxis
@@ -314,9 +836,9 @@ class Dispatcher(object):
         
         # If taxi has a trunk only it can run, or some tasks are ready that only this taxi can run, it must be running
         for my_taxi in taxi_list:
-            if self._trunk_number(task_blob, for_taxi=my_taxi) > 0:
+            if trunk_counts.get(str(my_taxi), 0) > 0:
                 desired_state[str(my_taxi)] = True
-            if self._N_ready_tasks(task_blob, for_taxi=my_taxi) > 0:
+            if ready_counts.get(str(my_taxi), 0) > 0:
                 desired_state[str(my_taxi)] = True
                 
         # With taxi-specific requirements imposed, now just make sure we have enough taxis running
@@ -325,10 +847,10 @@ class Dispatcher(object):
         
         N_active_taxis = len(active_taxis)
         
-        N_active_trunks = self._trunk_number(task_blob)
+        N_active_trunks = sum(trunk_counts.values())
         
         # Even without trunks, if we have tasks that are ready, we need at least one taxi
-        N_ready_tasks = self._N_ready_tasks(task_blob)
+        N_ready_tasks = sum(ready_counts.values())
         if N_active_trunks == 0 and N_ready_tasks:
             N_active_trunks = N_ready_tasks # Correct behavior for trunkless task forests
         
@@ -342,17 +864,92 @@ class Dispatcher(object):
         return desired_state
         
         
-    def _invert_dependency_graph(self, task_pool):
-        # Give each task an identifier, reset dependents
+    def _build_dependency_graph(self, task_pool):
+        """Builds index-keyed adjacency lists for the dependency graph of the tasks in
+        task_pool, in one pass over tasks and dependencies (O(V+E)).
+        
+        Dependencies may be Task instances or task ids.  Dependencies that aren't in
+        task_pool are left out of the graph, and counted as external.  A dependency
+        listed more than once by the same task is only included once.
+        
+        Returns a dict with entries:
+            dependencies - List, for each task in task_pool, of the indices of its dependencies
+            dependents - List, for each task in task_pool, of the indices of its dependents
+            n_external - Number of dependencies on tasks outside of task_pool
+            duplicates - List of (task, dependency) pairs listed more than once
+        """
+        task_pool = list(task_pool)
+        
+        # Look up tasks by object, or by id for dependencies stored as ids
+        index_of_object = {}
+        index_of_id = {}
+        for jj, task in enumerate(task_pool):
+            index_of_object[id(task)] = jj
+            if getattr(task, 'id', None) is not None:
+                index_of_id[task.id] = jj
+        
+        dependencies = [[] for task in task_pool]
+        dependents = [[] for task in task_pool]
+        n_external = 0
+        duplicates = []
         for jj, task in enumerate(task_pool):
-            task._dependents = []
-
-        # Let dependencies know they have a dependent
-        for task in task_pool:
             if task.depends_on is None:
                 continue
+            seen = set([])
             for dependency in task.depends_on:
-                dependency._dependents.append(task)
+                if isinstance(dependency, (int, long)):
+                    kk = index_of_id.get(dependency, None)
+                else:
+                    kk = index_of_object.get(id(dependency), None)
+                if kk is None:
+                    n_external += 1
+                    continue
+                if kk in seen:
+                    duplicates.append((task, task_pool[kk]))
+                    continue
+                seen.add(kk)
+                dependencies[jj].append(kk)
+                dependents[kk].append(jj)
+        
+        return dict(dependencies=dependencies, dependents=dependents,
+                    n_external=n_external, duplicates=duplicates)
+    
+    
+    def _topological_order(self, task_pool, graph):
+        """Orders the indices of the tasks in task_pool so that every task comes after all
+        of its dependencies (Kahn's algorithm, O(V+E)), given graph from _build_dependency_graph.
+        
+        Raises a DependencyCycleException if the dependencies of the tasks form a cycle, in
+        which case the tasks on the cycle could never run.
+        """
+        n_unordered_dependencies = [len(deps) for deps in graph['dependencies']]
+        order = [jj for jj, n in enumerate(n_unordered_dependencies) if n == 0]
+        
+        # order grows as dependencies are resolved; ii walks through it
+        ii = 0
+        while ii < len(order):
+            for kk in graph['dependents'][order[ii]]:
+                n_unordered_dependencies[kk] -= 1
+                if n_unordered_dependencies[kk] == 0:
+                    order.append(kk)
+            ii += 1
+        
+        if len(order) < len(n_unordered_dependencies):
+            cycle_tasks = [task_pool[jj] for jj, n in enumerate(n_unordered_dependencies) if n > 0]
+            raise DependencyCycleException("Dependencies of {0} tasks form a cycle, e.g.: {1}"\
+                .format(len(cycle_tasks), ", ".join([str(getattr(t, 'id', None) or t) for t in cycle_tasks[:5]])))
+        
+        return order
+    
+    
+    def _invert_dependency_graph(self, task_pool):
+        """Gives each task in task_pool a list task._dependents of the tasks in task_pool
+        that depend on it."""
+        task_pool = list(task_pool)
+        graph = self._build_dependency_graph(task_pool)
+        for jj, task in enumerate(task_pool):
+            task._dependents = [task_pool[kk] for kk in graph['dependents'][jj]]
+        return graph
                 
 
     ## Initialization
@@ -361,39 +958,88 @@ class Dispatcher(object):
         of trunk tasks, and all tasks that depend on the trunk tasks out to the leaves.
         If a new trunk forks off of a sequence of trunk tasks, this is a new branch.
         
+        Tasks with no dependencies in task_pool are the roots of the branches.  Runs in
+        O(V+E), raises a DependencyCycleException if the dependencies form a cycle, and
+        warns about tasks that list the same dependency more than once.  Statistics
+        about the forest are stored in self.branch_stats (see _branch_statistics).
+        
         Returns a list of lists of Task instances.  Each sublist is a branch.
         """
+        task_pool = list(task_pool)
+        
         ## Scaffolding
-        self._invert_dependency_graph(task_pool)
+        graph = self._invert_dependency_graph(task_pool)
+        order = self._topological_order(task_pool, graph)
+        
+        for task, dependency in graph['duplicates']:
+            print "WARNING: Task {0} lists dependency {1} more than once".format(getattr(task, 'id', None) or task,
+                                                                              getattr(dependency, 'id', None) or dependency)
                 
         ## Break apart tasks into separate trees
         # First, find all roots
-        trees = []
-        for task in task_pool:
-            if task.depends_on is None or len(task.depends_on) == 0:
-                trees.append([task])
+        trees = [[jj] for jj in range(len(task_pool)) if len(graph['dependencies'][jj]) == 0]
+        in_tree = set([tree[0] for tree in trees])
 
         ## Build out from roots
         # TODO:
         # - If dependent has different number of nodes, make it a new tree
         # - If task is a trunk task and two dependents are trunk tasks, make one of them a new tree
-        for tree in trees:
-            for tree_task in tree:
+        # Trees (and tasks in trees) are appended to as they're walked through, so walk by index
+        tt = 0
+        while tt < len(trees):
+            tree = trees[tt]
+            ii = 0
+            while ii < len(tree):
+                tree_task = task_pool[tree[ii]]
+                ii += 1
                 if not tree_task.trunk:
                     continue
                 n_trunks_found = 0
-                for d in tree_task._dependents:
+                for kk in graph['dependents'][tree[ii-1]]:
+                    if kk in in_tree:
+                        continue # Already in a tree through another dependency
+                    in_tree.add(kk)
                     # Count number of trunk tasks encountered in dependents, fork if this isn't the first
-                    if d.trunk:
+                    if task_pool[kk].trunk:
                         n_trunks_found += 1
                         if n_trunks_found > 1:
-                            trees.append([d]) # Break branch off in to a new tree
+                            trees.append([kk]) # Break branch off in to a new tree
                             continue
                     # Normal behavior: build on current tree
-                    tree.append(d)
+                    tree.append(kk)
+            tt += 1
         
-        return trees
-                
+        self.branch_stats = self._branch_statistics(task_pool, graph, order, trees)
+        
+        return [[task_pool[jj] for jj in tree] for tree in trees]
+    
+    
+    def _branch_statistics(self, task_pool, graph, order, trees):
+        """Summarizes the shape of a task forest (see find_branches).  Returns a dict of
+        counts of tasks, dependencies, roots, and branches, the sizes of the largest and
+        average branch, the length of the longest chain of dependencies, and the number of
+        tasks that aren't in any branch."""
+        # Longest chain of dependencies ending at each task, in topological order
+        depth = [1]*len(task_pool)
+        for jj in order:
+            for kk in graph['dependents'][jj]:
+                depth[kk] = max(depth[kk], depth[jj] + 1)
+        
+        branch_sizes = [len(tree) for tree in trees]
+        return {
+            'n_tasks' : len(task_pool),
+            'n_dependencies' : sum([len(deps) for deps in graph['dependencies']]),
+            'n_external_dependencies' : graph['n_external'],
+            'n_duplicate_dependencies' : len(graph['duplicates']),
+            'n_roots' : sum([1 for deps in graph['dependencies'] if len(deps) == 0]),
+            'n_branches' : len(trees),
+            'largest_branch' : max(branch_sizes) if len(trees) > 0 else 0,
+            'mean_branch' : float(sum(branch_sizes))/len(trees) if len(trees) > 0 else 0.,
+            'longest_chain' : max(depth) if len(task_pool) > 0 else 0,
+            'n_unbranched' : len(task_pool) - sum(branch_sizes),
+        }
+    
+    
     def _find_lowest_task_priority(self, task_pool):
         lowest_priority = 0
         for task in task_pool:
@@ -403,11 +1049,12 @@ class Dispatcher(object):
         return lowest_priority
 
 
-    def _assign_priorities(self, task_pool, priority_method):
+    def _assign_priorities(self, task_pool, priority_method, lowest_priority=None):
         """
         Assign task priorities to the newly tree-structured task pool.  Respects
         any user-assigned priority values that already exist.  All auto-assigned
-        tasks have lower priority than user-chosen ones.
+        tasks have lower priority than user-chosen ones (or than lowest_priority,
+        if specified).
 
         'priority_method' describes the algorithm to be used for assigning priority.
         Currently, the following options are available:
@@ -418,11 +1065,16 @@ class Dispatcher(object):
         tasks at the same tree depth, before moving deeper.
         - 'canvas': Or "anti-trunk".  Workflow will work on trunk tasks last, working through
         the tree layer-by-layer.
+        - 'critical_path': Longest-path-first priority: the workflow works first on the tasks
+        with the most work chained downstream of them (e.g., long HMC streams with many measurements
+        waiting on them), to finish the whole forest as soon as possible. Work is measured by
+        req_time, or by the run time of previous runs of the task where available.
         - 'anarchy': No priorities are automatically assigned.  In the absence of user-determined
         priorities, the tasks will be run in arbitrary order, except that dependencies will be
         resolved first.
         """
-        lowest_priority = self._find_lowest_task_priority(task_pool)
+        if lowest_priority is None:
+            lowest_priority = self._find_lowest_task_priority(task_pool)
 
         if priority_method == 'tree':
             for tree in self.trees:
@@ -453,6 +1105,17 @@ class Dispatcher(object):
                         task.priority = lowest_priority + 1
             return
             
+        elif priority_method == 'critical_path':
+            task_pool = list(task_pool)
+            path_lengths = self._critical_path_lengths(task_pool)
+            
+            # Longer remaining path means higher priority (smaller number); equal lengths tie
+            rank_of_length = dict([(length, rank) for rank, length in enumerate(sorted(set(path_lengths), reverse=True))])
+            for task, length in zip(task_pool, path_lengths):
+                if task.priority < 0:
+                    task.priority = lowest_priority + 1 + rank_of_length[length]
+            return
+            
         elif priority_method == 'anarchy':
             ## Do nothing
             return
@@ -461,18 +1124,97 @@ class Dispatcher(object):
             raise ValueError("Invalid choice of priority assignment method: {0}".format(priority_method))
 
 
+    def _critical_path_lengths(self, task_pool):
+        """For each task in task_pool, computes the total time along the longest chain of
+        tasks starting with that task and following dependents out to the leaves (in O(V+E)).
+        
+        Time for each task is its run time from a previous run, if it has one, or else its
+        req_time; every task counts for at least one second, so untimed chains still count.
+        
+        Returns a list of lengths in seconds, in the same order as task_pool.
+        """
+        graph = self._build_dependency_graph(task_pool)
+        order = self._topological_order(task_pool, graph)
+        
+        task_times = []
+        for task in task_pool:
+            run_time = getattr(task, 'run_time', None)
+            if run_time is not None and run_time > 0:
+                task_times.append(run_time)
+            else:
+                task_times.append(max(getattr(task, 'req_time', 0) or 0, 1))
+        
+        # Walk backwards from the leaves
+        path_lengths = list(task_times)
+        for jj in reversed(order):
+            downstream = [path_lengths[kk] for kk in graph['dependents'][jj]]
+            if len(downstream) > 0:
+                path_lengths[jj] = task_times[jj] + max(downstream)
+        return path_lengths
+    
+    
     def _assign_task_ids(self, task_pool):
+        for task in self._stream_task_ids(task_pool):
+            pass
+    
+    
+    def _stream_task_ids(self, task_stream):
+        """Gives each task from the iterable task_stream an integer id as it is iterated
+        over, and yields it."""
         # If we are adding a new pool to an existing dispatcher, 
         # start enumerating task IDs at the end
         start_id = self._get_max_task_id()
         
         # Give each task an integer id
-        for jj, task in enumerate(task_pool):
+        for jj, task in enumerate(task_stream):
             task.id = jj + start_id + 1
+            yield task
             
 
-    def _populate_task_table(self, task_pool):
-        self.write_tasks(task_pool)
+    def _populate_task_table(self, task_pool, chunk_size=2000, n_processes=None):
+        self.load_tasks(task_pool, chunk_size=chunk_size, n_processes=n_processes)
+    
+    
+    def load_tasks(self, task_stream, chunk_size=2000, n_processes=None, report_progress=True):
+        """Bulk version of write_tasks: stores the tasks from the iterable task_stream
+        (a list, or a generator like mcmc.iter_config_generator_stream), chunk_size tasks
+        at a time, so that the whole stream never needs to be compiled at once.  Prints
+        progress and throughput after each chunk if report_progress=True.
+        
+        Dispatchers which can compile tasks in several processes at once do so with up to
+        n_processes processes (default: one).
+        
+        Returns the number of tasks stored."""
+        n_loaded = 0
+        start_time = time.time()
+        
+        chunk = []
+        for task in task_stream:
+            chunk.append(task)
+            if len(chunk) < chunk_size:
+                continue
+            self._load_task_chunk(chunk, n_processes)
+            n_loaded += len(chunk)
+            chunk = []
+            if report_progress:
+                self._report_load_progress(n_loaded, start_time)
+        if len(chunk) > 0:
+            self._load_task_chunk(chunk, n_processes)
+            n_loaded += len(chunk)
+            if report_progress:
+                self._report_load_progress(n_loaded, start_time)
+        
+        return n_loaded
+    
+    
+    def _load_task_chunk(self, task_chunk, n_processes=None):
+        self.write_tasks(task_chunk)
+    
+    
+    def _report_load_progress(self, n_loaded, start_time):
+        elapsed = max(time.time() - start_time, 1e-6)
+        print "Loaded {0} tasks in {1:.1f} s ({2:.0f} tasks/s)".format(n_loaded, elapsed, n_loaded / elapsed)
+        taxi.flush_output()
 
 
     def _get_max_task_id(self):
@@ -483,12 +1225,18 @@ class Dispatcher(object):
         raise NotImplementedError
 
 
-    def initialize_new_task_pool(self, task_pool, priority_method='canvas', imports=None):
+    def initialize_new_task_pool(self, task_pool, priority_method='canvas', imports=None,
+                                 chunk_size=2000, n_processes=None):
         """Loads the tasks from task_pool in to an empty dispatcher by compiling
         the specified tasks (i.e., assigning IDs and priorities, rendering them in
-        to storable format (e.g., JSON)) and storing them in the dispatch (usually a DB).
-        
-        See Dispatcher._assign_priorities for priority_method options.
+        to storable format (e.g., JSON)) and storing them in the dispatch (usually a DB),
+        chunk_size tasks at a time, with up to n_processes processes (see load_tasks).
+        
+        See Dispatcher._assign_priorities for priority_method options.  Every method except
+        'anarchy' needs the whole task forest, so task_pool is read in to a list first; with
+        'anarchy', a generator task_pool (e.g., mcmc.iter_config_generator_stream) is streamed
+        in to the dispatch without ever holding all of the tasks, but must then yield every
+        task after the tasks it depends on, and isn't checked for dependency cycles.
         """
         ## imports: Dispatcher needs to be able to import relevant runners.
         ## Convenient default behavior: import the calling script (presumably, the run-spec script)
@@ -500,19 +1248,172 @@ class Dispatcher(object):
         self._store_imports()
             
         ## Build dispatch
-        self.trees = self.find_branches(task_pool)
-        self._assign_priorities(task_pool, priority_method=priority_method)
-        self._assign_task_ids(task_pool)
-        self._populate_task_table(task_pool)
+        if priority_method == 'anarchy' and not isinstance(task_pool, (list, tuple)):
+            # Nothing to work out from the whole forest: number the tasks as they stream in
+            self.trees = None
+            task_pool = self._stream_task_ids(task_pool)
+        else:
+            task_pool = list(task_pool)
+            self.trees = self.find_branches(task_pool)
+            self._assign_priorities(task_pool, priority_method=priority_method)
+            self._assign_task_ids(task_pool)
+        self._populate_task_table(task_pool, chunk_size=chunk_size, n_processes=n_processes)
+
+
+    def extend_dispatch(self, new_tasks, priority_method='canvas', imports=None,
+                        chunk_size=2000, n_processes=None):
+        """Adds the tasks in new_tasks to a dispatch that already holds tasks (e.g., to extend
+        ensembles with mcmc.extend_ensemble), without reloading or re-prioritizing the tasks
+        already stored.  New tasks may depend on stored tasks by id, or by task (e.g., a task
+        from get_all_tasks).  Imports not already stored are added (see initialize_new_task_pool).
+        
+        New tasks are fit in to the branches and priorities of the stored tasks, assuming that
+        these were assigned with the same priority_method (see _assign_incremental_priorities).
+        """
+        new_tasks = list(new_tasks)
+        
+        ## Imports: add any that aren't stored already
+        if imports is None:
+            imports = [taxi.expand_path(__main__.__file__)] # Import the file that called this pool (presumably, run-spec script)
+        stored_imports = list(getattr(self, 'imports', None) or [])
+        self.imports = stored_imports + [ii for ii in imports if ii not in stored_imports]
+        self._store_imports()
+        
+        ## Dependencies on tasks outside of new_tasks are dependencies on stored tasks: keep their ids
+        in_pool = set([id(task) for task in new_tasks])
+        attached_ids = set([])
+        for task in new_tasks:
+            if task.depends_on is None:
+                continue
+            task.depends_on = [d if id(d) in in_pool else getattr(d, 'id', d) for d in task.depends_on]
+            attached_ids.update([d for d in task.depends_on if not isinstance(d, tasks.Task)])
+        attached_tasks = self._get_task_views(attached_ids)
+        missing_ids = sorted(attached_ids - set(attached_tasks.keys()))
+        assert len(missing_ids) == 0, "New tasks depend on task(s) {0}, which aren't in the dispatch".format(missing_ids)
+        
+        ## Build on to dispatch
+        self.trees = self.find_branches(new_tasks)
+        self._assign_incremental_priorities(new_tasks, attached_tasks, priority_method=priority_method)
+        self._assign_task_ids(new_tasks)
+        self._populate_task_table(new_tasks, chunk_size=chunk_size, n_processes=n_processes)
+    
+    
+    def _assign_incremental_priorities(self, task_pool, attached_tasks, priority_method):
+        """Assigns priorities to the tasks in task_pool, being added to the dispatch by
+        extend_dispatch, to match those of the stored tasks (see _assign_priorities):
+        
+        - 'tree': A branch of new tasks whose root is a trunk task depending on a stored
+        trunk task carries on the branch of the stored task, at its priority.  Other new
+        branches get priorities lower than all of the stored tasks.
+        - 'trunk', 'canvas': New tasks get the priorities of the stored trunk and non-trunk tasks.
+        - 'critical_path': New tasks are ranked amongst themselves, at priorities lower than
+        all of the stored tasks (stored tasks are not re-ranked).
+        - 'anarchy': No priorities are automatically assigned.
+        
+        attached_tasks is a dict like {id : task (or TaskView)} of the stored tasks that
+        the tasks in task_pool depend on (see _get_task_views), and self.trees must
+        hold the branches of task_pool (see find_branches).
+        """
+        levels = self._stored_priority_levels()
+        lowest_priority = max([self._find_lowest_task_priority(task_pool)] + levels.values())
+        
+        if priority_method == 'tree':
+            for tree in self.trees:
+                root_task = tree[0]
+                continued = []
+                if root_task.trunk and root_task.depends_on is not None:
+                    continued = [attached_tasks[d] for d in root_task.depends_on
+                                 if not isinstance(d, tasks.Task) and attached_tasks[d].trunk]
+                if len(continued) > 0:
+                    tree_priority = continued[0].priority
+                else:
+                    tree_priority = lowest_priority + 1
+                    lowest_priority = tree_priority
+                
+                for tree_task in tree:
+                    if tree_task.priority < 0:
+                        tree_task.priority = tree_priority
+            return
+        
+        elif priority_method in ['trunk', 'canvas']:
+            # Work back to the lowest priority the stored tasks were assigned relative to
+            offsets = {True : 1, False : 2} if priority_method == 'trunk' else {True : 2, False : 1}
+            base_priority = max([self._find_lowest_task_priority(task_pool)]
+                                + [priority - offsets[trunk] for trunk, priority in levels.items()])
+            self._assign_priorities(task_pool, priority_method, lowest_priority=base_priority)
+            return
+        
+        else:
+            self._assign_priorities(task_pool, priority_method, lowest_priority=lowest_priority)
+    
+    
+    def _get_task_views(self, task_ids):
+        """Returns a dict like {id : task (or TaskView, see get_all_tasks)} of the stored
+        tasks with ids in task_ids; ids not found in the dispatch are left out."""
+        task_blob = self.get_all_tasks(include_complete=True, lazy=True) or {}
+        return dict([(task_id, task_blob[task_id]) for task_id in task_ids if task_blob.has_key(task_id)])
+    
+    
+    def _stored_priority_levels(self):
+        """Returns a dict like {trunk (bool) : lowest priority (i.e., highest number)} of the
+        stored trunk and non-trunk tasks.  Tasks without priorities are ignored."""
+        task_blob = self.get_all_tasks(include_complete=True, lazy=True) or {}
+        levels = {}
+        for task in task_blob.values():
+            if task.priority >= 0:
+                levels[bool(task.trunk)] = max(levels.get(bool(task.trunk), task.priority), task.priority)
+        return levels
 
 
     ## Cascading rollback
-    def rollback(self, tasks, delete_files=False, rollback_dir=None):
+    def rollback_closure(self, tasks):
+        """Finds the tasks that rolling back the tasks in list tasks would roll back: those
+        tasks, and everything downstream of them that has run (i.e., isn't pending; pending
+        tasks, and so everything downstream of them, haven't run yet and are left alone).
+        Found in one traversal of the dependency graph (O(V+E)), however many tasks are given.
+        
+        Returns a list of tasks (possibly TaskViews, see get_all_tasks), in order of id."""
+        task_blob = self.get_all_tasks(include_complete=True, lazy=True)
+        task_pool = task_blob.values() if task_blob is not None else []
+        return self._rollback_closure_in(task_pool, tasks)
+    
+    
+    def _rollback_closure_in(self, task_pool, tasks):
+        """Finds the rollback closure of the tasks in list tasks (see rollback_closure) among
+        the tasks in task_pool."""
+        graph = self._build_dependency_graph(task_pool)
+        index_of_id = dict([(task.id, jj) for jj, task in enumerate(task_pool)])
+        
+        to_visit = []
+        for task in tasks:
+            assert index_of_id.has_key(task.id), "Can't find task {0} to roll back in dispatch".format(task.id)
+            to_visit.append(index_of_id[task.id])
+        in_closure = set(to_visit)
+        
+        # Could do this with recursion instead, but recursion is slow in Python
+        while len(to_visit) > 0:
+            jj = to_visit.pop()
+            for kk in graph['dependents'][jj]:
+                if kk in in_closure or task_pool[kk].status == 'pending':
+                    continue
+                in_closure.add(kk)
+                to_visit.append(kk)
+        
+        return sorted([task_pool[jj] for jj in in_closure], key=lambda task: task.id)
+
+
+    def rollback(self, tasks, delete_files=False, rollback_dir=None, dry_run=False, n_file_workers=8):
         """Rolls back a task (or tasks) and any tasks that depend on it, and any tasks that depend on those, etc.
+        (see rollback_closure).  If any of these tasks is active, nothing is rolled back.
         
         Any task rolled back will have its status changed back to pending and any output files removed.
         If delete_files==True, output files will be deleted. If rollback_dir is specified,
-        output files will be moved to rollback_dir.
+        output files will be moved to rollback_dir.  Files are moved (or deleted) by up to n_file_workers
+        threads at once, and then all of the status changes are written to the dispatch at once.
+        
+        If dry_run=True, only reports what would be rolled back.
+        
+        Returns the list of tasks rolled back (or that would be rolled back, if dry_run=True).
         """
         
         if not hasattr(tasks, '__iter__'): # Passed a single task, presumably
@@ -521,51 +1422,47 @@ class Dispatcher(object):
         assert not (rollback_dir is None and delete_files == False),\
             "Must either provide a rollback_dir to copy files to or give permission to delete_files"
         
-        task_blob = self.get_all_tasks(include_complete=True)
+        tasks_to_roll_back = self.rollback_closure(tasks)
         
-        affected_tasks = []
+        active_ids = [task.id for task in tasks_to_roll_back if task.status == 'active']
+        if len(active_ids) > 0:
+            print "Can't rollback active task(s) w/ id(s)={0}. Kill them first.".format(active_ids)
+            return []
         
-        for task in tasks:
-            # Find the task to roll back in the new task blob (objects won't be identical, but ids will)
-            # TODO: Use task equality instead of ids?
-            assert task_blob.has_key(task.id), "Can't find task to roll back in rollbackable tasks"
-            task = task_blob[task.id]
-            
-            # Find rollbackable (non-active, non-pending) tasks (also dict->list)
-            task_blob = [t for t in task_blob.values() if t.status not in ['active', 'pending']]
-            
-            # Find dependents
-            self._invert_dependency_graph(task_blob)
-            
-            # Could do this with recursion instead, but recursion is slow in Python
-            cascade_tasks = [task]
-            tasks_to_roll_back = []
-            while len(cascade_tasks) > 0:
-                # Pop task to roll back off front of list
-                rt = cascade_tasks[0]
-                cascade_tasks = cascade_tasks[1:]
-                
-                if rt.status == 'active':
-                    print "Can't rollback active task w/ id={0}. Kill it first.".format(rt.id)
-                    # Cancel rollbacking
-                    tasks_to_roll_back = [] 
-                    break
-                
-                tasks_to_roll_back.append(rt)
-                
-                # Must roll back everything downstream, add to list
-                for d in rt._dependents:
-                    if d not in task_blob:
-                        continue # Not rollbackable
-                    cascade_tasks.append(d)
-                    
-            for rt in tasks_to_roll_back:
-                # Perform rollback
-                affected_tasks.append(rt)
-                rt._rollback(delete_files=delete_files, rollback_dir=rollback_dir)
-            
-        # Update DB
+        if dry_run:
+            print "Would roll back {0} task(s): {1}".format(len(tasks_to_roll_back), [task.id for task in tasks_to_roll_back])
+            return tasks_to_roll_back
+        
+        tasks_to_roll_back = self.materialize_tasks(tasks_to_roll_back)
+        
+        if rollback_dir is not None:
+            taxi.ensure_path_exists(taxi.expand_path(rollback_dir)) # Dig out the rollback directory once, up front
+        
+        def roll_back_task(task):
+            try:
+                task._rollback(delete_files=delete_files, rollback_dir=rollback_dir)
+                return None
+            except Exception, e:
+                print "Failed to roll back task {0}: {1}".format(task.id, e)
+                return e
+        
+        # File moves are I/O-bound, so threads can overlap them
+        file_workers = ThreadPool(max(min(n_file_workers, len(tasks_to_roll_back)), 1))
+        try:
+            errors = file_workers.map(roll_back_task, tasks_to_roll_back)
+        finally:
+            file_workers.close()
+            file_workers.join()
+        
+        # Update DB, in one go -- except for the tasks that couldn't be rolled back
+        affected_tasks = [task for task, error in zip(tasks_to_roll_back, errors) if error is None]
         self.write_tasks(affected_tasks)
+        
+        failures = [error for error in errors if error is not None]
+        if len(failures) > 0:
+            raise failures[0]
+        
+        return affected_tasks
             
     
 
@@ -573,6 +1470,16 @@ class Dispatcher(object):
     
 import sqlite3
 
+## Compiling tasks in several processes (see SQLiteDispatcher.load_tasks): tasks can't be pickled
+## (file interfaces hold weak references), so worker processes are forked with the tasks being
+## loaded already in place here, and are only sent their positions
+_compile_tasks = None
+_compile_dispatcher = None
+
+def _compile_task_row_at(jj):
+    return _compile_dispatcher._compiled_task_row(_compile_tasks[jj])
+
+
 class SQLiteDispatcher(Dispatcher):
     """
     Implementation of the Dispatcher abstract class using SQLite as a backend.
@@ -585,13 +1492,38 @@ class SQLiteDispatcher(Dispatcher):
     ## The clean way to remove the duplication would be multiple inheritance of
     ## an SQLite interface class...but I think multiple inheritance is kind of
     ## weird in Python2 and earlier.  We can look into it.
+    
+    ## With deduplicate_tasks, paths of other dispatch DBs whose complete tasks are reused: new
+    ## Runners identical to one of them are stored as already complete, and never run again
+    dedup_dispatch_paths = []
 
 
-    def __init__(self, db_path):
+    def __init__(self, db_path, use_wal=False, pragmas=None):
+        """Access the SQLite dispatch DB at db_path, creating it if it doesn't exist.
+        
+        use_wal and pragmas configure the connections to the dispatch DB; use_wal=True
+        switches to write-ahead-log journaling where the filesystem supports it.
+        See taxi._utility.connect_sqlite."""
         self.db_path = taxi.expand_path(db_path)
+        self.use_wal = use_wal
+        self.pragmas = pragmas
         self._setup_complete = False
         
+        self.conn = None
+        self._persistent_session = False
+        
+        # Task views and task rows, kept between calls to get_all_tasks (see _refresh_task_cache)
+        self._task_cache = {} # task id : [task view, rebuilt task (or None if not yet read), list of dependency ids]
+        self._task_cache_version = -1
+        self._task_cache_deletion = -1
+        
         self._in_context = False
+        self._in_transaction = False
+        
+        # Worker processes compiling the tasks being loaded, and where to find the tasks (see load_tasks)
+        self._compile_workers = None
+        self._compile_index = None # id(task) : position in the tasks the workers were forked with
+        self._relabeled_ids = {}
         
         with self:
             pass # Semi-kludgey creation/retrieval of dispatch DB
@@ -608,10 +1540,16 @@ class SQLiteDispatcher(Dispatcher):
         """Opens access to an existing SQLite dispatch DB specified in self.db_path.
         
         Retrieves list of imports necessary to run the tasks in the dispatch DB,
-        then calls superclass to import Task subclasses and get them in the global scope."""
+        then calls superclass to import Task subclasses and get them in the global scope.
+        Dispatch DBs written by older versions of taxi are migrated to the current table structure."""
+        self._migrate_table_structure()
+        
         ## Get imports
         imports_query = """SELECT * FROM imports"""
-        self.imports = [ii['import'] for ii in self.execute_select(imports_query)] # Extract list of imports from rows (dicts)
+        self.imports = []
+        for ii in self.execute_select(imports_query): # Extract list of imports from rows (dicts)
+            if ii['import'] not in self.imports:
+                self.imports.append(ii['import']) # Older dispatches may hold duplicate imports
         
         ## Call super to do dynamical imports
         super(SQLiteDispatcher, self)._load_existing_dispatch()
@@ -627,10 +1565,12 @@ class SQLiteDispatcher(Dispatcher):
             return
         self._in_context = True
         
+        if self.conn is not None:
+            return # Persistent session: connection is still open, setup already done
+        
         dispatch_db_exists = os.path.exists(self.db_path)
             
-        self.conn = sqlite3.connect(self.db_path, timeout=30.0) # Creates file if it doesn't exist
-        self.conn.row_factory = sqlite3.Row # Row factory for return-as-dict
+        self.conn = connect_sqlite(self.db_path, use_wal=self.use_wal, pragmas=self.pragmas) # Creates file if it doesn't exist
 
         # Only run initializers once
         if not self._setup_complete:
@@ -639,6 +1579,9 @@ class SQLiteDispatcher(Dispatcher):
                 self._load_existing_dispatch()
             else:
                 self._create_new_dispatch()
+        
+        # Policy settings may have been changed since the last connection
+        self._load_settings()
             
         ## Get/update a dictionary of all Task subclasses in the global scope, to
         ## rebuild objects from JSON payloads
@@ -649,8 +1592,61 @@ class SQLiteDispatcher(Dispatcher):
         """Context interface: connect to SQLite Dispatch DB.  If performing multiple operations,
         faster to leave a "connection" open than to open and close it repeatedly; dangerous
         to leave a connection open constantly."""
-        self.conn.close()
         self._in_context = False
+        
+        # In a persistent session, keep the connection unless something went wrong with it
+        if self._persistent_session and not (exc_type is not None and issubclass(exc_type, sqlite3.Error)):
+            return
+        
+        self.conn.close()
+        self.conn = None
+        
+        
+    def open_session(self):
+        """Persistent-session mode, for long-lived users of the dispatch like taxis: keeps
+        one connection to the dispatch DB open between contexts ("with <SQLiteDispatcher>:"),
+        so that connecting and the associated setup happen once instead of in every context.
+        
+        If an SQLite error escapes a context, the connection is dropped, and a new
+        one is opened on the next entry. Ends with close_session."""
+        self._persistent_session = True
+        
+        
+    def close_session(self):
+        """Ends persistent-session mode (see open_session), closing the connection to the dispatch DB."""
+        self._persistent_session = False
+        if self.conn is not None and not self._in_context:
+            self.conn.close()
+            self.conn = None
+            
+            
+    def store_settings(self, **settings):
+        """Stores policy settings (the Dispatcher attributes listed in dispatch_settings,
+        e.g. concurrent_tasks=True) in the dispatch DB, and applies them to this dispatcher.
+        Dispatchers read the stored settings whenever they connect to the dispatch DB, so
+        the settings apply to all taxis working on this dispatch."""
+        unknown_names = [name for name in settings.keys() if name not in dispatch_settings]
+        if len(unknown_names) > 0:
+            raise ValueError("Invalid dispatch settings {0}".format(unknown_names))
+        
+        # If we're not in context when this is called, get in context
+        if not self._in_context:
+            with self:
+                return self.store_settings(**settings)
+        
+        with self.conn:
+            self.conn.executemany("""INSERT OR REPLACE INTO dispatch_settings (name, value) VALUES (?, ?)""",
+                                  [(name, json.dumps(value)) for (name, value) in settings.items()])
+        for name, value in settings.items():
+            setattr(self, name, value)
+            
+            
+    def _load_settings(self):
+        """Applies the policy settings stored in the dispatch DB (see store_settings) to this dispatcher.
+        Settings that have never been stored are left alone."""
+        for r in self.conn.execute("""SELECT name, value FROM dispatch_settings""").fetchall():
+            if r['name'] in dispatch_settings:
+                setattr(self, r['name'], json.loads(r['value']))
 
 
     def write_table_structure(self):
@@ -673,8 +1669,25 @@ class SQLiteDispatcher(Dispatcher):
                 start_time real DEFAULT -1,
                 run_time real DEFAULT -1,
                 priority integer DEFAULT -1,
+                trunk bool DEFAULT 0,
+                cores integer,
+                binary text,
+                nodes integer,
+                memory real,
+                min_walltime real,
+                
+                payload text,
+                
+                n_unresolved integer DEFAULT 0,
+                n_failed integer DEFAULT 0,
+                version integer DEFAULT 0,
+                
+                model_key text,
+                est_time real,
+                
+                lease_expiry real,
                 
-                payload text
+                content_hash text
             )"""
             
         create_imports_str = """
@@ -682,10 +1695,189 @@ class SQLiteDispatcher(Dispatcher):
                 id integer PRIMARY KEY,
                 import text
             )"""
+        
+        # Normalized copy of depends_on: one row per (dependent, dependency) edge
+        create_deps_str = """
+            CREATE TABLE IF NOT EXISTS task_deps (
+                task_id integer REFERENCES tasks (id),
+                depends_on_id integer REFERENCES tasks (id),
+                PRIMARY KEY (task_id, depends_on_id)
+            )"""
+        create_deps_index_str = """
+            CREATE INDEX IF NOT EXISTS task_deps_depends_on_id ON task_deps (depends_on_id)"""
+        
+        # Complete tasks moved out of the tasks table (see archive_complete_tasks); their
+        # dependency edges stay in task_deps
+        create_archive_str = """
+            CREATE TABLE IF NOT EXISTS archived_tasks (
+                id integer PRIMARY KEY,
+                task_type text,
+                depends_on text,
+                status text,
+                for_taxi text,
+                by_taxi text,
+                is_recurring bool,
+                req_time integer,
+                start_time real,
+                run_time real,
+                priority integer,
+                trunk bool,
+                payload text,
+                cores integer,
+                binary text,
+                nodes integer,
+                memory real,
+                min_walltime real,
+                model_key text,
+                content_hash text,
+                
+                archive_time real
+            )"""
+        create_archive_index_str = """
+            CREATE INDEX IF NOT EXISTS archived_tasks_content_hash ON archived_tasks (content_hash)"""
+        
+        # Run telemetry, and the runtime model built from it (see enable_runtime_estimates)
+        create_runs_str = """
+            CREATE TABLE IF NOT EXISTS task_runs (
+                id integer PRIMARY KEY,
+                task_id integer REFERENCES tasks (id),
+                model_key text,
+                by_taxi text,
+                status text,
+                start_time real,
+                run_time real
+            )"""
+        create_runs_index_str = """
+            CREATE INDEX IF NOT EXISTS task_runs_model_key ON task_runs (model_key, status)"""
+        create_model_str = """
+            CREATE TABLE IF NOT EXISTS runtime_model (
+                id integer PRIMARY KEY CHECK (id = 1),
+                quantile real,
+                margin real,
+                min_runs integer
+            )"""
+        create_estimates_str = """
+            CREATE TABLE IF NOT EXISTS runtime_estimates (
+                model_key text PRIMARY KEY,
+                n_runs integer,
+                estimate real
+            )"""
+        create_settings_str = """
+            CREATE TABLE IF NOT EXISTS dispatch_settings (
+                name text PRIMARY KEY,
+                value text
+            )"""
+        
+        # Indices for the usual ways of looking up tasks: by status, by taxi, and
+        # ready-to-run tasks in priority order (covering everything _find_ready_task needs)
+        create_task_index_strs = [
+            """CREATE INDEX IF NOT EXISTS tasks_status_priority ON tasks (status, priority)""",
+            """CREATE INDEX IF NOT EXISTS tasks_for_taxi ON tasks (for_taxi)""",
+            """CREATE INDEX IF NOT EXISTS tasks_by_taxi ON tasks (by_taxi)""",
+            """CREATE INDEX IF NOT EXISTS tasks_model_key ON tasks (model_key)""",
+            """CREATE INDEX IF NOT EXISTS tasks_ready ON tasks (status, n_unresolved, priority, for_taxi, req_time)""",
+            """CREATE INDEX IF NOT EXISTS tasks_lease_expiry ON tasks (status, lease_expiry)""",
+            """CREATE UNIQUE INDEX IF NOT EXISTS tasks_content_hash ON tasks (content_hash)""",
+        ]
+        
+        # Every insert or update of a task row stamps it with a new, dispatch-wide
+        # increasing version number, so readers can pick out just the changed rows
+        create_version_index_str = """
+            CREATE INDEX IF NOT EXISTS tasks_version ON tasks (version)"""
+        create_insert_trigger_str = """
+            CREATE TRIGGER IF NOT EXISTS tasks_version_insert AFTER INSERT ON tasks
+            BEGIN
+                UPDATE tasks SET version = (SELECT MAX(version) FROM tasks) + 1 WHERE id = NEW.id;
+            END"""
+        create_update_trigger_str = """
+            CREATE TRIGGER IF NOT EXISTS tasks_version_update AFTER UPDATE ON tasks
+            WHEN NEW.version = OLD.version
+            BEGIN
+                UPDATE tasks SET version = (SELECT MAX(version) FROM tasks) + 1 WHERE id = NEW.id;
+            END"""
+        
+        # Deleted task ids are logged, so readers can drop them without rescanning the table
+        create_deletions_str = """
+            CREATE TABLE IF NOT EXISTS deleted_tasks (
+                id integer PRIMARY KEY AUTOINCREMENT,
+                task_id integer
+            )"""
+        create_delete_trigger_str = """
+            CREATE TRIGGER IF NOT EXISTS tasks_delete AFTER DELETE ON tasks
+            BEGIN
+                INSERT INTO deleted_tasks (task_id) VALUES (OLD.id);
+            END"""
 
         with self.conn:
             self.conn.execute(create_task_str)
             self.conn.execute(create_imports_str)
+            self.conn.execute(create_deps_str)
+            self.conn.execute(create_deps_index_str)
+            self.conn.execute(create_archive_str)
+            self.conn.execute(create_archive_index_str)
+            self.conn.execute(create_runs_str)
+            self.conn.execute(create_runs_index_str)
+            self.conn.execute(create_model_str)
+            self.conn.execute(create_estimates_str)
+            self.conn.execute(create_settings_str)
+            for create_task_index_str in create_task_index_strs:
+                self.conn.execute(create_task_index_str)
+            self.conn.execute(create_version_index_str)
+            self.conn.execute(create_insert_trigger_str)
+            self.conn.execute(create_update_trigger_str)
+            self.conn.execute(create_deletions_str)
+            self.conn.execute(create_delete_trigger_str)
+
+
+    def _migrate_table_structure(self):
+        """Brings a dispatch DB written by an older version of taxi up to the current
+        table structure: adds any missing columns to the tasks table and creates any
+        missing tables, then fills in the dependency edge table and the dependency
+        counters from the JSON depends_on column if they have never been populated.
+        """
+        task_columns = [row['name'] for row in self.conn.execute("""PRAGMA table_info(tasks)""").fetchall()]
+        
+        new_columns = [
+            ('n_unresolved', 'integer DEFAULT 0'),
+            ('n_failed', 'integer DEFAULT 0'),
+            ('version', 'integer DEFAULT 0'),
+            ('trunk', 'bool DEFAULT 0'),
+            ('model_key', 'text'),
+            ('est_time', 'real'),
+            ('cores', 'integer'),
+            ('binary', 'text'),
+            ('nodes', 'integer'),
+            ('memory', 'real'),
+            ('min_walltime', 'real'),
+            ('lease_expiry', 'real'),
+            ('content_hash', 'text'),
+        ]
+        if len(task_columns) == 0:
+            missing_columns = [] # No tasks table at all; created from scratch below
+        else:
+            missing_columns = [(name, decl) for (name, decl) in new_columns if name not in task_columns]
+        
+        with self.conn:
+            for name, decl in missing_columns:
+                self.conn.execute("""ALTER TABLE tasks ADD COLUMN {0} {1}""".format(name, decl))
+        
+        self.write_table_structure() # Creates any missing tables, indices, and triggers
+        
+        if 'n_unresolved' in [name for (name, decl) in missing_columns]:
+            # Dependency bookkeeping has never been done for this dispatch -- do it all now
+            with self.conn:
+                dep_rows = self.conn.execute("""SELECT id, depends_on FROM tasks WHERE depends_on IS NOT null""").fetchall()
+                self._write_dependency_edges([(r['id'], json.loads(r['depends_on'])) for r in dep_rows])
+                self._refresh_dependency_counters(None)
+        
+        if len(set(payload_columns).intersection([name for (name, decl) in missing_columns])) > 0:
+            # Some information used to live only in the payload -- copy it out
+            with self.conn:
+                payload_rows = self.conn.execute("""SELECT id, task_type, payload FROM tasks WHERE payload IS NOT null""").fetchall()
+                column_data = [self._payload_column_values(r['task_type'], json.loads(r['payload'])) + (r['id'],)
+                               for r in payload_rows]
+                payload_query = """UPDATE tasks SET {0} WHERE id=?""".format(", ".join(["{0}=?".format(c) for c in payload_columns]))
+                self.conn.executemany(payload_query, column_data)
 
 
     def execute_select(self, query, *query_args):
@@ -711,6 +1903,36 @@ class SQLiteDispatcher(Dispatcher):
         return res
 
 
+    @contextmanager
+    def _immediate_transaction(self):
+        """Context for a write transaction that takes the dispatch DB write lock as soon as
+        it begins (BEGIN IMMEDIATE), instead of at the first write.  Nothing read inside
+        the transaction can be changed by another taxi before the transaction commits.
+        Rolls back if an exception is raised inside the context."""
+        self.conn.execute("""BEGIN IMMEDIATE""")
+        self._in_transaction = True
+        try:
+            yield
+        except:
+            self.conn.rollback()
+            raise
+        finally:
+            self._in_transaction = False
+        self.conn.commit()
+
+
+    @contextmanager
+    def _write_transaction(self):
+        """Context for the writes of methods like write_tasks: commits on exit, like
+        'with self.conn', unless inside of an _immediate_transaction, in which case
+        the writes are committed (or rolled back) along with the rest of it."""
+        if self._in_transaction:
+            yield
+        else:
+            with self.conn:
+                yield
+
+
     def execute_update(self, query, *query_args):
         """Executes a write or update on the attached dispatch DB.
         
@@ -768,6 +1990,9 @@ class SQLiteDispatcher(Dispatcher):
         Raises an error if the appropriate Task subclass cannot be found in the 
         global scope.
         """
+        # Dispatcher bookkeeping isn't part of the task
+        bookkeeping = dict([(k, r.pop(k)) for k in bookkeeping_columns if r.has_key(k)])
+        
         # SQLite doesn't support arrays -- Parse dependency JSON in to list of integers
         if r.get('depends_on', None) is not None:
             r['depends_on'] = json.loads(r['depends_on'])
@@ -793,60 +2018,178 @@ class SQLiteDispatcher(Dispatcher):
             except AttributeError:
                 pass # For non-settable properties
                 
-        # Deploy payload
-        for k, v in rebuilt.__dict__.pop('payload', {}).items():
+        # Deploy payload -- properties and Files first, so stored values of plain attributes win over
+        # anything their setters derive (e.g., setting ConfigGenerator.traj or loadg sets start_traj)
+        payload = rebuilt.__dict__.pop('payload', {})
+        for k, v in sorted(payload.items(), key=lambda kv: not hasattr(task_class, kv[0])):
             try:
                 setattr(rebuilt, k, v)
             except AttributeError:
                 pass # For non-settable properties
         
+        # Claiming a task only updates the by_taxi column, so it may be newer than the payload
+        if r.get('by_taxi', None) is not None:
+            rebuilt.by_taxi = r['by_taxi']
+        
+        # Dependency resolution as of the time the task was read from the dispatch DB
+        if bookkeeping.has_key('n_unresolved') and bookkeeping.has_key('n_failed'):
+            rebuilt._dependency_counts = (bookkeeping['n_unresolved'], bookkeeping['n_failed'])
+        
+        # Estimated run time from the runtime model (see enable_runtime_estimates)
+        rebuilt._est_time = bookkeeping.get('est_time', None)
+        
         return rebuilt
             
 
-    def get_all_tasks(self, my_taxi=None, include_complete=True):
+    def get_all_tasks(self, my_taxi=None, include_complete=True, lazy=False, include_archived=False):
         """Get all incomplete tasks runnable by specified taxi (my_taxi), or all
-        tasks (if my_taxi is not provided)."""
-
-        if (my_taxi is None):
-            task_query = """
-                SELECT * FROM tasks """
-            if (not include_complete):
-                task_query += """ WHERE (status != 'complete')"""
-
-            task_res = self.execute_select(task_query)
-        else:
-            taxi_name = str(my_taxi)
-
-            task_query = """
-                SELECT * FROM tasks
-                WHERE (for_taxi=? OR for_taxi IS null)"""
-            if (not include_complete):
-                task_query += """ AND (status != 'complete')"""
+        tasks (if my_taxi is not provided).
         
-            task_res = self.execute_select(task_query, taxi_name)
+        If lazy=True, returns TaskView instances, and the payloads of the tasks
+        are never decoded; use materialize_tasks to get the full tasks when needed.
         
-
-        if len(task_res) == 0:
+        Tasks are served from a cache that is kept between calls, and only tasks
+        which have changed in the dispatch DB since the last call are read again (see
+        _refresh_task_cache). Payloads are only decoded once per change to a task; each
+        call returns copies of the cached Task instances, so changes to a returned task
+        aren't seen by other callers until stored with write_tasks.
+        
+        If include_archived=True (and include_complete=True), archived tasks are read from
+        the archive as well (see iter_archived_tasks); these are never cached."""
+        
+        # If we're not in context when this is called, get in context
+        if not self._in_context:
+            with self:
+                return self.get_all_tasks(my_taxi=my_taxi, include_complete=include_complete, lazy=lazy,
+                                          include_archived=include_archived)
+        
+        self._refresh_task_cache()
+        
+        # Filter on task views
+        taxi_name = (str(my_taxi) if my_taxi is not None else None)
+        task_ids = []
+        for task_id, (view, task, dep_ids) in self._task_cache.items():
+            if (not include_complete) and view.status == 'complete':
+                continue
+            if taxi_name is not None and view.for_taxi is not None and view.for_taxi != taxi_name:
+                continue
+            task_ids.append(task_id)
+        
+        # Package as task_id : task dict
+        if lazy:
+            res_dict = dict([(task_id, self._task_cache[task_id][0]) for task_id in task_ids])
+        else:
+            res_dict = self._rebuild_cached_tasks(task_ids)
+        
+        archived_tasks = []
+        if include_archived and include_complete:
+            archived_tasks = [task for task in self.iter_archived_tasks(lazy=lazy)
+                              if taxi_name is None or task.for_taxi is None or task.for_taxi == taxi_name]
+            res_dict.update([(task.id, task) for task in archived_tasks])
+            
+        if len(res_dict) == 0:
             return None
-
-        # Dictionaryize everything
-        task_res = map(dict, task_res)
         
-        # Objectify and package as task_id : task dict
-        res_dict = {}
-        for r in task_res:
-            res_dict[r['id']] = self.rebuild_json_task(r)    
+        self._link_dependencies(res_dict)
+        for task in archived_tasks:
+            if task.depends_on is not None:
+                task.depends_on = [(res_dict[dep_id] if res_dict.has_key(dep_id) else dep_id) for dep_id in task.depends_on]
         
+        return res_dict
+    
+    
+    def materialize_tasks(self, tasks):
+        """Returns a list of the full Task instances for the tasks in list tasks, which
+        may be Task or TaskView instances (see get_all_tasks), including archived tasks.
+        Dependencies are linked to the other returned tasks where possible, and left as
+        ids otherwise."""
+        # If we're not in context when this is called, get in context
+        if not self._in_context:
+            with self:
+                return self.materialize_tasks(tasks)
         
-        # Replace ID dependencies with object dependencies
+        self._refresh_task_cache()
+        
+        task_ids = [t.id for t in tasks if t.id in self._task_cache]
+        res_dict = self._rebuild_cached_tasks(task_ids)
+        self._link_dependencies(res_dict)
+        
+        archived_tasks = self._get_archived_tasks([t.id for t in tasks if t.id not in self._task_cache])
+        for task in archived_tasks.values():
+            if task.depends_on is not None:
+                task.depends_on = [(res_dict[dep_id] if res_dict.has_key(dep_id) else dep_id) for dep_id in task.depends_on]
+        res_dict.update(archived_tasks)
+        
+        return [res_dict[t.id] if res_dict.has_key(t.id) else t for t in tasks]
+    
+    
+    def _link_dependencies(self, res_dict):
+        """Replaces ID dependencies of the cached tasks in res_dict (a task_id : task dict)
+        with object dependencies on the other tasks in res_dict."""
         for task_id, task in res_dict.items():
-            if task.depends_on is None:
+            if not self._task_cache.has_key(task_id):
+                continue # Archived
+            dep_ids = self._task_cache[task_id][2]
+            if dep_ids is None:
                 continue
             
             # If not found in dictionary, just leave as IDs (usually don't request completes)
-            task.depends_on = [(res_dict[dep_id] if res_dict.has_key(dep_id) else dep_id) for dep_id in task.depends_on]
-        
-        return res_dict
+            task.depends_on = [(res_dict[dep_id] if res_dict.has_key(dep_id) else dep_id) for dep_id in dep_ids]
+    
+    
+    def _rebuild_cached_tasks(self, task_ids):
+        """Returns the full Task instances for the cached tasks with ids in task_ids, as a
+        task_id : task dict. Tasks are only read from the dispatch DB and rebuilt if they
+        haven't been since the task was last changed; the cached Task instances are never
+        handed out, since tasks are mutable and the caller may change them, so each call
+        returns cheap copies of them (see copy_rebuilt_task)."""
+        missing_ids = [task_id for task_id in task_ids if self._task_cache[task_id][1] is None]
+        for id_chunk in self._chunked(missing_ids):
+            task_query = """SELECT * FROM tasks WHERE id IN ({0})""".format(",".join(["?"]*len(id_chunk)))
+            for r in map(dict, self.conn.execute(task_query, id_chunk).fetchall()):
+                self._task_cache[r['id']][1] = self.rebuild_json_task(r)
+        
+        return dict([(task_id, copy_rebuilt_task(self._task_cache[task_id][1])) for task_id in task_ids])
+    
+    
+    def _refresh_task_cache(self):
+        """Brings the cache of task views up to date with the dispatch DB.
+        
+        Every write to a task row stamps it with a new version number (see
+        write_table_structure), so only rows with a version newer than the newest
+        one already in the cache need to be fetched. Deleted rows are logged in the
+        deleted_tasks table, so they can be dropped the same way. If nothing has
+        changed, this costs two indexed lookups. Must be called in context.
+        """
+        max_version = self.conn.execute("""SELECT MAX(version) FROM tasks""").fetchone()[0]
+        if max_version is None:
+            max_version = -1 # No tasks
+        max_deletion = self.conn.execute("""SELECT MAX(id) FROM deleted_tasks""").fetchone()[0]
+        if max_deletion is None:
+            max_deletion = -1 # Nothing deleted
+        
+        if max_version < self._task_cache_version or max_deletion < self._task_cache_deletion:
+            # Versions only go up, so this is not the dispatch DB we cached -- start over
+            self._task_cache = {}
+            self._task_cache_version = -1
+            self._task_cache_deletion = max_deletion
+        
+        if max_deletion > self._task_cache_deletion:
+            # Drop deleted tasks before picking up changed ones, so re-inserted tasks are kept
+            deleted_query = """SELECT id, task_id FROM deleted_tasks WHERE id > ?"""
+            for deletion_id, task_id in self.conn.execute(deleted_query, (self._task_cache_deletion,)).fetchall():
+                self._task_cache.pop(task_id, None)
+                self._task_cache_deletion = max(self._task_cache_deletion, deletion_id)
+        
+        if max_version > self._task_cache_version:
+            # Payloads of changed tasks aren't decoded until needed (see _rebuild_cached_tasks);
+            # resetting the entry drops any task rebuilt from the old version
+            changed_query = """SELECT {0} FROM tasks WHERE version > ?""".format(", ".join(view_columns))
+            changed_rows = self.conn.execute(changed_query, (self._task_cache_version,)).fetchall()
+            for r in map(dict, changed_rows):
+                view = TaskView(r)
+                self._task_cache[view.id] = [view, None, view.depends_on]
+            self._task_cache_version = max_version
 
 
     def check_task_status(self, task):
@@ -867,6 +2210,114 @@ class SQLiteDispatcher(Dispatcher):
         return dict(task_res[0])['status']
 
 
+    def _find_ready_task(self, for_taxi, fits_in=None, best_fit=False, max_cores=None):
+        """Finds the highest-priority pending task runnable by for_taxi whose dependencies
+        are all resolved, and whose resource requirements for_taxi meets (see task_fits_taxi).
+        Returns the row of the tasks table with the id and req_time of the task (or None, if
+        no such task exists).
+
+        If fits_in is specified, only considers tasks that need less time than fits_in (see
+        estimated_time).  If best_fit=True, finds the task that needs the most time instead
+        (highest priority among equals), i.e. the one that best fills fits_in.
+        If max_cores is specified, only considers tasks that need at most max_cores cores.
+        """
+        # Time needed is the runtime estimate where there is one, otherwise req_time (see estimated_time)
+        candidate_query = """
+            SELECT id, COALESCE(est_time, req_time) AS req_time FROM tasks
+            WHERE status = 'pending' AND n_unresolved = 0 AND (for_taxi=? OR for_taxi IS null)"""
+        query_args = [str(for_taxi)]
+        requirements_query, requirements_args = self._requirements_filter(for_taxi)
+        candidate_query += requirements_query
+        query_args += requirements_args
+        if fits_in is not None:
+            candidate_query += """ AND COALESCE(est_time, req_time) < ?"""
+            query_args.append(fits_in)
+        if max_cores is not None:
+            # Tasks that don't specify cores need all of the taxi's (see task_cores)
+            candidate_query += """ AND COALESCE(cores, ?) <= ?"""
+            query_args += [for_taxi.cores, max_cores]
+        # Same ordering as task_priority_sort_key: non-negative priorities first, smallest first
+        if best_fit:
+            candidate_query += """ ORDER BY COALESCE(est_time, req_time) DESC, (priority < 0), priority, id LIMIT 1"""
+        else:
+            candidate_query += """ ORDER BY (priority < 0), priority, id LIMIT 1"""
+
+        task_res = self.conn.execute(candidate_query, query_args).fetchall()
+        if len(task_res) == 0:
+            return None
+        return task_res[0]
+
+
+    def _requirements_filter(self, for_taxi):
+        """SQL condition (to append to a WHERE clause) selecting the tasks whose resource
+        requirements taxi for_taxi meets (see task_fits_taxi).  Returns a tuple
+        (condition, list of query arguments)."""
+        condition = ""
+        condition_args = []
+        for task_attr, taxi_attr in task_requirements:
+            available = getattr(for_taxi, taxi_attr, None)
+            if available is not None:
+                condition += """ AND ({0} IS null OR {0} <= ?)""".format(task_attr)
+                condition_args.append(available)
+        return condition, condition_args
+
+
+    def _get_task_by_id(self, task_id):
+        """Rebuilds the single task with id=task_id from the dispatch DB. Dependencies are
+        left in task_id format."""
+        task_res = self.conn.execute("""SELECT * FROM tasks WHERE id=?""", (task_id,)).fetchall()
+        if len(task_res) == 0:
+            return None
+        return self.rebuild_json_task(dict(task_res[0]))
+
+
+    def request_next_task(self, for_taxi, max_cores=None):
+        """Determines the next task to be executed by taxi for_taxi.  Same decisions
+        as Dispatcher.request_next_task (a Task instance to run, or Die, Respawn, or Sleep,
+        with backfilling according to backfill_policy, and only tasks that need at most
+        max_cores cores if specified), but asks SQLite for the ready candidates, instead
+        of loading and sorting the whole task forest.
+        Only the task that is returned is rebuilt from its JSON payload.
+        """
+        # If we're not in context when this is called, get in context
+        if not self._in_context:
+            with self:
+                return self.request_next_task(for_taxi, max_cores=max_cores)
+
+        time_remaining = for_taxi.time_remaining()
+
+        # Highest-priority ready task, if taxi has enough time to run it
+        top_task = self._find_ready_task(for_taxi, max_cores=max_cores)
+        if top_task is not None and top_task['req_time'] < time_remaining:
+            return self._get_task_by_id(top_task['id'])
+        
+        # Otherwise, run as much of it as fits, if it can be split
+        if top_task is not None and self.split_config_generators:
+            split_task = self._split_to_fit(self._get_task_by_id(top_task['id']), for_taxi)
+            if split_task is not None:
+                return split_task
+        
+        # Otherwise, backfill the remaining time
+        if top_task is not None:
+            fitting_task = self._find_ready_task(for_taxi, fits_in=time_remaining, max_cores=max_cores,
+                                                 best_fit=(self.backfill_policy == 'best_fit'))
+            if fitting_task is not None:
+                return self._get_task_by_id(fitting_task['id'])
+
+        # If there are no tasks, finish up
+        count_query = """SELECT COUNT(*) FROM tasks WHERE status = 'pending' AND (for_taxi=? OR for_taxi IS null)"""
+        N_pending_tasks = self.conn.execute(count_query, (str(for_taxi),)).fetchone()[0]
+        if N_pending_tasks == 0:
+            return tasks.Die(message="WORK COMPLETE: no tasks pending")
+
+        if top_task is not None:
+            # Just need more time -- tell this taxi to resubmit itself!
+            return tasks.Respawn()
+        else:
+            # Something is wrong other than not having enough time.
+            return tasks.Sleep(message="WORK COMPLETE: no tasks ready, but %d pending"%N_pending_tasks)
+
+
     def claim_task(self, my_taxi, task):
         """Attempt to claim task for a given taxi.  Fails if the status of task
         has been changed from pending."""
@@ -876,9 +2327,9 @@ class SQLiteDispatcher(Dispatcher):
             # Claim in DB -- check for race conditions
             with self.conn:
                 # Try to change status, but with condition that taxi status is pending
-                claim_query = """UPDATE tasks SET status="active", by_taxi=? WHERE id=? AND status="pending";"""
+                claim_query = """UPDATE tasks SET status="active", by_taxi=?, lease_expiry=? WHERE id=? AND status="pending";"""
                 # Affected rows == 1 if this worked correctly
-                result = self.conn.execute(claim_query, (my_taxi.name, task.id))
+                result = self.conn.execute(claim_query, (my_taxi.name, self._new_lease_expiry(), task.id))
                 claim_failed = result.rowcount != 1
                 
                 if claim_failed:
@@ -893,6 +2344,368 @@ class SQLiteDispatcher(Dispatcher):
         task.by_taxi = my_taxi.name
 
 
+    def claim_next_task(self, my_taxi, max_cores=None):
+        """Determines the next task to be executed by my_taxi and claims it for my_taxi.
+        Returns the claimed Task instance, or an instance of Die, Sleep, or Respawn.
+        
+        Selection (see request_next_task, including max_cores) and claiming happen
+        inside of a single write transaction, so no other taxi can claim the selected
+        task in between; many taxis starting at once each get a different task, instead
+        of colliding and having to start over.
+        """
+        return self._claim_next_tasks(my_taxi, max_cores=max_cores, bundle=False)[0]
+    
+    
+    def claim_next_tasks(self, my_taxi, max_cores=None):
+        """Claims a bundle of tasks for my_taxi to run back-to-back (see Dispatcher.claim_next_tasks).
+        Selection and claiming of the whole bundle happen inside of a single write transaction,
+        like in claim_next_task."""
+        return self._claim_next_tasks(my_taxi, max_cores=max_cores, bundle=(self.max_bundle_size > 1))
+    
+    
+    def _claim_next_tasks(self, my_taxi, max_cores=None, bundle=False):
+        """Implements claim_next_task (bundle=False) and claim_next_tasks (bundle=True).
+        Returns a list of tasks."""
+        # If we're not in context when this is called, get in context
+        if not self._in_context:
+            with self:
+                return self._claim_next_tasks(my_taxi, max_cores=max_cores, bundle=bundle)
+        
+        with self._immediate_transaction():
+            task = self.request_next_task(for_taxi=my_taxi, max_cores=max_cores)
+            task_bundle = [task]
+            
+            # Die/Sleep/Respawn aren't in the DB, nothing to claim
+            if getattr(task, 'id', None) is not None:
+                if bundle:
+                    task_bundle += self.request_task_bundle(my_taxi, task, max_cores=max_cores)
+                claim_query = """UPDATE tasks SET status="active", by_taxi=?, lease_expiry=? WHERE id=? AND status="pending";"""
+                lease_expiry = self._new_lease_expiry()
+                self.conn.executemany(claim_query, [(my_taxi.name, lease_expiry, t.id) for t in task_bundle])
+            
+        # Keep task objects up-to-date
+        for task in task_bundle:
+            task.status = 'active'
+            task.by_taxi = my_taxi.name
+        
+        return task_bundle
+    
+    
+    def request_task_bundle(self, for_taxi, first_task, max_cores=None):
+        """Finds ready tasks for taxi for_taxi to run back-to-back after first_task (see
+        Dispatcher.request_task_bundle), asking SQLite for the candidates, in priority order."""
+        # If we're not in context when this is called, get in context
+        if not self._in_context:
+            with self:
+                return self.request_task_bundle(for_taxi, first_task, max_cores=max_cores)
+        
+        time_left = for_taxi.time_remaining() - self.estimated_time(first_task)
+        
+        candidate_query = """
+            SELECT id, COALESCE(est_time, req_time) AS req_time FROM tasks
+            WHERE status = 'pending' AND n_unresolved = 0 AND (for_taxi=? OR for_taxi IS null)
+                AND id != ? AND task_type = ? AND binary IS ? AND COALESCE(est_time, req_time) < ?"""
+        query_args = [str(for_taxi), first_task.id, first_task.__class__.__name__, getattr(first_task, 'binary', None), time_left]
+        requirements_query, requirements_args = self._requirements_filter(for_taxi)
+        candidate_query += requirements_query
+        query_args += requirements_args
+        candidate_query += """ AND COALESCE(cores, ?) <= ?"""
+        query_args += [for_taxi.cores, self._bundle_cores(for_taxi, first_task, max_cores)]
+        candidate_query += """ ORDER BY (priority < 0), priority, id"""
+        
+        bundle_ids = []
+        for r in self.conn.execute(candidate_query, query_args):
+            if len(bundle_ids) >= self.max_bundle_size - 1:
+                break
+            if r['req_time'] < time_left:
+                time_left -= r['req_time']
+                bundle_ids.append(r['id'])
+        
+        return [self._get_task_by_id(task_id) for task_id in bundle_ids]
+    
+    
+    def finalize_task_runs(self, my_taxi, task_bundle, pool=None, queue=None):
+        """Called by my_taxi when it has completed running the tasks in task_bundle
+        (see Dispatcher.finalize_task_runs), all in one write transaction.
+        
+        Also records the runs in the task_runs table, and, if runtime estimates are enabled
+        (see enable_runtime_estimates), updates the runtime estimates for tasks like these.
+        Idle taxis are launched (if pool is provided) after the transaction is committed.
+        """
+        # If we're not in context when this is called, get in context
+        if not self._in_context:
+            with self:
+                return self.finalize_task_runs(my_taxi, task_bundle, pool=pool, queue=queue)
+        
+        with self._immediate_transaction():
+            super(SQLiteDispatcher, self).finalize_task_runs(my_taxi, task_bundle)
+            
+            for task in task_bundle:
+                run_time = getattr(task, 'run_time', None)
+                if getattr(task, 'id', None) is not None and run_time is not None and run_time > 0:
+                    self._record_task_run(my_taxi, task)
+        
+        if pool is not None:
+            self.wake_idle_taxis(my_taxi, task_bundle, pool, queue=queue)
+    
+    
+    def wait_for_ready_task(self, for_taxi, timeout, min_poll_interval=1., max_poll_interval=60.):
+        """Blocks until taxi for_taxi has something to do other than Sleep, or until timeout
+        seconds have passed (see Dispatcher.wait_for_ready_task).  Holds a connection to the
+        dispatch DB (but no locks) while waiting, to see when other connections change it."""
+        # If we're not in context when this is called, get in context
+        if not self._in_context:
+            with self:
+                return self.wait_for_ready_task(for_taxi, timeout, min_poll_interval=min_poll_interval,
+                                                max_poll_interval=max_poll_interval)
+        
+        return super(SQLiteDispatcher, self).wait_for_ready_task(for_taxi, timeout, min_poll_interval=min_poll_interval,
+                                                                 max_poll_interval=max_poll_interval)
+    
+    
+    def _change_token(self):
+        """SQLite's data_version for this connection, which changes whenever another
+        connection commits a change to the dispatch DB."""
+        return self.conn.execute("""PRAGMA data_version""").fetchone()[0]
+    
+    
+    def _has_work_for(self, for_taxi):
+        """Checks whether taxi for_taxi would be told to do something other than Sleep by
+        request_next_task (see Dispatcher._has_work_for), asking SQLite."""
+        if self._find_ready_task(for_taxi) is not None:
+            return True
+        count_query = """SELECT COUNT(*) FROM tasks WHERE status = 'pending' AND (for_taxi=? OR for_taxi IS null)"""
+        return self.conn.execute(count_query, (str(for_taxi),)).fetchone()[0] == 0
+    
+    
+    def newly_ready_tasks(self, task_bundle):
+        """Finds the pending tasks that depend on any of the (complete) tasks in task_bundle,
+        and are now ready to run (see Dispatcher.newly_ready_tasks), straight from the
+        dependency edges and counters in the dispatch DB.  Returns a list of TaskView
+        instances, highest priority first."""
+        # If we're not in context when this is called, get in context
+        if not self._in_context:
+            with self:
+                return self.newly_ready_tasks(task_bundle)
+        
+        finished_ids = [task.id for task in task_bundle
+                        if getattr(task, 'id', None) is not None and task.status == 'complete']
+        
+        ready_tasks = []
+        for id_chunk in self._chunked(finished_ids):
+            ready_query = """
+                SELECT {0} FROM tasks WHERE status = 'pending' AND n_unresolved = 0
+                AND id IN (SELECT task_id FROM task_deps WHERE depends_on_id IN ({1}))"""\
+                .format(", ".join(view_columns), ",".join(["?"]*len(id_chunk)))
+            ready_tasks += [TaskView(dict(r)) for r in self.conn.execute(ready_query, id_chunk).fetchall()]
+        
+        # Tasks may depend on more than one of the finished tasks
+        ready_tasks = dict([(task.id, task) for task in ready_tasks]).values()
+        return sorted(ready_tasks, key=task_priority_sort_key)
+    
+    
+    def _record_task_run(self, my_taxi, task):
+        """Stores the run time of task, just run by my_taxi, in the task_runs table, and
+        updates the runtime estimate for (and of all pending tasks like) task."""
+        key = runtime_model.model_key(task.__class__.__name__, task.compiled().get('payload', {}))
+        with self._write_transaction():
+            self.conn.execute("""INSERT INTO task_runs (task_id, model_key, by_taxi, status, start_time, run_time)
+                VALUES (?, ?, ?, ?, ?, ?)""",
+                (task.id, key, str(my_taxi), task.status, getattr(task, 'start_time', None), task.run_time))
+            if task.status == 'complete' or task.is_recurring:
+                self._update_runtime_estimates([key])
+    
+    
+    def _runtime_model_settings(self):
+        """Returns the settings row of the runtime model, or None if runtime estimates are not enabled."""
+        settings = self.conn.execute("""SELECT quantile, margin, min_runs FROM runtime_model WHERE id = 1""").fetchall()
+        return settings[0] if len(settings) > 0 else None
+    
+    
+    def _runtime_estimates(self, model_keys):
+        """Looks up the current runtime estimates for the model keys in model_keys.
+        Returns a dict like {model_key : estimate}; keys without an estimate are left out."""
+        estimates = {}
+        for key_chunk in self._chunked(list(model_keys)):
+            estimate_query = """SELECT model_key, estimate FROM runtime_estimates WHERE model_key IN ({0})"""\
+                .format(", ".join(["?"]*len(key_chunk)))
+            for r in self.conn.execute(estimate_query, key_chunk).fetchall():
+                estimates[r['model_key']] = r['estimate']
+        return estimates
+    
+    
+    def _update_runtime_estimates(self, model_keys, max_runs=100):
+        """Recomputes the runtime estimates for the model keys in model_keys from the run times
+        of the last max_runs successful runs of each, and stores them on the pending tasks with
+        those keys.  Does nothing if runtime estimates are not enabled."""
+        settings = self._runtime_model_settings()
+        if settings is None:
+            return
+        
+        runs_query = """SELECT run_time FROM task_runs WHERE model_key = ? AND status != 'failed'
+            ORDER BY id DESC LIMIT ?"""
+        for key in model_keys:
+            run_times = [r['run_time'] for r in self.conn.execute(runs_query, (key, max_runs)).fetchall()]
+            estimate = runtime_model.conservative_estimate(run_times,
+                q=settings['quantile'], margin=settings['margin'], min_runs=settings['min_runs'])
+            if estimate is None:
+                continue
+            self.conn.execute("""INSERT OR REPLACE INTO runtime_estimates (model_key, n_runs, estimate) VALUES (?, ?, ?)""",
+                              (key, len(run_times), estimate))
+            self.conn.execute("""UPDATE tasks SET est_time = ? WHERE model_key = ? AND status = 'pending'""",
+                              (estimate, key))
+    
+    
+    def enable_runtime_estimates(self, quantile=0.95, margin=1.2, min_runs=3):
+        """Starts using a model of task run times learned from previous runs (see taxi.runtime_model)
+        instead of req_time to decide whether a taxi has enough time left to run a task.
+        
+        Tasks are estimated to need the quantile-quantile of the recorded run times of
+        similar tasks, padded by a factor of margin; tasks similar to fewer than min_runs
+        recorded runs keep using req_time.  The settings are stored in the dispatch DB,
+        so apply to all taxis working on this dispatch.
+        """
+        # If we're not in context when this is called, get in context
+        if not self._in_context:
+            with self:
+                return self.enable_runtime_estimates(quantile=quantile, margin=margin, min_runs=min_runs)
+        
+        assert 0 < quantile <= 1, "quantile must be in (0, 1]"
+        with self.conn:
+            self.conn.execute("""INSERT OR REPLACE INTO runtime_model (id, quantile, margin, min_runs) VALUES (1, ?, ?, ?)""",
+                              (quantile, margin, min_runs))
+            self.conn.execute("""DELETE FROM runtime_estimates""")
+            self.conn.execute("""UPDATE tasks SET est_time = null""")
+            model_keys = [r['model_key'] for r in self.conn.execute("""SELECT DISTINCT model_key FROM task_runs""").fetchall()]
+            self._update_runtime_estimates(model_keys)
+    
+    
+    def disable_runtime_estimates(self):
+        """Goes back to using req_time to decide whether a taxi has enough time left to run
+        a task.  Recorded runs are kept, so estimates can be re-enabled later."""
+        # If we're not in context when this is called, get in context
+        if not self._in_context:
+            with self:
+                return self.disable_runtime_estimates()
+        
+        with self.conn:
+            self.conn.execute("""DELETE FROM runtime_model""")
+            self.conn.execute("""DELETE FROM runtime_estimates""")
+            self.conn.execute("""UPDATE tasks SET est_time = null""")
+    
+    
+    def estimated_time(self, task):
+        """Time in seconds that task is expected to need to run: the estimate from the
+        runtime model when there is one (see enable_runtime_estimates), otherwise req_time."""
+        est_time = getattr(task, '_est_time', None)
+        if est_time is not None:
+            return est_time
+        return task.req_time
+    
+    
+    def mark_abandoned_task(self, by_taxi):
+        """Method to handle the case when a Taxi has died unexpectedly.  When this occurs, it often means
+        a task is left marked 'active', but has in fact failed(/been abandoned).  This method marks that task
+        abandoned.
+        
+        A taxi running several tasks at once (see concurrent_tasks) leaves all of them
+        active, so every task still active for by_taxi is marked abandoned.  Looks them up
+        using the by_taxi index, without loading the rest of the dispatch, and marks them
+        in one transaction, so none that finish (or get reclaimed) meanwhile are overwritten.
+        """
+        by_taxi = str(by_taxi)
+        assert by_taxi is not None # This should never happen, but would be catastrophically inconvenient if it did.
+        
+        # If we're not in context when this is called, get in context
+        if not self._in_context:
+            with self:
+                return self.mark_abandoned_task(by_taxi)
+        
+        abandoned_query = """SELECT id FROM tasks WHERE by_taxi=? AND status='active'"""
+        with self._immediate_transaction():
+            abandoned_tasks = [self._get_task_by_id(r['id']) for r in self.conn.execute(abandoned_query, (by_taxi,)).fetchall()]
+            
+            for task in abandoned_tasks:
+                task.status = 'abandoned'
+                print "WARNING: Task {tid} was abandoned by taxi {tn}.".format(tid=task.id, tn=by_taxi)
+            
+            self.write_tasks(abandoned_tasks)
+
+
+    def _new_lease_expiry(self):
+        """Expiry time of a lease taken or renewed now (see lease_time); None if leases are off."""
+        if self.lease_time is None:
+            return None
+        return time.time() + self.lease_time
+
+
+    @contextmanager
+    def lease_heartbeat(self, my_taxi, task_bundle):
+        """Context (e.g., for my_taxi to run the tasks in task_bundle in) in which a background
+        thread renews my_taxi's leases on the tasks in task_bundle every lease_time/3 seconds.
+        Does nothing if leases are off (lease_time is None)."""
+        task_ids = [task.id for task in task_bundle if getattr(task, 'id', None) is not None]
+        if self.lease_time is None or len(task_ids) == 0:
+            yield
+            return
+        
+        stop_event = threading.Event()
+        heartbeat = threading.Thread(target=self._renew_leases_until, args=(my_taxi, task_ids, stop_event))
+        heartbeat.daemon = True # Don't keep a dying taxi alive
+        heartbeat.start()
+        try:
+            yield
+        finally:
+            stop_event.set()
+            heartbeat.join()
+
+
+    def _renew_leases_until(self, my_taxi, task_ids, stop_event):
+        """Heartbeat (see lease_heartbeat): renews my_taxi's leases on the (still active) tasks with
+        ids in task_ids every lease_time/3 seconds, until stop_event is set.  Runs in its own
+        thread, so uses its own connection to the dispatch DB."""
+        conn = connect_sqlite(self.db_path, use_wal=self.use_wal, pragmas=self.pragmas)
+        renew_query = """UPDATE tasks SET lease_expiry=? WHERE id IN ({0}) AND status='active' AND by_taxi=?"""\
+            .format(",".join(["?"]*len(task_ids)))
+        try:
+            while not stop_event.wait(self.lease_time / 3.):
+                try:
+                    with conn:
+                        conn.execute(renew_query, [self._new_lease_expiry()] + task_ids + [my_taxi.name])
+                except sqlite3.Error, e:
+                    print "WARNING: Failed to renew leases on tasks {0}: {1}".format(task_ids, e) # Try again next beat
+        finally:
+            conn.close()
+
+
+    def reclaim_expired_leases(self):
+        """Marks abandoned all active tasks whose leases have expired (see Dispatcher.reclaim_expired_leases),
+        looking them up with the lease expiry index, whatever the size of the dispatch.  Returns the list
+        of the ids of the abandoned tasks."""
+        # If we're not in context when this is called, get in context
+        if not self._in_context:
+            with self:
+                return self.reclaim_expired_leases()
+        
+        now = time.time()
+        expired_query = """SELECT id, by_taxi FROM tasks WHERE status='active' AND lease_expiry < ?"""
+        
+        # Taxis call this every loop, and leases rarely expire: only take the write lock if any have
+        if len(self.conn.execute(expired_query + """ LIMIT 1""", (now,)).fetchall()) == 0:
+            return []
+        
+        with self._immediate_transaction():
+            # Look again: leases may have been renewed (or reclaimed by another taxi) in the meantime
+            expired_tasks = self.conn.execute(expired_query, (now,)).fetchall()
+            if len(expired_tasks) > 0:
+                # Abandoned tasks hold up their dependents just like active ones, so no dependency counters change
+                self.conn.execute("""UPDATE tasks SET status='abandoned' WHERE status='active' AND lease_expiry < ?""", (now,))
+        
+        for r in expired_tasks:
+            print "WARNING: Task {tid} was abandoned by taxi {tn} (lease expired).".format(tid=r['id'], tn=r['by_taxi'])
+        return [r['id'] for r in expired_tasks]
+
+
     def write_tasks(self, tasks_to_write):
         """Stores (i.e., adds or updates) the Task instances specified in tasks
         to the tasks table of the dispatch DB specified in self.db_path. Calls
@@ -900,50 +2713,563 @@ class SQLiteDispatcher(Dispatcher):
         will fit in to the dispatch DB (i.e., non-common attributes stored in a
         'payload' dict attribute).
         
+        The dependency edges of the written tasks and the unresolved/failed
+        dependency counters of the written tasks and their dependents are updated
+        in the same transaction.  Archived tasks that are written (e.g., by rollback)
+        are moved back in to the tasks table, in the same transaction.
+        
         Args:
             tasks - A list of Task subclasses to be written to the DB (or a single task).
         """
         if isinstance(tasks_to_write, tasks.Task):
             tasks_to_write = [tasks_to_write]
         
-        task_query = """INSERT OR REPLACE INTO tasks
-        (id, task_type, depends_on, status, for_taxi, is_recurring, req_time, priority, payload)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"""
-
+        # If we're not in context when this is called, get in context
+        if not self._in_context:
+            with self:
+                self.write_tasks(tasks_to_write)
+            return
+        
         # JSON serialize all tasks
-        compiled_tasks = [task.compiled() for task in tasks_to_write]
-        
-        # Build list to insert
-        upsert_data = []
-        for compiled_task in compiled_tasks:
-            task_values = (
-                compiled_task['id'],
-                compiled_task['task_type'], 
-                json.dumps(compiled_task['depends_on'], cls=LocalEncoder),
-                compiled_task['status'], 
-                compiled_task['for_taxi'] if compiled_task.has_key('for_taxi') else None, 
-                compiled_task['is_recurring'],
-                compiled_task['req_time'], 
-                compiled_task['priority'],
-                json.dumps(compiled_task['payload'], cls=LocalEncoder) if compiled_task.has_key('payload') else None,
-            )
-            upsert_data.append(task_values)
-        
-        self.execute_update(task_query, *upsert_data)
+        duplicate_ids = self._write_compiled_tasks([self._compiled_task_row(task) for task in tasks_to_write])
+        self._relabel_duplicate_tasks(tasks_to_write, duplicate_ids)
+    
+    
+    def _compiled_task_row(self, task):
+        """Compiles task (see Task.compiled) in to the values to store in its row of the
+        tasks table.  Returns a tuple like (task id (or None), tuple of column values, list
+        of dependency ids (or None), content hash (or None)), to be written by _write_compiled_tasks.
+        
+        Only Runners get content hashes, and only if self.deduplicate_tasks is set."""
+        compiled_task = task.compiled()
+        payload = compiled_task.get('payload', {})
+        task_values = (
+            compiled_task['task_type'], 
+            json.dumps(compiled_task['depends_on'], cls=LocalEncoder),
+            compiled_task['status'], 
+            compiled_task['for_taxi'] if compiled_task.has_key('for_taxi') else None, 
+            compiled_task['is_recurring'],
+            compiled_task['req_time'], 
+            compiled_task['priority'],
+            json.dumps(compiled_task['payload'], cls=LocalEncoder) if compiled_task.has_key('payload') else None,
+        ) + self._payload_column_values(compiled_task['task_type'], payload) # Also see TaskView
+        content_hash = task_content_hash(compiled_task) if self.deduplicate_tasks and isinstance(task, tasks.Runner) else None
+        return (compiled_task.get('id', None), task_values, compiled_task['depends_on'], content_hash)
+    
+    
+    def _write_compiled_tasks(self, task_rows, relabeled_ids=None):
+        """Adds or updates the tasks compiled in to task_rows (see _compiled_task_row) in the
+        tasks table, along with their dependency edges and counters (see write_tasks).
+        Dependencies on ids in the dict relabeled_ids, like {old id : new id}, are
+        redirected to the new ids.
+        
+        New tasks with the same content hash as a pending or complete stored task, or as an
+        earlier task in task_rows, aren't stored; dependencies on them are redirected to that
+        task.  New tasks with the same content hash as a task that is complete in one of the
+        dispatch DBs in dedup_dispatch_paths are stored as complete.  Content hashes are only
+        stored with new tasks: the content of a stored task doesn't change, but writing it back
+        after running it (e.g., by a taxi that doesn't deduplicate tasks) shouldn't lose its hash.
+        
+        Returns a dict like {id : id of stored task} of the tasks that weren't stored."""
+        task_columns = ['task_type', 'depends_on', 'status', 'for_taxi', 'is_recurring', 'req_time', 'priority', 'payload']\
+                        + payload_columns + ['est_time']
+        model_key_index = task_columns.index('model_key') # Position of the model key in the compiled values
+        insert_query = """INSERT INTO tasks (id, {0}, content_hash) VALUES (?, {1}, ?)"""\
+            .format(", ".join(task_columns), ", ".join(["?"]*len(task_columns)))
+        update_query = """UPDATE tasks SET {0} WHERE id=?"""\
+            .format(", ".join(["{0}=?".format(c) for c in task_columns]))
+        
+        try:
+            with self._write_transaction():
+                # Current run time estimates for the written tasks
+                estimates = self._runtime_estimates(set([row[1][model_key_index] for row in task_rows]))
+                
+                existing_ids = self._existing_task_ids([row[0] for row in task_rows if row[0] is not None])
+                
+                # Archived tasks being written back (e.g., rolled back) are moved back in to the tasks table first
+                archived_ids = self._existing_task_ids([row[0] for row in task_rows if row[0] is not None and row[0] not in existing_ids],
+                                                       table='archived_tasks')
+                if len(archived_ids) > 0:
+                    self._move_from_archive(archived_ids)
+                    existing_ids.update(archived_ids)
+                
+                # Identical tasks (see deduplicate_tasks)
+                duplicate_rows = self._find_duplicate_tasks(task_rows, existing_ids)
+                duplicate_ids = dict([(task_rows[jj][0], stored_id) for (jj, stored_id) in duplicate_rows.items()
+                                      if task_rows[jj][0] is not None and stored_id is not None])
+                dependency_ids = dict(relabeled_ids or {})
+                dependency_ids.update(duplicate_ids)
+                completed_elsewhere = self._completed_elsewhere([row[3] for (jj, row) in enumerate(task_rows)
+                                                                 if row[3] is not None and row[0] not in existing_ids
+                                                                 and not duplicate_rows.has_key(jj)])
+                
+                insert_data = []
+                update_data = []
+                unnumbered_data = []
+                written_deps = [] # Like [(task id, list of dependency ids)]
+                for jj, (task_id, values, depends_on, content_hash) in enumerate(task_rows):
+                    if duplicate_rows.has_key(jj):
+                        continue
+                    if content_hash in completed_elsewhere:
+                        values = values[:2] + ('complete',) + values[3:]
+                    if depends_on is not None and any([dependency_ids.has_key(d) for d in depends_on]):
+                        depends_on = [dependency_ids.get(d, d) for d in depends_on]
+                        values = (values[0], json.dumps(depends_on, cls=LocalEncoder)) + values[2:]
+                    values = values + (estimates.get(values[model_key_index], None),)
+                    if task_id is None:
+                        unnumbered_data.append((values + (content_hash,), depends_on))
+                        continue
+                    if task_id in existing_ids:
+                        update_data.append(values + (task_id,))
+                    else:
+                        insert_data.append((task_id,) + values + (content_hash,))
+                    written_deps.append((task_id, depends_on))
+                
+                # Failed (or abandoned, or active) tasks don't count as duplicates: new tasks like them take over their hashes
+                self._release_content_hashes([row[3] for (jj, row) in enumerate(task_rows) if row[3] is not None
+                                              and row[0] not in existing_ids and not duplicate_rows.has_key(jj)])
+                self.conn.executemany(insert_query, insert_data)
+                self.conn.executemany(update_query, update_data)
+                for values, depends_on in unnumbered_data:
+                    task_id = self._get_max_task_id() + 1 # Tasks without an id get one here (not an archived task's)
+                    self.conn.execute(insert_query, (task_id,) + values)
+                    written_deps.append((task_id, depends_on))
+                
+                # Keep dependency bookkeeping up to date
+                self._write_dependency_edges(written_deps)
+                self._refresh_dependency_counters([task_id for (task_id, depends_on) in written_deps])
+        except:
+            print "Failed to write tasks: "
+            print [row[0] for row in task_rows]
+            raise
+        
+        if len(duplicate_rows) > 0:
+            print "Skipped {0} task(s) identical to stored tasks".format(len(duplicate_rows))
+        if len(completed_elsewhere) > 0:
+            print "Stored {0} task(s) as complete, already run in other dispatches".format(len(completed_elsewhere))
+        return duplicate_ids
+    
+    
+    def _find_duplicate_tasks(self, task_rows, existing_ids):
+        """Finds the new tasks (with ids not in existing_ids) among task_rows (see _compiled_task_row)
+        with the same content hash as a pending or complete stored (or archived) task, or as an earlier
+        new task in task_rows.  Returns a dict like {index in task_rows : id of the identical task (None
+        if it has no id yet)}."""
+        new_rows = [(jj, row) for (jj, row) in enumerate(task_rows) if row[3] is not None and row[0] not in existing_ids]
+        
+        ids_by_hash = {}
+        for hash_chunk in self._chunked(set([row[3] for (jj, row) in new_rows])):
+            for table in ['archived_tasks', 'tasks']:
+                hash_query = """SELECT id, content_hash FROM {0} WHERE status IN ('pending', 'complete') AND content_hash IN ({1})"""\
+                    .format(table, ",".join(["?"]*len(hash_chunk)))
+                ids_by_hash.update([(r['content_hash'], r['id']) for r in self.conn.execute(hash_query, hash_chunk).fetchall()])
+        
+        duplicate_rows = {}
+        for jj, (task_id, values, depends_on, content_hash) in new_rows:
+            if ids_by_hash.has_key(content_hash):
+                duplicate_rows[jj] = ids_by_hash[content_hash]
+            else:
+                ids_by_hash[content_hash] = task_id
+        return duplicate_rows
+    
+    
+    def _release_content_hashes(self, content_hashes):
+        """Clears the content hashes in content_hashes from the stored tasks that hold them, so that
+        new tasks with those hashes can be stored (see _write_compiled_tasks).  Must be called inside
+        of a transaction."""
+        for hash_chunk in self._chunked(set(content_hashes)):
+            self.conn.execute("""UPDATE tasks SET content_hash = null WHERE content_hash IN ({0})"""
+                              .format(",".join(["?"]*len(hash_chunk))), hash_chunk)
+    
+    
+    def _completed_elsewhere(self, content_hashes):
+        """Returns the set of the content_hashes of tasks that are complete in the dispatch DBs
+        listed in dedup_dispatch_paths, including their archived tasks."""
+        completed = set([])
+        if len(content_hashes) == 0:
+            return completed
+        
+        for dispatch_path in self.dedup_dispatch_paths:
+            if not os.path.exists(dispatch_path):
+                print "WARNING: Can't find dispatch {0} to reuse completed tasks from".format(dispatch_path)
+                continue
+            other_conn = connect_sqlite(dispatch_path)
+            try:
+                # Dispatches written by older versions of taxi have no archive
+                tables = ['tasks']
+                if other_conn.execute("""SELECT name FROM sqlite_master WHERE type='table' AND name='archived_tasks'""").fetchone() is not None:
+                    tables.append('archived_tasks')
+                for hash_chunk in self._chunked(set(content_hashes)):
+                    for table in tables:
+                        hash_query = """SELECT content_hash FROM {0} WHERE status='complete' AND content_hash IN ({1})"""\
+                            .format(table, ",".join(["?"]*len(hash_chunk)))
+                        completed.update([r['content_hash'] for r in other_conn.execute(hash_query, hash_chunk).fetchall()])
+            except sqlite3.OperationalError:
+                print "WARNING: Dispatch {0} has no content hashes to reuse completed tasks by".format(dispatch_path)
+            finally:
+                other_conn.close()
+        return completed
+    
+    
+    def _relabel_duplicate_tasks(self, task_list, duplicate_ids):
+        """Gives the tasks in task_list that weren't stored because they were identical
+        to stored tasks (see _write_compiled_tasks) the ids of the stored tasks, so that
+        tasks compiled later depend on the stored tasks instead."""
+        if len(duplicate_ids) == 0:
+            return
+        for task in task_list:
+            if duplicate_ids.has_key(getattr(task, 'id', None)):
+                task.id = duplicate_ids[task.id]
+    
+    
+    def load_tasks(self, task_stream, chunk_size=2000, n_processes=None, report_progress=True):
+        """Bulk version of write_tasks: stores the tasks from the iterable task_stream
+        chunk_size tasks at a time, all in one transaction (see Dispatcher.load_tasks).
+        
+        If n_processes > 1 and task_stream is a list, the tasks are compiled by a pool of
+        that many processes, forked once before the transaction begins.  Tasks from other
+        iterables (e.g., generators) are compiled by this process: tasks can't be sent to
+        the workers, so they must already exist when the workers are forked."""
+        global _compile_tasks, _compile_dispatcher
+        
+        # If we're not in context when this is called, get in context
+        if not self._in_context:
+            with self:
+                return self.load_tasks(task_stream, chunk_size=chunk_size, n_processes=n_processes,
+                                       report_progress=report_progress)
+        
+        if n_processes is not None and n_processes > 1 and isinstance(task_stream, (list, tuple)) and len(task_stream) > 1:
+            _compile_tasks, _compile_dispatcher = task_stream, self
+            self._compile_index = dict([(id(task), jj) for (jj, task) in enumerate(task_stream)])
+            self._compile_workers = multiprocessing.Pool(min(n_processes, len(task_stream)))
+        self._relabeled_ids = {}
+        
+        try:
+            with self._immediate_transaction():
+                return super(SQLiteDispatcher, self).load_tasks(task_stream, chunk_size=chunk_size, n_processes=n_processes,
+                                                                report_progress=report_progress)
+        finally:
+            if self._compile_workers is not None:
+                self._compile_workers.close()
+                self._compile_workers.join()
+            self._compile_workers, self._compile_index, self._relabeled_ids = None, None, {}
+            _compile_tasks, _compile_dispatcher = None, None
+    
+    
+    def _load_task_chunk(self, task_chunk, n_processes=None):
+        if self._compile_workers is None:
+            task_rows = [self._compiled_task_row(task) for task in task_chunk]
+        else:
+            # Workers only send back the compiled rows
+            task_rows = self._compile_workers.map(_compile_task_row_at, [self._compile_index[id(task)] for task in task_chunk],
+                                                  chunksize=max(len(task_chunk) // (4*n_processes), 1))
+        
+        # Workers see the tasks as they were when forked, so may still use the old ids of tasks
+        # relabeled since (see _relabel_duplicate_tasks); those are redirected when written
+        duplicate_ids = self._write_compiled_tasks(task_rows, relabeled_ids=self._relabeled_ids)
+        self._relabel_duplicate_tasks(task_chunk, duplicate_ids)
+        self._relabeled_ids.update(duplicate_ids)
+    
+    
+    def _payload_column_values(self, task_type, payload):
+        """Values for the columns of the tasks table that hold copies of information from
+        the payload of a task (see payload_columns), given the task_type and the payload
+        dict of the compiled task.  Returns a tuple, in the order of payload_columns."""
+        return (
+            payload.get('by_taxi', None),
+            bool(payload.get('trunk', False)),
+            payload.get('start_time', -1),
+            payload.get('run_time', -1),
+            runtime_model.model_key(task_type, payload),
+            payload.get('cores', None),
+            payload.get('binary', None),
+            payload.get('nodes', None),
+            payload.get('memory', None),
+            payload.get('min_walltime', None),
+        )
+    
+    
+    def _chunked(self, ids, chunk_size=500):
+        """Splits ids in to chunks small enough to bind as parameters of a single
+        query, staying well below SQLite's limit on the number of bound parameters."""
+        ids = list(ids)
+        return [ids[ii:ii+chunk_size] for ii in range(0, len(ids), chunk_size)]
+    
+    
+    def _existing_task_ids(self, task_ids, table='tasks'):
+        """Returns the set of ids among task_ids that are already present in the tasks table
+        (or in the table named table)."""
+        existing_ids = set([])
+        for id_chunk in self._chunked(task_ids):
+            id_query = """SELECT id FROM {0} WHERE id IN ({1})""".format(table, ",".join(["?"]*len(id_chunk)))
+            existing_ids.update([r['id'] for r in self.conn.execute(id_query, id_chunk).fetchall()])
+        return existing_ids
+    
+    
+    def _write_dependency_edges(self, task_dependencies):
+        """Replaces the edges in the task_deps table for the specified tasks. Must be called
+        inside of a transaction.
+        
+        Args:
+            task_dependencies - List of tuples like (task id, list of dependency ids (or None)).
+        """
+        for dep_chunk in self._chunked(task_dependencies):
+            delete_query = """DELETE FROM task_deps WHERE task_id IN ({0})""".format(",".join(["?"]*len(dep_chunk)))
+            self.conn.execute(delete_query, [task_id for (task_id, depends_on) in dep_chunk])
+        
+        edge_data = []
+        for task_id, depends_on in task_dependencies:
+            if depends_on is None:
+                continue
+            edge_data += [(task_id, dep_id) for dep_id in depends_on]
+        self.conn.executemany("""INSERT OR IGNORE INTO task_deps (task_id, depends_on_id) VALUES (?, ?)""", edge_data)
+        
+        
+    def _refresh_dependency_counters(self, task_ids):
+        """Recomputes the unresolved/failed dependency counters for the tasks with ids in task_ids,
+        and for all tasks which directly depend on them. If task_ids is None, recomputes counters
+        for all tasks. Must be called inside of a transaction.
+        
+        As with Task.count_unresolved_dependencies, dependencies that are not present in the
+        dispatch are considered to be resolved.
+        """
+        refresh_query = """
+            UPDATE tasks SET
+            n_unresolved = (SELECT COUNT(*) FROM task_deps JOIN tasks AS dep ON dep.id = task_deps.depends_on_id
+                            WHERE task_deps.task_id = tasks.id AND dep.status != 'complete'),
+            n_failed = (SELECT COUNT(*) FROM task_deps JOIN tasks AS dep ON dep.id = task_deps.depends_on_id
+                        WHERE task_deps.task_id = tasks.id AND dep.status = 'failed')"""
+        
+        if task_ids is None:
+            self.conn.execute(refresh_query)
+            return
+            
+        for id_chunk in self._chunked(task_ids):
+            id_list = ",".join(["?"]*len(id_chunk))
+            chunk_query = refresh_query + """
+                WHERE id IN ({0}) OR id IN (SELECT task_id FROM task_deps WHERE depends_on_id IN ({0}))""".format(id_list)
+            self.conn.execute(chunk_query, id_chunk + id_chunk)
+    
+    
+    def count_unresolved_dependencies(self, task):
+        """Counts up the number of dependencies of task that are not complete, and the
+        number that are failed.  Returns tuple (n_unresolved, n_failed).
+        
+        Uses the dependency counters stored in the dispatch DB when the task was read,
+        so doesn't need the dependencies of task to be loaded."""
+        if hasattr(task, '_dependency_counts'):
+            return task._dependency_counts
+        return super(SQLiteDispatcher, self).count_unresolved_dependencies(task)
+    
+    
+    def _count_trunks_and_ready_tasks(self):
+        """Counts the trunks available to work on and the ready tasks, bucketed by the taxi
+        the tasks are for (see Dispatcher._count_trunks_and_ready_tasks).
+        
+        Counted directly from the dependency counters in the dispatch DB, in one query.
+        """
+        count_query = """
+            SELECT for_taxi,
+                SUM(trunk AND (status = 'active' OR n_unresolved = 0)) AS n_trunks,
+                SUM(status = 'pending' AND n_unresolved = 0) AS n_ready
+            FROM tasks WHERE status IN ('active', 'pending')
+            GROUP BY for_taxi"""
+        trunk_counts = {}
+        ready_counts = {}
+        for r in self.execute_select(count_query):
+            if r['n_trunks']:
+                trunk_counts[r['for_taxi']] = r['n_trunks']
+            if r['n_ready']:
+                ready_counts[r['for_taxi']] = r['n_ready']
+        return trunk_counts, ready_counts
+    
+    
+    def _N_ready_tasks(self, task_blob, for_taxi=None):
+        """Counts how many tasks are ready that can only be run by the taxi specified
+        in for_taxi (or, if for_taxi is not specified, how many tasks are ready in total).
+        
+        Counted directly from the dependency counters in the dispatch DB; task_blob is ignored.
+        """
+        ready_query = """SELECT COUNT(*) FROM tasks WHERE status = 'pending' AND n_unresolved = 0"""
+        if for_taxi is None:
+            return self.execute_select(ready_query)[0][0]
+        ready_query += """ AND for_taxi = ?"""
+        return self.execute_select(ready_query, str(for_taxi))[0][0]
             
         
     def _get_max_task_id(self):
-        task_id_query = """SELECT id FROM tasks ORDER BY id DESC LIMIT 1;"""
-        max_id_query = map(dict, self.execute_select(task_id_query))
-
-        if len(max_id_query) == 0:
+        # If we're not in context when this is called, get in context
+        if not self._in_context:
+            with self:
+                return self._get_max_task_id()
+        
+        # Archived tasks keep their ids (and dependents may still refer to them), so ids aren't reused.
+        # Read straight from the connection: this may be called inside of a transaction (see load_tasks)
+        task_id_query = """SELECT MAX(id) FROM (SELECT MAX(id) AS id FROM tasks UNION ALL SELECT MAX(id) AS id FROM archived_tasks)"""
+        max_id = self.conn.execute(task_id_query).fetchone()[0]
+        
+        if max_id is None:
             return 0
         else:
-            return max_id_query[0]['id']
+            return max_id
         
         
     def _store_imports(self):
-        import_query = """INSERT OR REPLACE INTO imports (import) VALUES (?)"""
-        upsert_data = [(ii,) for ii in self.imports]
-        self.execute_update(import_query, *upsert_data)
+        # Imports already stored (e.g., when extending a dispatch) aren't stored twice
+        import_query = """INSERT INTO imports (import) SELECT ? WHERE NOT EXISTS (SELECT 1 FROM imports WHERE import=?)"""
+        insert_data = [(ii, ii) for ii in self.imports]
+        self.execute_update(import_query, *insert_data)
+    
+    
+    def _get_task_views(self, task_ids):
+        """Same as Dispatcher._get_task_views, but looks the tasks up by id, in the archive
+        too (e.g., the last finished configuration of a stream, when extending it)."""
+        # If we're not in context when this is called, get in context
+        if not self._in_context:
+            with self:
+                return self._get_task_views(task_ids)
+        
+        task_views = {}
+        for id_chunk in self._chunked(task_ids):
+            view_query = """SELECT {0} FROM tasks WHERE id IN ({1})""".format(", ".join(view_columns), ",".join(["?"]*len(id_chunk)))
+            for r in self.conn.execute(view_query, id_chunk).fetchall():
+                task_views[r['id']] = TaskView(dict(r))
+        task_views.update(self._get_archived_tasks([task_id for task_id in task_ids if not task_views.has_key(task_id)], lazy=True))
+        return task_views
+    
+    
+    def _stored_priority_levels(self):
+        levels_query = """SELECT trunk, MAX(priority) AS priority FROM
+            (SELECT trunk, priority FROM tasks UNION ALL SELECT trunk, priority FROM archived_tasks)
+            WHERE priority >= 0 GROUP BY trunk"""
+        return dict([(bool(r['trunk']), r['priority']) for r in self.execute_select(levels_query)])
+    
+    
+    ## Archival
+    def archive_complete_tasks(self):
+        """Moves complete tasks which nothing unfinished depends on from the tasks table to the
+        archived_tasks table, so that the tasks table (and so get_all_tasks) only holds the work
+        that is still going on.  Recurring tasks are never archived, and neither is the most
+        recently changed task, so that task versions keep going up (see _refresh_task_cache).
+        
+        The dependency edges of archived tasks stay behind in task_deps: dependencies on
+        archived tasks count as resolved, and rolling back a task brings the archived tasks
+        that depend on it back first (see rollback_closure).  Returns the ids of the tasks archived."""
+        # If we're not in context when this is called, get in context
+        if not self._in_context:
+            with self:
+                return self.archive_complete_tasks()
+        
+        archive_query = """SELECT id FROM tasks WHERE status = 'complete' AND NOT is_recurring
+            AND version < (SELECT MAX(version) FROM tasks)
+            AND NOT EXISTS (SELECT 1 FROM task_deps JOIN tasks AS dependent ON dependent.id = task_deps.task_id
+                            WHERE task_deps.depends_on_id = tasks.id AND dependent.status != 'complete')"""
+        
+        with self._immediate_transaction():
+            archive_ids = [r['id'] for r in self.conn.execute(archive_query).fetchall()]
+            now = time.time()
+            for id_chunk in self._chunked(archive_ids):
+                id_list = ",".join(["?"]*len(id_chunk))
+                self.conn.execute("""INSERT INTO archived_tasks ({0}, archive_time) SELECT {0}, ? FROM tasks WHERE id IN ({1})"""\
+                    .format(", ".join(archived_columns), id_list), [now] + id_chunk)
+                self.conn.execute("""DELETE FROM tasks WHERE id IN ({0})""".format(id_list), id_chunk)
+        
+        print "Archived {0} complete task(s)".format(len(archive_ids))
+        return archive_ids
+    
+    
+    def unarchive_tasks(self, task_ids):
+        """Moves the archived tasks with ids in task_ids back in to the tasks table."""
+        # If we're not in context when this is called, get in context
+        if not self._in_context:
+            with self:
+                self.unarchive_tasks(task_ids)
+            return
+        
+        with self._write_transaction():
+            self._move_from_archive(task_ids)
+            self._refresh_dependency_counters(task_ids)
+    
+    
+    def _move_from_archive(self, task_ids):
+        """Moves the rows of the archived tasks with ids in task_ids back in to the tasks table,
+        leaving the dependency counters alone (see unarchive_tasks).  Must be called inside of a transaction."""
+        for id_chunk in self._chunked(task_ids):
+            id_list = ",".join(["?"]*len(id_chunk))
+            self.conn.execute("""INSERT INTO tasks ({0}) SELECT {0} FROM archived_tasks WHERE id IN ({1})"""\
+                .format(", ".join(archived_columns), id_list), id_chunk)
+            self.conn.execute("""DELETE FROM archived_tasks WHERE id IN ({0})""".format(id_list), id_chunk)
+    
+    
+    def _get_archived_tasks(self, task_ids, lazy=False):
+        """Reads the archived tasks with ids in task_ids from the archive, leaving them there.
+        Returns a dict like {task_id : task}, of TaskViews if lazy=True.  Dependencies are left
+        in task_id format."""
+        archived_tasks = {}
+        for id_chunk in self._chunked(task_ids):
+            archived_query = """SELECT * FROM archived_tasks WHERE id IN ({0})""".format(",".join(["?"]*len(id_chunk)))
+            for r in map(dict, self.conn.execute(archived_query, id_chunk).fetchall()):
+                r.pop('archive_time', None)
+                archived_tasks[r['id']] = TaskView(r) if lazy else self.rebuild_json_task(r)
+        return archived_tasks
+    
+    
+    def iter_archived_tasks(self, lazy=False, chunk_size=500):
+        """Yields the archived tasks (see archive_complete_tasks) in order of id, reading
+        chunk_size of them from the archive at a time.  If lazy=True, yields TaskViews, whose
+        payloads are never decoded.  Dependencies are left in task_id format."""
+        # If we're not in context when this is called, get in context
+        if not self._in_context:
+            with self:
+                for task in self.iter_archived_tasks(lazy=lazy, chunk_size=chunk_size):
+                    yield task
+            return
+        
+        last_id = 0
+        while True:
+            archive_rows = self.conn.execute("""SELECT * FROM archived_tasks WHERE id > ? ORDER BY id LIMIT ?""",
+                                             (last_id, chunk_size)).fetchall()
+            if len(archive_rows) == 0:
+                return
+            for r in map(dict, archive_rows):
+                last_id = r['id']
+                r.pop('archive_time', None)
+                if lazy:
+                    yield TaskView(r)
+                else:
+                    yield self.rebuild_json_task(r)
+    
+    
+    def count_archived_tasks(self):
+        return self.execute_select("""SELECT COUNT(*) FROM archived_tasks""")[0][0]
+    
+    
+    def rollback_closure(self, tasks):
+        """Finds the tasks that rolling back the tasks in list tasks would roll back (see
+        Dispatcher.rollback_closure), including any archived tasks among them or downstream
+        of them.  Archived tasks are only read, not brought back: rollback brings them back
+        when it writes them (see write_tasks)."""
+        # If we're not in context when this is called, get in context
+        if not self._in_context:
+            with self:
+                return self.rollback_closure(tasks)
+        
+        task_blob = self.get_all_tasks(include_complete=True, lazy=True)
+        task_pool = task_blob.values() if task_blob is not None else []
+        
+        if self.count_archived_tasks() > 0:
+            # Dependency edges of archived tasks are kept, so walk them to find everything downstream
+            downstream_ids = set([task.id for task in tasks])
+            to_visit = list(downstream_ids)
+            while len(to_visit) > 0:
+                dependent_ids = []
+                for id_chunk in self._chunked(to_visit):
+                    dependents_query = """SELECT task_id FROM task_deps WHERE depends_on_id IN ({0})""".format(",".join(["?"]*len(id_chunk)))
+                    dependent_ids += [r['task_id'] for r in self.conn.execute(dependents_query, id_chunk).fetchall()]
+                to_visit = [task_id for task_id in set(dependent_ids) if task_id not in downstream_ids]
+                downstream_ids.update(to_visit)
+            
+            task_pool += self._get_archived_tasks(downstream_ids, lazy=True).values()
+        
+        return self._rollback_closure_in(task_pool, tasks)
 
@@ -2,4 +2,8 @@
 
 ## Taxi info
 mpirun_str = "/usr/local/mpich2-1.4.1p1/bin/mpirun -np {0:d} "
-use_mpi = True
\ No newline at end of file
+use_mpi = True
+## Prefix that pins a command to a slice of the taxi's cores, for taxis running several tasks at
+## once; {cores} is replaced by a comma-separated list of core indices (None to disable pinning).
+## MPICH2's mpirun doesn't bind ranks by default, so they inherit the taskset affinity
+core_slice_str = "taskset -c {cores} "
\ No newline at end of file
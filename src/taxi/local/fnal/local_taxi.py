@@ -2,4 +2,9 @@
 
 ## Taxi info
 mpirun_str = "/usr/local/mvapich/bin/mpirun -np {0:d} "
-use_mpi = True
\ No newline at end of file
+use_mpi = True
+## Prefix that pins a command to a slice of the taxi's cores, for taxis running several tasks at
+## once; {cores} is replaced by a comma-separated list of core indices (None to disable pinning).
+## MVAPICH binds each rank to its own core by default, starting from core 0, which would override
+## the taskset affinity and stack concurrent tasks on the same cores -- turn that off
+core_slice_str = "MV2_ENABLE_AFFINITY=0 taskset -c {cores} "
\ No newline at end of file
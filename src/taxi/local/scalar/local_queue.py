@@ -7,19 +7,19 @@ import sqlite3
 import os
 
 from taxi.batch_queue import *
-from taxi._utility import ensure_path_exists
+from taxi._utility import ensure_path_exists, connect_sqlite
 
 import time
 
 class LocalQueue(BatchQueue):
     
-    def __init__(self):
+    def __init__(self, use_wal=False, pragmas=None):
+        """use_wal and pragmas configure the connection to the queue DB, see taxi._utility.connect_sqlite."""
         self.queue_db_path = os.path.expanduser("~") + "/.taxi/"
         if not (os.path.exists(self.queue_db_path)):
             ensure_path_exists(self.queue_db_path)
 
-        self.conn = sqlite3.connect(self.queue_db_path + "serial_queue.sqlite3", timeout=30.0)
-        self.conn.row_factory = sqlite3.Row
+        self.conn = connect_sqlite(self.queue_db_path + "serial_queue.sqlite3", use_wal=use_wal, pragmas=pragmas)
 
         self._write_table_structure()
 
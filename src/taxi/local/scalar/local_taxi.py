@@ -3,6 +3,9 @@
 ## Taxi info
 mpirun_str = "mpirun -np {0:d} "
 use_mpi = False
+## Prefix that pins a command to a slice of the taxi's cores, for taxis running several tasks at
+## once; {cores} is replaced by a comma-separated list of core indices (None to disable pinning)
+core_slice_str = "taskset -c {cores} "
 
 ## Binary locations
 flow_binary = None
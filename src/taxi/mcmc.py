@@ -9,6 +9,7 @@ Created on Mon Jun 12 20:45:17 2017
 from random import seed, randint
 
 import os
+from copy import copy
 
 import tasks
 from taxi import sanitized_path, expand_path
@@ -96,13 +97,13 @@ class MCMC(tasks.Runner):
         self.loadg = loadg # Automatically parses out parameters and loads them in to the object
 
             
-    def execute(self, cores=None):
+    def execute(self, cores=None, core_slice=None):
         """Versus Runner, checks to make sure loadg exists before running.
         """
         assert not should_load_file(self.loadg) or os.path.exists(str(self.loadg)),\
             "Error: file {loadg} does not exist.".format(loadg=self.loadg)
    
-        super(MCMC, self).execute(cores=cores)
+        super(MCMC, self).execute(cores=cores, core_slice=core_slice)
         
     
     
@@ -203,6 +204,44 @@ class ConfigGenerator(MCMC):
     @traj.setter
     def traj(self, value):
         self.start_traj = value
+        
+    
+    def split(self, n_traj):
+        """Splits this ConfigGenerator in two, e.g. to run part of it in the time a taxi
+        has left.  Returns a new ConfigGenerator (without an id) that runs the first n_traj
+        trajectories, saving its output according to the file naming conventions.  This
+        ConfigGenerator becomes the continuation: it runs the remaining trajectories,
+        starting from the configuration saved by the new ConfigGenerator, with a new seed.
+        
+        Whatever depended on this ConfigGenerator still does, and its output files keep
+        their names.  req_time is divided in proportion to the number of trajectories.
+        """
+        assert 0 < n_traj < self.n_traj, "Can only split off between 1 and n_traj-1 trajectories"
+        start_traj = self.start_traj
+        total_traj = self.n_traj
+        loadg = self.loadg
+        
+        # Copy without any File overrides, so the head renders its own output filenames
+        head = copy(self)
+        head._file_interfaces = []
+        head._currently_evaluating_properties = set([])
+        head.__dict__.pop('id', None)
+        head.depends_on = list(self.depends_on or [])
+        head.loadg = None if loadg is None else str(loadg)
+        head.start_traj = start_traj
+        head.n_traj = n_traj
+        head.req_time = self.req_time * n_traj / float(total_traj)
+        
+        # Continue from the head
+        self.loadg = str(head.saveg)
+        self.start_traj = start_traj + n_traj
+        self.n_traj = total_traj - n_traj
+        self.req_time -= head.req_time
+        self.depends_on = [head]
+        self.seed = randint(0, 9999)
+        self.branch_root = False
+        
+        return head
 
 ## Need to be able to steal physical parameters from ConfigGenerator
 ## However, we don't want any of ConfigGenerator's logistical parameters (e.g. fout, seed, trunk?, ...)
@@ -285,6 +324,22 @@ def make_config_generator_stream(config_generator_class, N,
         List of ConfigGenerator tasks.
     """
 
+    return list(iter_config_generator_stream(config_generator_class, N, starter=starter,
+                                             streamseed=streamseed, seeds=seeds,
+                                             start_traj=start_traj, **kwargs))
+
+
+def iter_config_generator_stream(config_generator_class, N,
+                                 starter=None, # default: fresh start
+                                 streamseed=None, seeds=None, # One of these must be provided
+                                 start_traj=0,
+                                 **kwargs):
+    """Generator version of make_config_generator_stream: yields the sequential ConfigGenerators
+    of the stream one at a time, each picking up where the last left off, instead of building
+    them all up front.  Useful for streaming very long streams in to a dispatch (see
+    Dispatcher.load_tasks); the arguments are the same as for make_config_generator_stream.
+    """
+
     assert issubclass(config_generator_class, ConfigGenerator), \
         "config_generator_class must be a subclass of ConfigGenerator, not {c}".format(c=str(config_generator_class))
     
@@ -309,22 +364,20 @@ def make_config_generator_stream(config_generator_class, N,
         starter = str(starter)
     
     ## Assemble stream
-    stream = []
     for cc in range(N):
-        # Make new task and add it to list
+        # Make new task
         new_task = config_generator_class(starter=starter, seed=seeds[cc], **kwargs)
-        stream.append(new_task)
+        
+        # Let the first task know it's the beginning of a new branch/sub-trunk
+        if cc == 0:
+            new_task.branch_root = True
+        yield new_task
         
         # Next ConfigGenerator will depend on this ConfigGenerator
         starter = new_task
         
         # After first task, don't want to reset start_traj each time
         kwargs.pop('start_traj', None)
-        
-    # Let the first task know it's the beginning of a new branch/sub-trunk
-    stream[0].branch_root = True
-        
-    return stream  
 
 
 def extend_ensemble(config_generator_class, N,
@@ -333,7 +386,8 @@ def extend_ensemble(config_generator_class, N,
                      **kwargs):
     """Wrapper function for make_config_generator_stream to extend an existing
     ensemble of gauge configurations. Assembles a stream of sequential ConfigGenerators,
-    each picking up where the last left off.
+    each picking up where the last left off.  To add the stream to the dispatch holding
+    starter, use Dispatcher.extend_dispatch.
     
     Args:
         config_generator_class: A subclass of ConfigGenerator.
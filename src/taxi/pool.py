@@ -281,7 +281,7 @@ class SQLitePool(Pool):
     def __init__(self, db_path, pool_name=None,
                  work_dir=None, log_dir=None,
                  allocation=None, queue=None,
-                 thrash_delay=300):
+                 thrash_delay=300, use_wal=False, pragmas=None):
         """
         Argument options: either [db_path(, pool_name, thrash_delay)] are specified,
         which specifies the location of an existing pool; or,
@@ -299,11 +299,17 @@ class SQLitePool(Pool):
         
         queue specifies which queue/machine to submit to, if relevant
         (e.g., bc or ds on the USQCD machines).
+        
+        use_wal and pragmas configure the connections to the pool DB; use_wal=True
+        switches to write-ahead-log journaling where the filesystem supports it.
+        See taxi._utility.connect_sqlite.
         """
         super(SQLitePool, self).__init__(work_dir=work_dir, log_dir=log_dir,
              thrash_delay=thrash_delay, allocation=allocation, queue=queue)
 
         self.db_path = taxi.expand_path(db_path)
+        self.use_wal = use_wal
+        self.pragmas = pragmas
             
         if not os.path.exists(self.db_path) and pool_name is None:
             # Case: Making a new pool but pool_name not provided.  Set to default.
@@ -314,6 +320,7 @@ class SQLitePool(Pool):
             self.pool_name = pool_name
 
         self.conn = None
+        self._persistent_session = False
         
         self._in_context = False
         
@@ -329,6 +336,7 @@ class SQLitePool(Pool):
                 time_limit real,
                 cores integer,
                 nodes integer,
+                memory real,
                 time_last_submitted real,
                 status text,
                 dispatch text
@@ -345,6 +353,11 @@ class SQLitePool(Pool):
         with self.conn:
             self.conn.execute(create_taxi_str)
             self.conn.execute(create_pool_str)
+            
+            # Pool DBs written by older versions of taxi don't know how much memory taxis have
+            taxi_columns = [row['name'] for row in self.conn.execute("""PRAGMA table_info(taxis)""").fetchall()]
+            if 'memory' not in taxi_columns:
+                self.conn.execute("""ALTER TABLE taxis ADD COLUMN memory real""")
     
     
     def _get_or_create_pool(self):
@@ -399,8 +412,10 @@ class SQLitePool(Pool):
             return
         self._in_context = True
         
-        self.conn = sqlite3.connect(self.db_path, timeout=30.0)
-        self.conn.row_factory = sqlite3.Row # Row factory for return-as-dict
+        if self.conn is not None:
+            return # Persistent session: connection is still open, setup already done
+        
+        self.conn = taxi.connect_sqlite(self.db_path, use_wal=self.use_wal, pragmas=self.pragmas)
         
         self._get_or_create_pool() # Also retrieves info about pool from DB, including working dir, so must occur here
         
@@ -411,9 +426,34 @@ class SQLitePool(Pool):
         """Context interface: connect to SQLite Pool DB.  If performing multiple operations,
         faster to leave a "connection" open than to open and close it repeatedly; dangerous
         to leave a connection open constantly."""
+        self._in_context = False
+        
+        # In a persistent session, keep the connection unless something went wrong with it
+        if self._persistent_session and not (exc_type is not None and issubclass(exc_type, sqlite3.Error)):
+            return
+        
         self.conn.close()
+        self.conn = None
 #        os.chdir(self.backup_cwd) # restore original working directory
-        self._in_context = False
+        
+        
+    def open_session(self):
+        """Persistent-session mode, for long-lived users of the pool like taxis: keeps
+        one connection to the pool DB open between contexts ("with <SQLitePool>:"),
+        so that connecting, retrieving the pool details, and digging out the working
+        and log directories happen once instead of in every context.
+        
+        If an SQLite error escapes a context, the connection is dropped, and a new
+        one is opened (with setup redone) on the next entry. Ends with close_session."""
+        self._persistent_session = True
+        
+        
+    def close_session(self):
+        """Ends persistent-session mode (see open_session), closing the connection to the pool DB."""
+        self._persistent_session = False
+        if self.conn is not None and not self._in_context:
+            self.conn.close()
+            self.conn = None
 
 
     def _create_taxi_object(self, db_taxi):
@@ -595,11 +635,11 @@ class SQLitePool(Pool):
         """
 
         insert_taxi_query = """INSERT OR REPLACE INTO taxis
-            (name, pool_name, time_limit, cores, nodes, time_last_submitted, status)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
+            (name, pool_name, time_limit, cores, nodes, memory, time_last_submitted, status)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
         """
         self.execute_update(insert_taxi_query, my_taxi.name, my_taxi.pool_name, my_taxi.time_limit, 
-            my_taxi.cores, my_taxi.nodes, my_taxi.time_last_submitted, my_taxi.status)
+            my_taxi.cores, my_taxi.nodes, getattr(my_taxi, 'memory', None), my_taxi.time_last_submitted, my_taxi.status)
 
 
     def delete_taxi_from_pool(self, my_taxi):
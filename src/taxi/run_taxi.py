@@ -6,6 +6,8 @@ import os
 import sys
 import argparse
 import datetime
+import threading
+import Queue
 
 import taxi
 import taxi.dispatcher
@@ -17,6 +19,39 @@ import taxi.local.local_queue as local_queue
 from taxi import flush_output, work_in_dir, print_traceback
 
 
+def execute_tasks(task_bundle, cores, core_slice=None):
+    """Runs the tasks in task_bundle (see Dispatcher.claim_next_tasks) back-to-back on
+    cores cores (pinned to the cores listed in core_slice, if specified), timing each.
+    Tasks that raise errors are marked failed; the rest of the bundle still runs."""
+    for task in task_bundle:
+        task.start_time = time.time()
+        try:
+            if core_slice is None:
+                task.execute(cores=cores)
+            else:
+                task.execute(cores=cores, core_slice=core_slice)
+        except:
+            ## TODO: some exception logging here?
+            ## Record task as failed
+            task.status = 'failed'
+            print "RUNNING FAILED:"
+            print_traceback()
+        task.run_time = time.time() - task.start_time
+        flush_output()
+
+
+def execute_in_background(task_bundle, core_slice, finished_tasks, heartbeat):
+    """For taxis running several tasks at once: runs the tasks in task_bundle on the
+    cores listed in core_slice, inside the context heartbeat (see Dispatcher.lease_heartbeat),
+    then puts the bundle in the Queue finished_tasks to be finalized -- even if something
+    goes wrong, since the main loop waits on finished_tasks to free the cores."""
+    try:
+        with heartbeat:
+            execute_tasks(task_bundle, cores=len(core_slice), core_slice=core_slice)
+    finally:
+        finished_tasks.put(task_bundle)
+
+
 if __name__ == '__main__':
     
     ### Initialization
@@ -48,6 +83,10 @@ if __name__ == '__main__':
     )
     my_queue = local_queue.LocalQueue()
     
+    # Taxis live a long time and hit the DBs every loop: keep the connections open
+    my_dispatch.open_session()
+    my_pool.open_session()
+    
     
     ## "Who am I?" -- Get information about this taxi from pool
     with my_pool:
@@ -80,6 +119,12 @@ if __name__ == '__main__':
     keep_running = True
     tasks_run = 0
     
+    ## Running several tasks at once (see Dispatcher.concurrent_tasks)
+    run_concurrently = my_dispatch.concurrent_tasks and taxi_obj.cores > 1
+    running_tasks = {} # id of first task in bundle : list of the cores the bundle runs on
+    free_cores = range(taxi_obj.cores)
+    finished_tasks = Queue.Queue()
+    
     ## Main control loop
     with work_in_dir(my_pool.work_dir):
         
@@ -97,25 +142,76 @@ if __name__ == '__main__':
             with my_pool:
                 my_pool.update_all_taxis_queue_status(queue=my_queue, dispatcher=my_dispatch)
                 my_pool.spawn_idle_taxis(queue=my_queue, dispatcher=my_dispatch)
+            
+            # Tasks of dead taxis, without asking the queue (see Dispatcher.lease_time)
+            if my_dispatch.lease_time is not None:
+                with my_dispatch:
+                    my_dispatch.reclaim_expired_leases()
         
         
             ### Check with dispatch for tasks to execute
             with my_dispatch:
-                # Ask dispatcher for next task
-                task = my_dispatch.request_next_task(for_taxi=taxi_obj)
-        
-                # Flag task for execution
+                # Ask dispatcher for next task, and flag it for execution
+                # (may hand out a bundle of short tasks to run back-to-back, see Dispatcher.max_bundle_size)
                 try:
-                    my_dispatch.claim_task(taxi_obj, task)
+                    if not run_concurrently:
+                        task_bundle = my_dispatch.claim_next_tasks(taxi_obj)
+                    elif len(free_cores) > 0:
+                        # Only tasks that fit on the free cores (all of them, if nothing is running)
+                        task_bundle = my_dispatch.claim_next_tasks(taxi_obj, max_cores=len(free_cores))
+                    else:
+                        task_bundle = [None]
+                    task = task_bundle[0]
                 except taxi.dispatcher.TaskClaimException, e:
                     ## Race condition safeguard: skips and tries again if the task status has changed
                     print str(e)
                     continue
+            
+            ### Running several tasks at once: start tasks in the background, finalize them as they finish
+            if run_concurrently and getattr(task, 'id', None) is not None and callable(getattr(task, 'execute', None)):
+                task_cores = min(my_dispatch.task_cores(task, taxi_obj), len(free_cores))
+                core_slice, free_cores = free_cores[:task_cores], free_cores[task_cores:]
                 
+                print "EXECUTING TASKS {0} ON CORES {1}".format([t.id for t in task_bundle], core_slice)
+                print "Time remaining:", taxi_obj.time_remaining()
+                flush_output()
+                
+                running_tasks[task.id] = core_slice
+                heartbeat = my_dispatch.lease_heartbeat(taxi_obj, task_bundle)
+                threading.Thread(target=execute_in_background, args=(task_bundle, core_slice, finished_tasks, heartbeat)).start()
+                
+                loops_without_executing_task = 0 # ANTI-THRASH: Not thrashing if we're starting tasks
+                continue
             
+            if len(running_tasks) > 0:
+                # Nothing else to start for now (not enough free cores, or Die/Sleep/Respawn):
+                # wait for a running task to finish, then look again
+                task_bundle = finished_tasks.get()
+                free_cores = sorted(free_cores + running_tasks.pop(task_bundle[0].id))
+                
+                with my_dispatch:
+                    tasks_run += len(task_bundle)
+                    my_dispatch.finalize_task_runs(taxi_obj, task_bundle, pool=my_pool, queue=my_queue)
+                print "FINISHED TASKS {0}".format([(t.id, t.status) for t in task_bundle])
+                flush_output()
+                
+                loops_without_executing_task = 0 # ANTI-THRASH: Not thrashing if we've made it this far
+                continue
+
+            ### Nothing ready yet: hold on to the queue slot for a while, in case something becomes ready
+            if isinstance(task, taxi.tasks.Sleep) and my_dispatch.sleep_wait_time > 0:
+                wait_time = min(my_dispatch.sleep_wait_time, taxi_obj.time_remaining())
+                print "WAITING up to {0:.0f} s for a task to become ready ({1})".format(wait_time, task.message)
+                flush_output()
+                if my_dispatch.wait_for_ready_task(taxi_obj, wait_time):
+                    continue
+
+
             ### Execute task
             print "EXECUTING TASK {0}".format(getattr(task, 'id', None))
             print task
+            if len(task_bundle) > 1:
+                print "...BUNDLED WITH TASKS {0}".format([t.id for t in task_bundle[1:]])
             
             ## Timing
             task.start_time = time.time()
@@ -154,14 +250,8 @@ if __name__ == '__main__':
                 
             ## 'Normal' behavior -- Task running
             elif hasattr(task, 'execute') and callable(getattr(task, 'execute')): # duck typing
-                try:
-                    task.execute(cores=taxi_obj.cores)
-                except:
-                    ## TODO: some exception logging here?
-                    ## Record task as failed
-                    task.status = 'failed'
-                    print "RUNNING FAILED:"
-                    print_traceback()
+                with my_dispatch.lease_heartbeat(taxi_obj, task_bundle):
+                    execute_tasks(task_bundle, cores=taxi_obj.cores)
             else:
                 print "WARNING: Task type {t} does nothing".format(type(task))
                 print task.to_dict()
@@ -170,13 +260,17 @@ if __name__ == '__main__':
             
             
             ### Record exit status, time taken, etc.
-            task.run_time = time.time() - task.start_time
+            if not callable(getattr(task, 'execute', None)):
+                task.run_time = time.time() - task.start_time # Runners are timed by execute_tasks
             with my_dispatch:
-                tasks_run += 1
-                my_dispatch.finalize_task_run(taxi_obj, task)    
+                tasks_run += len(task_bundle)
+                my_dispatch.finalize_task_runs(taxi_obj, task_bundle, pool=my_pool, queue=my_queue) # Also wakes idle taxis for newly-ready tasks
             flush_output()
             
             loops_without_executing_task = 0 # ANTI-THRASH: Not thrashing if we've made it this far
 
+    my_dispatch.close_session()
+    my_pool.close_session()
+
 ## Exit
 os.system('date')
\ No newline at end of file
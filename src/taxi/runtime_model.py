@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+
+# Runtime model: estimates how long a task will take to run from the recorded
+# run times of similar tasks.  Tasks are similar if they have the same task type
+# and the same values of the parameters that set the amount of work to do
+# (lattice volume, number of trajectories, fermion irrep; see model_parameters).
+
+import json
+import math
+
+## Task attributes that, together with the task type, determine how long a task takes
+model_parameters = ['Ns', 'Nt', 'n_traj', 'irrep']
+
+
+def model_key(task_type, payload):
+    """Key identifying the tasks that the runtime model considers to be similar to a
+    task of type task_type with (compiled) payload dict payload.  Returns a string."""
+    params = {}
+    for param in model_parameters:
+        value = payload.get(param, None)
+        if isinstance(value, (int, long, float, basestring)):
+            params[param] = value
+    return json.dumps([task_type, params], sort_keys=True)
+
+
+def quantile(values, q):
+    """Nearest-rank q-quantile (0 < q <= 1) of the list values."""
+    ordered = sorted(values)
+    rank = int(math.ceil(q * len(ordered))) - 1
+    return ordered[min(max(rank, 0), len(ordered) - 1)]
+
+
+def conservative_estimate(run_times, q=0.95, margin=1.2, min_runs=3):
+    """Conservative estimate of how long the next run will take, given the list
+    run_times of run times (in seconds) of previous runs of similar tasks: the
+    q-quantile of the run times, padded by a factor of margin.
+
+    Returns None if there are fewer than min_runs run times to go on."""
+    if len(run_times) < max(min_runs, 1):
+        return None
+    return quantile(run_times, q) * margin
@@ -2,6 +2,7 @@
 
 import os
 import shutil
+import threading
 import taxi.local.local_taxi as local_taxi
 
 from taxi import sanitized_path, expand_path, all_subclasses_of, copy_nested_list, ensure_path_exists
@@ -12,11 +13,23 @@ from copy import copy, deepcopy
 
 import hashlib # For checksum comparisons by Copy
 
+## Dispatcher.rollback rolls back several tasks at once: paths in a rollback directory that
+## are about to be moved to, so that two tasks don't pick the same name (see Runner._rollback)
+_rollback_lock = threading.Lock()
+_reserved_rollback_paths = set([])
+
 special_keys = ['id', 'task_type', 'depends_on', 'status', 'for_taxi', 'is_recurring', 'req_time', 'priority']
 
 class Task(object):
     """Abstract task superclass"""
     
+    ## Resources a taxi must have to run this task (see Dispatcher.task_fits_taxi);
+    ## None means no requirement.  Memory is in the same units as Taxi.memory,
+    ## min_walltime (minimum taxi time_limit) in seconds.
+    nodes = None
+    memory = None
+    min_walltime = None
+    
     def __init__(self, req_time=0, for_taxi=None, **kwargs):
         # Provided arguments
         self.req_time = req_time
@@ -135,7 +148,7 @@ class Task(object):
         return N_unresolved, N_failed
     
     
-    def _rollback(self):
+    def _rollback(self, rollback_dir=None, delete_files=False):
         print "Rolling back task {0}: {1}".format(getattr(self, 'id', None), self)
         assert self.status != 'active', "Task {0} is active, cannot roll it back. Kill it first.".format(self)
         self.status = 'pending'
@@ -201,11 +214,14 @@ class Runner(Task):
         """
         pass
     
-    def execute(self, cores=None):
+    def execute(self, cores=None, core_slice=None):
         """Calls the binary specified in self.binary, using mpirun (if self.use_mpi==True)
         as specified in local_taxi.mpirun_str and feeding the binary the input string
         generated by build_input_string.
         
+        If core_slice (a list of core indices) is specified, e.g. by a taxi running several
+        tasks at once, pins the call to those cores as specified in local_taxi.core_slice_str.
+        
         Smart behavior regarding output files:
             - Will not overwrite an existing file unless self.allow_output_clobbering;
             this is also useful to avoid race conditions where multiple taxis start
@@ -240,6 +256,10 @@ class Runner(Task):
         else:
             exec_str = ""
             
+        core_slice_str = getattr(local_taxi, 'core_slice_str', None)
+        if core_slice is not None and core_slice_str is not None:
+            exec_str = core_slice_str.format(cores=",".join([str(cc) for cc in core_slice])) + exec_str
+            
         
         ## Non-clobbering behavior
         if not self.allow_output_clobbering:
@@ -310,14 +330,20 @@ class Runner(Task):
                     to_path = os.path.join(rollback_dir, os.path.basename(fn))
                     
                     # Don't clobber any files in the rollback directory -- rename duplicate files like hmc_output(1)
-                    counter = 0
-                    while os.path.exists(to_path):
-                        counter += 1
-                        new_fn = os.path.basename(fn) + '({0})'.format(counter)
-                        to_path = os.path.join(rollback_dir, new_fn)
+                    with _rollback_lock:
+                        counter = 0
+                        while os.path.exists(to_path) or to_path in _reserved_rollback_paths:
+                            counter += 1
+                            new_fn = os.path.basename(fn) + '({0})'.format(counter)
+                            to_path = os.path.join(rollback_dir, new_fn)
+                        _reserved_rollback_paths.add(to_path)
                     
                     print "Rollback: '{0}' -> '{1}'".format(fn, to_path)
-                    shutil.move(fn, to_path)
+                    try:
+                        shutil.move(fn, to_path)
+                    finally:
+                        with _rollback_lock:
+                            _reserved_rollback_paths.discard(to_path)
                     
                 
                 elif delete_files:
@@ -43,7 +43,7 @@ def summary(dispatch):
             if task.depends_on is not None and any([dep in abandoned_tasks for dep in task.depends_on]):
                 blocked_tasks.append(task)
             else:
-                npending, nfailed = task.count_unresolved_dependencies()
+                npending, nfailed = dispatch.count_unresolved_dependencies(task)
                 if nfailed > 0:
                     blocked_tasks.append(task)
                 elif npending == 0:
@@ -54,8 +54,9 @@ def summary(dispatch):
             failed_tasks.append(task)
             
     # Print summary info
-    print "PENDING %d  READY %d  BLOCKED %d  ACTIVE %d  ABANDONED %d  FAILED %d  COMPLETE %d"%\
-        (len(pending_tasks), len(ready_tasks), len(blocked_tasks), len(active_tasks), len(abandoned_tasks), len(failed_tasks), len(completed_tasks))
+    print "PENDING %d  READY %d  BLOCKED %d  ACTIVE %d  ABANDONED %d  FAILED %d  COMPLETE %d  ARCHIVED %d"%\
+        (len(pending_tasks), len(ready_tasks), len(blocked_tasks), len(active_tasks), len(abandoned_tasks), len(failed_tasks), len(completed_tasks),
+         dispatch.count_archived_tasks())
 
     # Print diagnostics
     if len(active_tasks) > 0:
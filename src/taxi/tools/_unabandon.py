@@ -20,10 +20,10 @@ def unabandon(dispatch, pool, rollback_dir=None, delete_files=False):
     for task in abandoned_tasks:
         print "UNABANDONING", task.id, task
         task.status = 'abandoned'
-        dispatch.write_tasks([task])
-        dispatch.rollback(task, rollback_dir=rollback_dir, delete_files=delete_files)
         pool.update_taxi_status(my_taxi=task.by_taxi, status='I')
         relevant_taxis.append(task.by_taxi)
+    dispatch.write_tasks(abandoned_tasks)
+    dispatch.rollback(abandoned_tasks, rollback_dir=rollback_dir, delete_files=delete_files)
     
     print "RELAUNCHING MISSING TAXIS", relevant_taxis
     for my_taxi in pool.get_all_taxis_in_pool():
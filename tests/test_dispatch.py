@@ -5,9 +5,16 @@ import mock
 import os
 import sqlite3
 import json
+import time
+import threading
+import shutil
 
+import taxi
 from taxi.dispatcher import *
 from taxi.tasks import *
+import taxi.mcmc
+from taxi.apps.mrep_milc.hmc_multirep import MultirepHMCTask
+from taxi.apps.mrep_milc.flow import FlowTask
 
 class TestSQLiteBase(unittest.TestCase):
     def setUp(self):
@@ -36,6 +43,48 @@ class TestSQLiteEmptyDispatch(TestSQLiteBase):
             with self.assertRaises(sqlite3.OperationalError):
                 self.test_dispatch.conn.execute("""SELECT fake_column FROM taxis""")
 
+    def test_wal_journal(self):
+        wal_dispatch = SQLiteDispatcher(self.test_filename, use_wal=True, pragmas={'synchronous' : 'NORMAL'})
+        with wal_dispatch:
+            self.assertEqual(wal_dispatch.conn.execute("""PRAGMA journal_mode""").fetchone()[0], 'wal')
+            self.assertEqual(wal_dispatch.conn.execute("""PRAGMA synchronous""").fetchone()[0], 1)
+        
+        # Falls back to rollback journal on network filesystems
+        with mock.patch('taxi._utility.is_network_filesystem', return_value=True):
+            nfs_dispatch = SQLiteDispatcher(self.test_filename, use_wal=True)
+            with nfs_dispatch:
+                self.assertEqual(nfs_dispatch.conn.execute("""PRAGMA journal_mode""").fetchone()[0], 'delete')
+
+    def test_filesystem_type(self):
+        mounts_path = './tests/test_mounts'
+        with open(mounts_path, 'w') as f:
+            f.write("/dev/sda1 / ext4 rw 0 0\n")
+            f.write("server:/export /mnt/scratch nfs4 rw 0 0\n")
+        try:
+            self.assertEqual(taxi._utility.filesystem_type('/mnt/scratch/dispatch.sqlite', mounts_path), 'nfs4')
+            self.assertEqual(taxi._utility.filesystem_type('/mnt/scratchy', mounts_path), 'ext4')
+        finally:
+            os.unlink(mounts_path)
+
+    def test_persistent_session(self):
+        self.test_dispatch.open_session()
+        with self.test_dispatch:
+            session_conn = self.test_dispatch.conn
+        with self.test_dispatch:
+            self.assertTrue(self.test_dispatch.conn is session_conn)
+        self.assertEqual(self.test_dispatch.get_all_tasks(), None) # Out of context, but still connected
+        self.assertTrue(self.test_dispatch.conn is session_conn)
+        
+        # SQLite errors drop the connection, next context reconnects
+        with self.assertRaises(sqlite3.OperationalError):
+            with self.test_dispatch:
+                self.test_dispatch.conn.execute("""SELECT fake_column FROM tasks""")
+        with self.test_dispatch:
+            self.assertFalse(self.test_dispatch.conn is session_conn)
+        
+        self.test_dispatch.close_session()
+        self.assertTrue(self.test_dispatch.conn is None)
+
     def test_json_rebuild(self):
         json_one = {'task_type': 'Copy', 'src': 'abc', 'dest': 'xyz' }
         json_two = {'task_type': 'Copy', 'src': 'abc', 'dest': 'xyz', 'bad_arg': 4 }
@@ -79,9 +128,999 @@ class TestSQLiteEmptyDispatch(TestSQLiteBase):
 
             self.assertEqual(task_blob_no_complete.keys(), [2])
 
+    def test_load_task_stream(self):
+        def task_stream(n_tasks):
+            previous = None
+            for ii in range(n_tasks):
+                task = Task(req_time=10+ii)
+                if previous is not None:
+                    task.depends_on = [previous]
+                yield task
+                previous = task
+
+        with self.test_dispatch:
+            self.test_dispatch.initialize_new_task_pool(task_stream(25), priority_method='anarchy', imports=[],
+                                                        chunk_size=10, n_processes=2)
+
+            task_blob = self.test_dispatch.get_all_tasks(None, include_complete=True)
+            self.assertEqual(sorted(task_blob.keys()), range(1, 26))
+            self.assertEqual(task_blob[25].req_time, 34)
+
+            # Dependencies across chunks are tracked like any others
+            edges = self.test_dispatch.conn.execute("""SELECT task_id, depends_on_id FROM task_deps ORDER BY task_id""").fetchall()
+            self.assertEqual(map(tuple, edges), [(ii, ii-1) for ii in range(2, 26)])
+            n_ready = self.test_dispatch.conn.execute("""SELECT COUNT(*) FROM tasks WHERE n_unresolved=0""").fetchone()[0]
+            self.assertEqual(n_ready, 1)
+
+            # Adding more tasks numbers them after the existing ones
+            self.assertEqual(self.test_dispatch.load_tasks([Task(req_time=5)], report_progress=False), 1)
+            self.assertEqual(self.test_dispatch._get_max_task_id(), 26)
+
+    def test_load_task_list(self):
+        import multiprocessing
+        
+        # A duplicate dropped in the first chunk, and a task depending on it in the last one
+        self.test_dispatch.deduplicate_tasks = True
+        measurement = Runner(req_time=10)
+        same_measurement = Runner(req_time=10)
+        follow_up = Task(req_time=10)
+        follow_up.depends_on = [same_measurement]
+        task_list = [measurement, same_measurement] + [Task(req_time=10) for ii in range(10)] + [follow_up]
+        for ii, task in enumerate(task_list):
+            task.id = ii + 1
+        
+        # Lists are compiled by one pool of processes for the whole load
+        with self.test_dispatch:
+            with mock.patch('multiprocessing.Pool', wraps=multiprocessing.Pool) as mock_pool:
+                self.test_dispatch.load_tasks(task_list, chunk_size=5, n_processes=2, report_progress=False)
+            self.assertEqual(mock_pool.call_count, 1)
+            
+            task_blob = self.test_dispatch.get_all_tasks(lazy=True)
+            self.assertEqual(len(task_blob), 12)
+            self.assertEqual([d.id for d in task_blob[follow_up.id].depends_on], [measurement.id])
+
+    def test_extend_dispatch(self):
+        hmc_tasks = [Task(req_time=100), Task(req_time=100)]
+        hmc_tasks[1].depends_on = [hmc_tasks[0]]
+        measurement = Task(req_time=10)
+        measurement.depends_on = [hmc_tasks[1]]
+        for hmc_task in hmc_tasks:
+            hmc_task.trunk = True
+
+        with self.test_dispatch:
+            self.test_dispatch.initialize_new_task_pool(hmc_tasks + [measurement], priority_method='canvas', imports=['/runspec.py'])
+
+            # Extend the stream from the stored task, by task and by id
+            stored_hmc = self.test_dispatch.get_all_tasks()[2]
+            new_hmc = Task(req_time=100)
+            new_hmc.trunk = True
+            new_hmc.depends_on = [stored_hmc]
+            new_measurement = Task(req_time=10)
+            new_measurement.depends_on = [new_hmc, 1]
+            self.test_dispatch.extend_dispatch([new_hmc, new_measurement], priority_method='canvas',
+                                               imports=['/runspec.py', '/extension.py'])
+
+            self.assertEqual((new_hmc.id, new_measurement.id), (4, 5))
+            task_blob = self.test_dispatch.get_all_tasks(lazy=True)
+            self.assertEqual(task_blob[4].priority, task_blob[2].priority) # Same levels as the stored tasks
+            self.assertEqual(task_blob[5].priority, task_blob[3].priority)
+            self.assertEqual(sorted([d.id for d in task_blob[5].depends_on]), [1, 4])
+            self.assertEqual(self.test_dispatch.count_unresolved_dependencies(task_blob[4]), (1, 0))
+
+            stored_imports = self.test_dispatch.conn.execute("""SELECT import FROM imports""").fetchall()
+            self.assertEqual([r['import'] for r in stored_imports], ['/runspec.py', '/extension.py'])
+
+            with self.assertRaises(AssertionError):
+                orphan = Task(req_time=10)
+                orphan.depends_on = [99]
+                self.test_dispatch.extend_dispatch([orphan], imports=[])
+
+    def test_extend_archived_dispatch(self):
+        hmc_tasks = [Task(req_time=100), Task(req_time=100)]
+        hmc_tasks[1].depends_on = [hmc_tasks[0]]
+        measurement = Task(req_time=10)
+        measurement.depends_on = [hmc_tasks[1]]
+        for hmc_task in hmc_tasks:
+            hmc_task.trunk = True
+
+        with self.test_dispatch:
+            self.test_dispatch.initialize_new_task_pool(hmc_tasks + [measurement], priority_method='canvas', imports=[])
+            for task in hmc_tasks + [measurement]:
+                task.status = 'complete'
+            self.test_dispatch.write_tasks(hmc_tasks + [measurement])
+            self.test_dispatch.write_tasks([measurement]) # The most recently changed task always stays
+            self.assertEqual(sorted(self.test_dispatch.archive_complete_tasks()), [1, 2])
+
+            # The last configuration of the stream was archived: extend from it anyway
+            new_hmc = Task(req_time=100)
+            new_hmc.trunk = True
+            new_hmc.depends_on = [2]
+            self.test_dispatch.extend_dispatch([new_hmc], priority_method='canvas', imports=[])
+
+            task_blob = self.test_dispatch.get_all_tasks(lazy=True)
+            self.assertEqual(new_hmc.id, 4)
+            self.assertEqual(task_blob[4].priority, hmc_tasks[1].priority) # Same level as the archived task
+            self.assertEqual(self.test_dispatch.count_unresolved_dependencies(task_blob[4]), (0, 0))
+
+    def test_deduplicate_tasks(self):
+        self.test_dispatch.deduplicate_tasks = True
+        measurement = Runner(req_time=10)
+        same_measurement = Runner(req_time=20) # req_time doesn't change the work
+        other_measurement = Runner(req_time=10, cores=4)
+        follow_up = Task(req_time=10)
+        follow_up.depends_on = [same_measurement]
+
+        with self.test_dispatch:
+            self.test_dispatch.initialize_new_task_pool([measurement, same_measurement, other_measurement, follow_up],
+                                                        priority_method='anarchy', imports=[])
+            self.assertEqual(same_measurement.id, measurement.id)
+            task_blob = self.test_dispatch.get_all_tasks(lazy=True)
+            self.assertEqual(len(task_blob), 3)
+            self.assertEqual([d.id for d in task_blob[follow_up.id].depends_on], [measurement.id])
+
+            # Re-running the run-spec doesn't add the measurements again
+            self.test_dispatch.extend_dispatch([Runner(req_time=10)], priority_method='anarchy', imports=[])
+            self.assertEqual(len(self.test_dispatch.get_all_tasks(lazy=True)), 3)
+
+            measurement.status = 'complete'
+            follow_up.status = 'complete'
+            self.test_dispatch.write_tasks([measurement, follow_up])
+            self.test_dispatch.write_tasks([other_measurement]) # The most recently changed task always stays
+            self.assertEqual(sorted(self.test_dispatch.archive_complete_tasks()), sorted([measurement.id, follow_up.id]))
+
+        # Measurements already run in another dispatch (even if archived there) are stored as complete
+        other_filename = './tests/db_test_dispatch_other.sqlite'
+        other_dispatch = SQLiteDispatcher(other_filename)
+        other_dispatch.deduplicate_tasks = True
+        other_dispatch.dedup_dispatch_paths = [self.test_filename]
+        try:
+            with other_dispatch:
+                other_dispatch.initialize_new_task_pool([Runner(req_time=10), Runner(req_time=10, cores=4)],
+                                                        priority_method='anarchy', imports=[])
+                task_blob = other_dispatch.get_all_tasks(lazy=True)
+                self.assertEqual(sorted([t.status for t in task_blob.values()]), ['complete', 'pending'])
+        finally:
+            os.unlink(other_filename)
+
+    def test_deduplicate_tasks_after_running(self):
+        self.test_dispatch.deduplicate_tasks = True
+        with self.test_dispatch:
+            self.test_dispatch.initialize_new_task_pool([Runner(req_time=10), Runner(req_time=10, cores=4)],
+                                                        priority_method='anarchy', imports=[])
+        
+        # Run both tasks through a taxi's own dispatcher, which doesn't deduplicate; one fails
+        taxi_dispatch = SQLiteDispatcher(self.test_filename)
+        my_taxi = taxi.Taxi(name='test1', time_limit=1000, nodes=1, cores=4)
+        my_taxi.start_time = time.time()
+        for status in ['complete', 'failed']:
+            task = taxi_dispatch.claim_next_task(my_taxi)
+            task.start_time = time.time()
+            task.output_files = ['/path/to/output_{0}'.format(task.id)]
+            task.run_time = 1.
+            task.status = status
+            taxi_dispatch.finalize_task_run(my_taxi, task)
+        
+        # Re-running the run-spec only adds the failed task again
+        with self.test_dispatch:
+            self.test_dispatch.extend_dispatch([Runner(req_time=10), Runner(req_time=10, cores=4)],
+                                               priority_method='anarchy', imports=[])
+            task_blob = self.test_dispatch.get_all_tasks(lazy=True)
+            self.assertEqual(sorted([t.status for t in task_blob.values()]), ['complete', 'failed', 'pending'])
+
+    def test_store_settings(self):
+        # Taxis build their own dispatchers: settings have to come from the dispatch DB
+        self.test_dispatch.store_settings(concurrent_tasks=True, deduplicate_tasks=True, lease_time=300, sleep_wait_time=600, max_bundle_size=4)
+        self.assertTrue(self.test_dispatch.concurrent_tasks)
+        
+        taxi_dispatch = SQLiteDispatcher(self.test_filename)
+        self.assertTrue(taxi_dispatch.concurrent_tasks)
+        self.assertEqual(taxi_dispatch.max_bundle_size, 4)
+        self.assertEqual(taxi_dispatch.sleep_wait_time, 600)
+        self.assertEqual(taxi_dispatch.lease_time, 300)
+        self.assertEqual(taxi_dispatch.deduplicate_tasks, True)
+        self.assertFalse(SQLiteDispatcher.concurrent_tasks)
+        
+        self.assertRaises(ValueError, self.test_dispatch.store_settings, no_such_setting=1)
+
+
+class TestSQLiteTaskSelection(TestSQLiteBase):
+
+    def setUp(self):
+        super(TestSQLiteTaskSelection, self).setUp()
+
+        self.my_taxi = taxi.Taxi(name='test1', time_limit=1000, nodes=1, cores=1)
+        self.my_taxi.start_time = time.time()
+
+        # Chain of three tasks, plus a long task that no taxi has time for
+        self.first_task = Task(req_time=10)
+        self.second_task = Task(req_time=10)
+        self.second_task.depends_on = [self.first_task]
+        self.third_task = Task(req_time=10)
+        self.third_task.depends_on = [self.second_task]
+        self.long_task = Task(req_time=10000)
+        self.task_pool = [self.first_task, self.second_task, self.third_task, self.long_task]
+
+        with self.test_dispatch:
+            self.test_dispatch.initialize_new_task_pool(self.task_pool, priority_method='anarchy', imports=[])
+
+    def tearDown(self):
+        super(TestSQLiteTaskSelection, self).tearDown()
+
+    def test_request_ready_task(self):
+        with self.test_dispatch:
+            next_task = self.test_dispatch.request_next_task(self.my_taxi)
+            self.assertEqual(next_task.id, self.first_task.id)
+            self.assertEqual(next_task.status, 'pending')
+
+            # Completing the first task makes the second task ready
+            next_task.status = 'complete'
+            self.test_dispatch.write_tasks([next_task])
+            self.assertEqual(self.test_dispatch.request_next_task(self.my_taxi).id, self.second_task.id)
+
+    def test_request_respects_priority(self):
+        self.first_task.priority = 5
+        self.long_task.priority = 0
+        self.long_task.req_time = 10
+        with self.test_dispatch:
+            self.test_dispatch.write_tasks([self.first_task, self.long_task])
+            self.assertEqual(self.test_dispatch.request_next_task(self.my_taxi).id, self.long_task.id)
+
+    def test_request_respawn_sleep_die(self):
+        with self.test_dispatch:
+            for task in [self.first_task, self.second_task, self.third_task]:
+                task.status = 'complete'
+            self.test_dispatch.write_tasks([self.first_task, self.second_task, self.third_task])
+            
+            # Only the long task is left, and it is ready
+            self.assertTrue(isinstance(self.test_dispatch.request_next_task(self.my_taxi), Respawn))
+            
+            # Failed dependency: nothing is ready, but something is pending
+            self.long_task.depends_on = [self.third_task]
+            self.third_task.status = 'failed'
+            self.test_dispatch.write_tasks([self.long_task, self.third_task])
+            self.assertTrue(isinstance(self.test_dispatch.request_next_task(self.my_taxi), Sleep))
+
+            self.long_task.status = 'complete'
+            self.test_dispatch.write_tasks([self.long_task])
+            self.assertTrue(isinstance(self.test_dispatch.request_next_task(self.my_taxi), Die))
+
+    def test_backfill(self):
+        # Top priority task doesn't fit in the time left; two shorter ones do
+        self.long_task.priority = 0
+        short_task = Task(req_time=50)
+        short_task.priority = 5
+        short_task.id = 100
+        medium_task = Task(req_time=500)
+        medium_task.priority = 6
+        medium_task.id = 101
+        with self.test_dispatch:
+            self.test_dispatch.write_tasks([self.long_task, short_task, medium_task])
+            
+            for request_next_task in [self.test_dispatch.request_next_task,
+                                      lambda for_taxi: Dispatcher.request_next_task(self.test_dispatch, for_taxi)]:
+                self.test_dispatch.backfill_policy = 'best_fit'
+                self.assertEqual(request_next_task(self.my_taxi).id, medium_task.id)
+                
+                self.test_dispatch.backfill_policy = 'priority'
+                self.assertEqual(request_next_task(self.my_taxi).id, short_task.id)
+                
+                # Top priority task is always taken if it fits
+                self.my_taxi.time_limit = 20000
+                self.assertEqual(request_next_task(self.my_taxi).id, self.long_task.id)
+                self.my_taxi.time_limit = 1000
+
+    def test_claim_next_task(self):
+        next_task = self.test_dispatch.claim_next_task(self.my_taxi)
+        self.assertEqual(next_task.id, self.first_task.id)
+        self.assertEqual(next_task.status, 'active')
+        self.assertEqual(next_task.by_taxi, 'test1')
+        
+        with self.test_dispatch:
+            claimed = self.test_dispatch.conn.execute("""SELECT status, by_taxi FROM tasks WHERE id=?""",
+                (self.first_task.id,)).fetchone()
+            self.assertEqual(tuple(claimed), ('active', 'test1'))
+            
+            # Nothing else is ready yet
+            self.assertTrue(isinstance(self.test_dispatch.claim_next_task(self.my_taxi), Respawn))
+
+    def test_claim_next_task_concurrent(self):
+        import multiprocessing
+
+        # Twenty independent tasks, claimed by four taxis at once
+        tasks = [Task(req_time=10) for i in range(20)]
+        with self.test_dispatch:
+            self.test_dispatch.initialize_new_task_pool(tasks, priority_method='anarchy', imports=[])
+
+        results = multiprocessing.Queue()
+        def claim_all(taxi_name):
+            my_dispatch = SQLiteDispatcher(self.test_filename)
+            my_taxi = taxi.Taxi(name=taxi_name, time_limit=1000, nodes=1, cores=1)
+            my_taxi.start_time = time.time()
+            claimed = []
+            while True:
+                task = my_dispatch.claim_next_task(my_taxi)
+                if getattr(task, 'id', None) is None:
+                    break
+                claimed.append(task.id)
+            results.put(claimed)
+        
+        workers = [multiprocessing.Process(target=claim_all, args=('taxi%d' % i,)) for i in range(4)]
+        for w in workers:
+            w.start()
+        claimed = []
+        for w in workers:
+            claimed += results.get(timeout=60)
+        for w in workers:
+            w.join()
+        
+        # Every ready task claimed exactly once
+        self.assertEqual(sorted(claimed), sorted([self.first_task.id] + [t.id for t in tasks]))
+
+    def test_max_cores(self):
+        # First task needs all of a 4-core taxi's cores; a 1-core and a 2-core task are ready too
+        self.first_task.priority = 0
+        wide_task = Runner(req_time=10, cores=2)
+        wide_task.priority = 1
+        wide_task.id = 100
+        narrow_task = Runner(req_time=10, cores=1)
+        narrow_task.priority = 2
+        narrow_task.id = 101
+        self.my_taxi.cores = 4
+        with self.test_dispatch:
+            self.test_dispatch.write_tasks([self.first_task, wide_task, narrow_task])
+            
+            for request_next_task in [self.test_dispatch.request_next_task,
+                                      lambda for_taxi, max_cores: Dispatcher.request_next_task(self.test_dispatch, for_taxi, max_cores=max_cores)]:
+                self.assertEqual(request_next_task(self.my_taxi, max_cores=None).id, self.first_task.id)
+                self.assertEqual(request_next_task(self.my_taxi, max_cores=3).id, wide_task.id)
+                self.assertEqual(request_next_task(self.my_taxi, max_cores=1).id, narrow_task.id)
+            
+            # Claiming the narrow task leaves nothing else that fits in one core
+            self.assertEqual(self.test_dispatch.claim_next_task(self.my_taxi, max_cores=1).id, narrow_task.id)
+            self.assertTrue(isinstance(self.test_dispatch.claim_next_task(self.my_taxi, max_cores=1), Sleep))
+            self.assertEqual(self.test_dispatch.task_cores(self.first_task, self.my_taxi), 4)
+
+    def test_task_requirements(self):
+        # Highest-priority tasks need more cores, nodes, memory, or walltime than a small taxi has
+        big_tasks = [Runner(req_time=10, cores=8), Task(req_time=10), Task(req_time=10), Task(req_time=10)]
+        big_tasks[1].nodes = 2
+        big_tasks[2].memory = 64.
+        big_tasks[3].min_walltime = 2000
+        for i, task in enumerate(big_tasks):
+            task.id = 100 + i
+            task.priority = i
+        self.first_task.priority = len(big_tasks)
+        small_taxi = taxi.Taxi(name='test1', time_limit=1000, nodes=1, cores=4, memory=16.)
+        small_taxi.start_time = time.time()
+        big_taxi = taxi.Taxi(name='test1', time_limit=4000, nodes=2, cores=8, memory=64.)
+        big_taxi.start_time = time.time()
+        with self.test_dispatch:
+            self.test_dispatch.write_tasks(big_tasks + [self.first_task])
+
+            for request_next_task in [self.test_dispatch.request_next_task,
+                                      lambda for_taxi: Dispatcher.request_next_task(self.test_dispatch, for_taxi)]:
+                self.assertEqual(request_next_task(small_taxi).id, self.first_task.id)
+                self.assertEqual(request_next_task(big_taxi).id, big_tasks[0].id)
+            self.assertEqual([self.test_dispatch.task_fits_taxi(t, small_taxi) for t in big_tasks], [False]*4)
+
+            # Taxis that don't specify a resource can run tasks that require it
+            self.assertTrue(self.test_dispatch.task_fits_taxi(big_tasks[2], self.my_taxi))
+
+            # Only the long task is left that a small taxi could run, given more time
+            self.assertEqual(self.test_dispatch.claim_next_task(small_taxi).id, self.first_task.id)
+            self.assertTrue(isinstance(self.test_dispatch.request_next_task(small_taxi), Respawn))
+
+    def test_claim_next_tasks(self):
+        # Four Runners that each take 300 of the taxi's 1000 seconds, and two that don't go with them
+        runners = [Runner(req_time=300) for i in range(4)]
+        other_binary = Runner(req_time=10)
+        other_binary.binary = 'other'
+        other_type = Task(req_time=10)
+        for i, task in enumerate(runners + [other_binary, other_type]):
+            task.id = 100 + i
+            task.priority = i
+        with self.test_dispatch:
+            self.test_dispatch.write_tasks(runners + [other_binary, other_type])
+            
+            # Bundling is off by default
+            self.assertEqual(len(self.test_dispatch.claim_next_tasks(self.my_taxi)), 1)
+            
+            # Only three of the Runners fit
+            self.test_dispatch.max_bundle_size = 10
+            for request_task_bundle in [self.test_dispatch.request_task_bundle,
+                                        lambda for_taxi, first_task: Dispatcher.request_task_bundle(self.test_dispatch, for_taxi, first_task)]:
+                self.assertEqual([t.id for t in request_task_bundle(self.my_taxi, runners[1])], [runners[2].id, runners[3].id])
+            
+            task_bundle = self.test_dispatch.claim_next_tasks(self.my_taxi)
+            self.assertEqual([t.id for t in task_bundle], [runners[1].id, runners[2].id, runners[3].id])
+            
+            # Whole bundle is finalized at once
+            self.test_dispatch.finalize_task_runs(self.my_taxi, task_bundle)
+            statuses = self.test_dispatch.conn.execute("""SELECT status FROM tasks WHERE id IN (101, 102, 103)""").fetchall()
+            self.assertEqual([r['status'] for r in statuses], ['complete']*3)
+
+    def test_task_bundle_cores(self):
+        # Bundles run on the cores of their first task: only tasks needing at most that many go with it
+        big_taxi = taxi.Taxi(name='test2', time_limit=1000, nodes=1, cores=4)
+        big_taxi.start_time = time.time()
+        runners = [Runner(req_time=10) for i in range(4)]
+        for i, (task, cores) in enumerate(zip(runners, [2, 4, 1, None])):
+            task.id = 100 + i
+            task.priority = i
+            task.cores = cores
+        with self.test_dispatch:
+            self.test_dispatch.write_tasks(runners)
+            self.test_dispatch.max_bundle_size = 10
+            for request_task_bundle in [self.test_dispatch.request_task_bundle,
+                                        lambda for_taxi, first_task, max_cores=None: Dispatcher.request_task_bundle(
+                                            self.test_dispatch, for_taxi, first_task, max_cores=max_cores)]:
+                self.assertEqual([t.id for t in request_task_bundle(big_taxi, runners[0])], [runners[2].id])
+                self.assertEqual([t.id for t in request_task_bundle(big_taxi, runners[1], max_cores=2)], [runners[0].id, runners[2].id])
+
+    def test_claim_next_tasks_race(self):
+        runners = [Runner(req_time=10) for i in range(3)]
+        for i, task in enumerate(runners):
+            task.id = 100 + i
+            task.priority = i
+        with self.test_dispatch:
+            self.test_dispatch.write_tasks(runners)
+            self.test_dispatch.max_bundle_size = 10
+            
+            # A bundled task claimed by another taxi in the meantime is left out, instead of losing the whole bundle
+            with mock.patch.object(self.test_dispatch, 'claim_task', side_effect=[TaskClaimException("Claimed elsewhere"), None]):
+                task_bundle = Dispatcher.claim_next_tasks(self.test_dispatch, self.my_taxi)
+            self.assertEqual([t.id for t in task_bundle], [runners[0].id, runners[2].id])
+
+    def test_wait_for_ready_task(self):
+        # First task is running somewhere else, and the long task is done: nothing is ready
+        self.first_task.status = 'active'
+        self.long_task.status = 'complete'
+        with self.test_dispatch:
+            self.test_dispatch.write_tasks([self.first_task, self.long_task])
+            self.assertTrue(isinstance(self.test_dispatch.request_next_task(self.my_taxi), Sleep))
+            self.assertFalse(self.test_dispatch.wait_for_ready_task(self.my_taxi, 0.2, min_poll_interval=0.05))
+
+        # Another taxi finishes the first task in a moment
+        def finish_first_task():
+            self.first_task.status = 'complete'
+            SQLiteDispatcher(self.test_filename).write_tasks([self.first_task])
+        threading.Timer(0.2, finish_first_task).start()
+
+        start_time = time.time()
+        self.assertTrue(self.test_dispatch.wait_for_ready_task(self.my_taxi, 10, min_poll_interval=0.05))
+        self.assertTrue(time.time() - start_time < 5)
+        self.assertEqual(self.test_dispatch.request_next_task(self.my_taxi).id, self.second_task.id)
+
+    def test_leases(self):
+        self.test_dispatch.lease_time = 0.3
+        with self.test_dispatch:
+            task = self.test_dispatch.claim_next_task(self.my_taxi)
+            lease_expiry = self.test_dispatch.conn.execute("""SELECT lease_expiry FROM tasks WHERE id=?""", (task.id,)).fetchone()[0]
+            self.assertTrue(lease_expiry > time.time())
+
+            # Heartbeat keeps the lease alive while the task runs
+            with self.test_dispatch.lease_heartbeat(self.my_taxi, [task]):
+                time.sleep(0.6)
+                self.assertEqual(self.test_dispatch.reclaim_expired_leases(), [])
+
+            # Taxi stops renewing the lease, e.g. because it died
+            time.sleep(0.4)
+            self.assertEqual(self.test_dispatch.reclaim_expired_leases(), [task.id])
+            self.assertEqual(self.test_dispatch.check_task_status(task), 'abandoned')
+            self.assertEqual(self.test_dispatch.reclaim_expired_leases(), [])
+
+    def test_rollback(self):
+        # Whole chain has run, plus a measurement on the first task that made an output file
+        measurement = Runner(req_time=10)
+        measurement.depends_on = [self.first_task]
+        measurement.id = 100
+        output_path = './tests/test_rollback_output'
+        with open(output_path, 'w') as f:
+            f.write("output\n")
+        measurement.output_files = [os.path.abspath(output_path)]
+        rollback_dir = './tests/test_rollback_dir'
+        for task in [self.first_task, self.second_task, self.third_task, measurement]:
+            task.status = 'complete'
+        try:
+            with self.test_dispatch:
+                self.test_dispatch.write_tasks([self.first_task, self.second_task, self.third_task, measurement])
+
+                # Rolling back the second task and the measurement takes the third task along; dry run changes nothing
+                rolled_back = self.test_dispatch.rollback([self.second_task, measurement], rollback_dir=rollback_dir, dry_run=True)
+                self.assertEqual([t.id for t in rolled_back], [self.second_task.id, self.third_task.id, measurement.id])
+                self.assertEqual(self.test_dispatch.check_task_status(self.third_task), 'complete')
+                self.assertTrue(os.path.exists(output_path))
+
+                # Nothing is rolled back if a downstream task is running
+                self.third_task.status = 'active'
+                self.test_dispatch.write_tasks([self.third_task])
+                self.assertEqual(self.test_dispatch.rollback([self.first_task], rollback_dir=rollback_dir), [])
+                self.assertEqual(self.test_dispatch.check_task_status(self.first_task), 'complete')
+
+                self.third_task.status = 'failed'
+                self.test_dispatch.write_tasks([self.third_task])
+                rolled_back = self.test_dispatch.rollback([self.first_task], rollback_dir=rollback_dir)
+                self.assertEqual(len(rolled_back), 4)
+                self.assertEqual([self.test_dispatch.check_task_status(t) for t in rolled_back], ['pending']*4)
+                self.assertFalse(os.path.exists(output_path))
+                self.assertTrue(os.path.exists(os.path.join(rollback_dir, 'test_rollback_output')))
+        finally:
+            if os.path.exists(output_path):
+                os.unlink(output_path)
+            if os.path.exists(rollback_dir):
+                shutil.rmtree(rollback_dir)
+
+    def test_wake_idle_taxis(self):
+        # Finishing the first task makes the second task and another task ready
+        fork_task = Task(req_time=10)
+        fork_task.depends_on = [self.first_task]
+        fork_task.id = 100
+        fork_task.priority = 0
+        idle_taxis = []
+        for taxi_name, status, dispatch_path in [('test2', 'I', self.test_filename), ('test3', 'I', self.test_filename),
+                                                 ('test4', 'H', self.test_filename), ('test5', 'I', './other_dispatch.sqlite')]:
+            idle_taxi = taxi.Taxi(name=taxi_name, time_limit=1000, nodes=1, cores=1)
+            idle_taxi.status = status
+            idle_taxi.dispatch_path = dispatch_path
+            idle_taxis.append(idle_taxi)
+        test_pool = mock.Mock()
+        test_pool.get_all_taxis_in_pool.return_value = idle_taxis
+        with self.test_dispatch:
+            self.test_dispatch.write_tasks([fork_task])
+
+            # Finishing taxi takes one of them, only one idle taxi on this dispatch needs to be woken
+            self.test_dispatch.finalize_task_run(self.my_taxi, self.first_task, pool=test_pool)
+            self.assertEqual([str(call[0][0]) for call in test_pool.submit_taxi_to_queue.call_args_list], ['test2'])
+            
+            for newly_ready_tasks in [self.test_dispatch.newly_ready_tasks,
+                                      lambda task_bundle: Dispatcher.newly_ready_tasks(self.test_dispatch, task_bundle)]:
+                self.assertEqual([t.id for t in newly_ready_tasks([self.first_task])], [fork_task.id, self.second_task.id])
+
+            # Nothing new is ready after the long task
+            self.long_task.status = 'complete'
+            self.assertEqual(self.test_dispatch.wake_idle_taxis(self.my_taxi, [self.long_task], test_pool), [])
+
+    def test_should_taxis_be_running(self):
+        # Ready task that only taxi test3 can run; two trunk tasks that are ready for anyone
+        special_task = Task(req_time=10, for_taxi='test3')
+        self.first_task.trunk = True
+        self.long_task.trunk = True
+        with self.test_dispatch:
+            self.test_dispatch.write_tasks([special_task, self.first_task, self.long_task])
+        
+        taxi_list = []
+        for taxi_name in ['test1', 'test2', 'test3']:
+            my_taxi = taxi.Taxi(name=taxi_name, time_limit=1000, nodes=1, cores=1)
+            my_taxi.dispatch_path = self.test_filename
+            taxi_list.append(my_taxi) # All idle
+        
+        # SQL counts match the generic one-pass counts
+        sql_counts = self.test_dispatch._count_trunks_and_ready_tasks()
+        generic_counts = Dispatcher._count_trunks_and_ready_tasks(self.test_dispatch)
+        self.assertEqual(sql_counts, generic_counts)
+        self.assertEqual(sql_counts, ({None : 2}, {None : 2, 'test3' : 1}))
+        
+        # test3 must run for its task, and one more taxi is needed for two trunks
+        desired_state = self.test_dispatch.should_taxis_be_running(taxi_list)
+        self.assertTrue(desired_state['test3'])
+        self.assertEqual(sum(desired_state.values()), 2)
+
+    def test_runtime_estimates(self):
+        # Run the chain; each task takes 100 seconds, far less than the long task asks for
+        with self.test_dispatch:
+            for i in range(3):
+                task = self.test_dispatch.claim_next_task(self.my_taxi)
+                task.run_time = 100.
+                self.test_dispatch.finalize_task_run(self.my_taxi, task)
+            self.assertEqual(self.test_dispatch.conn.execute("""SELECT COUNT(*) FROM task_runs""").fetchone()[0], 3)
+            
+            # Estimates not enabled: the long task still doesn't fit
+            self.assertTrue(isinstance(self.test_dispatch.request_next_task(self.my_taxi), Respawn))
+            
+            # Long task is like the others, so it's estimated to take p95 * margin = 120 seconds
+            self.test_dispatch.enable_runtime_estimates(quantile=0.95, margin=1.2, min_runs=3)
+            for request_next_task in [self.test_dispatch.request_next_task,
+                                      lambda for_taxi: Dispatcher.request_next_task(self.test_dispatch, for_taxi)]:
+                next_task = request_next_task(self.my_taxi)
+                self.assertEqual(next_task.id, self.long_task.id)
+                self.assertAlmostEqual(self.test_dispatch.estimated_time(next_task), 120.)
+            
+            # Estimates are kept when tasks are written back, and given to similar tasks added later
+            est_query = """SELECT est_time FROM tasks WHERE id=?"""
+            self.test_dispatch.write_tasks([self.long_task])
+            self.assertAlmostEqual(self.test_dispatch.conn.execute(est_query, (self.long_task.id,)).fetchone()[0], 120.)
+            new_task = Task(req_time=10000)
+            self.test_dispatch.extend_dispatch([new_task], priority_method='anarchy', imports=[])
+            self.assertAlmostEqual(self.test_dispatch.conn.execute(est_query, (new_task.id,)).fetchone()[0], 120.)
+            
+            self.test_dispatch.disable_runtime_estimates()
+            self.assertTrue(isinstance(self.test_dispatch.request_next_task(self.my_taxi), Respawn))
+
+
+class TestSplitConfigGenerators(TestSQLiteBase):
+
+    def setUp(self):
+        super(TestSplitConfigGenerators, self).setUp()
+
+        self.my_taxi = taxi.Taxi(name='test1', time_limit=250, nodes=1, cores=1)
+        self.my_taxi.start_time = time.time()
+
+        # Stream of two ten-trajectory HMC tasks, with a flow measurement on the first
+        self.stream = taxi.mcmc.make_config_generator_stream(MultirepHMCTask, 2, seeds=[1, 2],
+            Ns=4, Nt=4, beta=7.75, k4=0.128, k6=0.125, label='test', nsteps1=10, n_traj=10, req_time=600)
+        self.flow_task = FlowTask(measure_on=self.stream[0], req_time=10, tmax=1.0)
+        self.flow_task.priority = 5 # Less urgent than the stream
+        with self.test_dispatch:
+            self.test_dispatch.initialize_new_task_pool(self.stream + [self.flow_task], priority_method='trunk', imports=[])
+
+    def tearDown(self):
+        super(TestSplitConfigGenerators, self).tearDown()
+
+    def test_no_split(self):
+        # Off by default: the first HMC task doesn't fit, and nothing else is ready
+        self.assertTrue(isinstance(self.test_dispatch.claim_next_task(self.my_taxi), Respawn))
+        
+        # Can't split off fewer than min_split_traj trajectories
+        self.test_dispatch.split_config_generators = True
+        self.test_dispatch.min_split_traj = 5
+        self.assertTrue(isinstance(self.test_dispatch.claim_next_task(self.my_taxi), Respawn))
+
+    def test_split(self):
+        first_id = self.stream[0].id
+        self.test_dispatch.split_config_generators = True
+        split_task = self.test_dispatch.claim_next_task(self.my_taxi)
+        
+        # Four trajectories at 60 seconds each fit in 250 seconds
+        self.assertEqual(split_task.status, 'active')
+        self.assertEqual((split_task.start_traj, split_task.n_traj), (0, 4))
+        self.assertEqual(split_task.req_time, 240)
+        self.assertEqual(str(split_task.saveg), 'cfg_4_4_7.75_0.128_0.125_test_4')
+        
+        with self.test_dispatch:
+            all_tasks = self.test_dispatch.get_all_tasks()
+        self.assertEqual(sorted(all_tasks.keys()), sorted([t.id for t in self.stream] + [self.flow_task.id, split_task.id]))
+        
+        # Original task continues from the split-off task, and still saves the same config
+        continuation = all_tasks[first_id]
+        self.assertEqual((continuation.start_traj, continuation.n_traj), (4, 10-4))
+        self.assertEqual(continuation.loadg, 'cfg_4_4_7.75_0.128_0.125_test_4')
+        self.assertEqual(continuation.saveg, 'cfg_4_4_7.75_0.128_0.125_test_10')
+        self.assertEqual([t.id for t in continuation.depends_on], [split_task.id])
+        self.assertEqual(continuation.req_time, 360)
+        
+        # Dependents of the original task are untouched
+        self.assertEqual([t.id for t in all_tasks[self.stream[1].id].depends_on], [first_id])
+        self.assertEqual([t.id for t in all_tasks[self.flow_task.id].depends_on], [first_id])
+
+
+class TestRuntimeModel(unittest.TestCase):
+
+    def test_model_key(self):
+        key = taxi.runtime_model.model_key('ConfigGenerator', {'Ns' : 16, 'Nt' : 32, 'seed' : 7, 'irrep' : 'f'})
+        self.assertEqual(json.loads(key), ['ConfigGenerator', {'Ns' : 16, 'Nt' : 32, 'irrep' : 'f'}])
+
+    def test_conservative_estimate(self):
+        run_times = [float(t) for t in range(1, 101)]
+        self.assertEqual(taxi.runtime_model.quantile(run_times, 0.95), 95.)
+        self.assertAlmostEqual(taxi.runtime_model.conservative_estimate(run_times, q=0.95, margin=1.2), 114.)
+        self.assertEqual(taxi.runtime_model.conservative_estimate([10., 20.], min_runs=3), None)
+
+
+class TestSQLiteDependencyCounters(TestSQLiteBase):
+
+    def setUp(self):
+        super(TestSQLiteDependencyCounters, self).setUp()
+
+        self.root_task = Task(req_time=10)
+        self.leaf_tasks = [Task(req_time=10) for ii in range(3)]
+        for leaf_task in self.leaf_tasks:
+            leaf_task.depends_on = [self.root_task]
+
+        with self.test_dispatch:
+            self.test_dispatch.initialize_new_task_pool([self.root_task] + self.leaf_tasks, priority_method='anarchy', imports=[])
+
+    def tearDown(self):
+        super(TestSQLiteDependencyCounters, self).tearDown()
+
+    def _counters(self):
+        rows = self.test_dispatch.conn.execute("""SELECT id, n_unresolved, n_failed FROM tasks""").fetchall()
+        return dict([(r['id'], (r['n_unresolved'], r['n_failed'])) for r in rows])
+
+    def test_dependency_edges(self):
+        with self.test_dispatch:
+            edges = self.test_dispatch.conn.execute("""SELECT task_id, depends_on_id FROM task_deps ORDER BY task_id""").fetchall()
+            self.assertEqual(map(tuple, edges), [(t.id, self.root_task.id) for t in self.leaf_tasks])
+
+    def test_counters_follow_status(self):
+        with self.test_dispatch:
+            self.assertEqual(self._counters()[self.leaf_tasks[0].id], (1, 0))
+            self.assertEqual(self.test_dispatch._N_ready_tasks(None), 1)
+
+            self.root_task.status = 'failed'
+            self.test_dispatch.write_tasks([self.root_task])
+            self.assertEqual(self._counters()[self.leaf_tasks[0].id], (1, 1))
+
+            self.root_task.status = 'complete'
+            self.test_dispatch.write_tasks([self.root_task])
+            self.assertEqual(self._counters()[self.leaf_tasks[0].id], (0, 0))
+            self.assertEqual(self.test_dispatch._N_ready_tasks(None), 3)
+            
+            task_blob = self.test_dispatch.get_all_tasks()
+            self.assertEqual(self.test_dispatch.count_unresolved_dependencies(task_blob[self.leaf_tasks[0].id]), (0, 0))
+
+    def test_archive_complete_tasks(self):
+        for task in [self.root_task] + self.leaf_tasks[:2]:
+            task.status = 'complete'
+
+        with self.test_dispatch:
+            self.test_dispatch.write_tasks([self.root_task] + self.leaf_tasks[:2])
+            self.test_dispatch.get_all_tasks() # Fill the task cache
+
+            # The root still has a pending dependent; the most recently changed task always stays
+            newest_id = self.test_dispatch.conn.execute("""SELECT id FROM tasks ORDER BY version DESC LIMIT 1""").fetchone()[0]
+            archived_ids = self.test_dispatch.archive_complete_tasks()
+            self.assertEqual(sorted(archived_ids), sorted([t.id for t in self.leaf_tasks[:2] if t.id != newest_id]))
+            self.assertEqual(self.test_dispatch.count_archived_tasks(), len(archived_ids))
+
+            # Archived tasks are only read on request
+            self.assertEqual(set(self.test_dispatch.get_all_tasks().keys()).intersection(archived_ids), set([]))
+            task_blob = self.test_dispatch.get_all_tasks(include_archived=True)
+            self.assertEqual(sorted(task_blob.keys()), [1, 2, 3, 4])
+            self.assertEqual([task_blob[task_id].status for task_id in archived_ids], ['complete']*len(archived_ids))
+            self.assertEqual(self.test_dispatch._get_max_task_id(), 4)
+
+            # Finding what a rollback would roll back leaves the archive alone
+            would_roll_back = self.test_dispatch.rollback([self.root_task], delete_files=True, dry_run=True)
+            self.assertEqual(sorted([t.id for t in would_roll_back]), sorted([self.root_task.id] + [t.id for t in self.leaf_tasks[:2]]))
+            self.assertEqual(self.test_dispatch.count_archived_tasks(), len(archived_ids))
+            
+            # Rolling back the root brings its archived dependents back to roll them back too
+            self.test_dispatch.rollback([self.root_task], delete_files=True)
+            self.assertEqual(self.test_dispatch.count_archived_tasks(), 0)
+            self.assertEqual(self._counters()[self.leaf_tasks[2].id], (1, 0))
+            self.assertEqual(sorted([t.status for t in self.test_dispatch.get_all_tasks().values()]), ['pending']*4)
+
+    def test_migrate_old_dispatch(self):
+        # Strip the dispatch down to the original table structure
+        with self.test_dispatch:
+            self.test_dispatch.conn.execute("""DROP TABLE task_deps""")
+            self.test_dispatch.conn.execute("""CREATE TABLE old_tasks AS SELECT id, task_type, depends_on, status,
+                for_taxi, by_taxi, is_recurring, req_time, start_time, run_time, priority, payload FROM tasks""")
+            self.test_dispatch.conn.execute("""DROP TABLE tasks""")
+            self.test_dispatch.conn.execute("""ALTER TABLE old_tasks RENAME TO tasks""")
+            self.test_dispatch.conn.commit()
+
+        migrated_dispatch = SQLiteDispatcher(self.test_filename)
+        with migrated_dispatch:
+            self.assertEqual(migrated_dispatch._N_ready_tasks(None), 1)
+            self.assertEqual(migrated_dispatch.conn.execute("""SELECT COUNT(*) FROM task_deps""").fetchone()[0], 3)
+            
+            index_names = [r['name'] for r in migrated_dispatch.conn.execute("""PRAGMA index_list(tasks)""").fetchall()]
+            for index_name in ['tasks_status_priority', 'tasks_for_taxi', 'tasks_by_taxi', 'tasks_ready']:
+                self.assertTrue(index_name in index_names)
+
+    def test_lookups_use_indices(self):
+        with self.test_dispatch:
+            plan = self.test_dispatch.conn.execute("""EXPLAIN QUERY PLAN SELECT id FROM tasks WHERE by_taxi=? AND status='active'""",
+                ('test1',)).fetchall()
+            self.assertTrue(any(['INDEX' in r[-1] for r in plan]))
+            
+            plan = self.test_dispatch.conn.execute("""EXPLAIN QUERY PLAN SELECT COUNT(*) FROM tasks
+                WHERE status = 'pending' AND n_unresolved = 0""").fetchall()
+            self.assertTrue(any(['COVERING INDEX tasks_ready' in r[-1] for r in plan]))
+
+
+class TestSQLiteTaskCache(TestSQLiteBase):
+
+    def setUp(self):
+        super(TestSQLiteTaskCache, self).setUp()
+
+        self.first_task = Task(req_time=10)
+        self.second_task = Task(req_time=10)
+        self.second_task.depends_on = [self.first_task]
+        self.task_pool = [self.first_task, self.second_task]
+
+        with self.test_dispatch:
+            self.test_dispatch.initialize_new_task_pool(self.task_pool, priority_method='anarchy', imports=[])
+
+    def tearDown(self):
+        super(TestSQLiteTaskCache, self).tearDown()
+
+    def test_version_bumped_on_write(self):
+        version_query = """SELECT version FROM tasks WHERE id=?"""
+        with self.test_dispatch:
+            old_version = self.test_dispatch.conn.execute(version_query, (self.first_task.id,)).fetchone()[0]
+            self.first_task.status = 'complete'
+            self.test_dispatch.write_tasks([self.first_task])
+            new_version = self.test_dispatch.conn.execute(version_query, (self.first_task.id,)).fetchone()[0]
+        self.assertTrue(new_version > old_version)
+
+    def test_unchanged_tasks_reused(self):
+        task_blob = self.test_dispatch.get_all_tasks()
+        self.assertFalse(hasattr(task_blob[self.first_task.id], 'version'))
+        self.assertTrue(task_blob[self.second_task.id].depends_on[0] is task_blob[self.first_task.id])
+        
+        # Nothing changed: payloads aren't decoded again, but each call gets its own tasks
+        task_blob[self.first_task.id].status = 'complete'
+        with mock.patch.object(self.test_dispatch, 'rebuild_json_task') as mock_rebuild:
+            new_task_blob = self.test_dispatch.get_all_tasks()
+            self.assertFalse(mock_rebuild.called)
+        self.assertFalse(new_task_blob[self.first_task.id] is task_blob[self.first_task.id])
+        self.assertEqual(new_task_blob[self.first_task.id].status, 'pending')
+        self.assertTrue(new_task_blob[self.second_task.id].depends_on[0] is new_task_blob[self.first_task.id])
+        
+        # Changed tasks are rebuilt, and only those
+        self.second_task.status = 'complete'
+        self.test_dispatch.write_tasks([self.second_task])
+        with mock.patch.object(self.test_dispatch, 'rebuild_json_task', wraps=self.test_dispatch.rebuild_json_task) as mock_rebuild:
+            new_task_blob = self.test_dispatch.get_all_tasks()
+            self.assertEqual(mock_rebuild.call_count, 1)
+        self.assertEqual(new_task_blob[self.second_task.id].status, 'complete')
+        
+    def test_cached_file_overrides(self):
+        stream = taxi.mcmc.make_config_generator_stream(MultirepHMCTask, 1, seeds=[1],
+            Ns=4, Nt=4, beta=7.75, k4=0.128, k6=0.125, label='test', nsteps1=10, n_traj=10, req_time=600)
+        stream[0].loadg = 'cfg_start'
+        self.test_dispatch.extend_dispatch(stream, priority_method='anarchy', imports=[])
+        
+        # Copies of a cached task keep its File overrides, but have their own
+        task_blob = self.test_dispatch.get_all_tasks()
+        self.assertEqual(task_blob[stream[0].id].loadg, 'cfg_start')
+        self.assertEqual(task_blob[stream[0].id].saveg, 'cfg_4_4_7.75_0.128_0.125_test_10')
+        task_blob[stream[0].id].loadg = 'cfg_other'
+        new_task = self.test_dispatch.get_all_tasks()[stream[0].id]
+        self.assertEqual(new_task.loadg, 'cfg_start')
+        self.assertEqual(task_blob[stream[0].id].loadg, 'cfg_other')
+        
+    def test_deleted_tasks_dropped(self):
+        self.assertEqual(len(self.test_dispatch.get_all_tasks()), 2)
+        
+        other_dispatch = SQLiteDispatcher(self.test_filename)
+        with other_dispatch:
+            with other_dispatch.conn:
+                other_dispatch.conn.execute("""DELETE FROM tasks WHERE id=?""", (self.second_task.id,))
+        
+        self.assertEqual(self.test_dispatch.get_all_tasks().keys(), [self.first_task.id])
+
+    def test_changed_tasks_refreshed(self):
+        task_blob = self.test_dispatch.get_all_tasks()
+        
+        # Change a task through a separate dispatcher, as another taxi would
+        other_dispatch = SQLiteDispatcher(self.test_filename)
+        self.first_task.status = 'complete'
+        other_dispatch.write_tasks([self.first_task])
+        
+        new_task_blob = self.test_dispatch.get_all_tasks()
+        self.assertEqual(new_task_blob[self.first_task.id].status, 'complete')
+        self.assertTrue(new_task_blob[self.second_task.id].depends_on[0] is new_task_blob[self.first_task.id])
+        self.assertEqual(self.test_dispatch.count_unresolved_dependencies(new_task_blob[self.second_task.id]), (0, 0))
+        
+        # Filtering still works on cached tasks
+        self.assertEqual(self.test_dispatch.get_all_tasks(include_complete=False).keys(), [self.second_task.id])
+
+
+    def test_lazy_task_views(self):
+        self.first_task.trunk = True
+        self.first_task.some_parameter = 'payload only'
+        self.test_dispatch.write_tasks([self.first_task])
+        
+        with mock.patch.object(self.test_dispatch, 'rebuild_json_task') as mock_rebuild:
+            task_blob = self.test_dispatch.get_all_tasks(lazy=True)
+            self.assertFalse(mock_rebuild.called)
+        
+        first_view = task_blob[self.first_task.id]
+        self.assertTrue(isinstance(first_view, TaskView))
+        self.assertTrue(first_view.trunk)
+        self.assertEqual(first_view.status, 'pending')
+        self.assertFalse(hasattr(first_view, 'some_parameter'))
+        self.assertTrue(task_blob[self.second_task.id].depends_on[0] is first_view)
+        self.assertEqual(self.test_dispatch.count_unresolved_dependencies(task_blob[self.second_task.id]), (1, 0))
+        
+        # Materialized tasks are the real thing
+        first_task, second_task = self.test_dispatch.materialize_tasks([first_view, task_blob[self.second_task.id]])
+        self.assertTrue(isinstance(first_task, Task))
+        self.assertEqual(first_task.some_parameter, 'payload only')
+        self.assertTrue(second_task.depends_on[0] is first_task)
+
+    def test_mark_abandoned_task(self):
+        my_taxi = taxi.Taxi(name='test1', time_limit=1000, nodes=1, cores=1)
+        my_taxi.start_time = time.time()
+        claimed_task = self.test_dispatch.claim_next_task(my_taxi)
+        
+        # A taxi running tasks concurrently can leave several active
+        self.second_task.depends_on = []
+        self.test_dispatch.write_tasks([self.second_task])
+        other_claimed_task = self.test_dispatch.claim_next_task(my_taxi)
+        self.assertEqual(other_claimed_task.id, self.second_task.id)
+        
+        self.test_dispatch.mark_abandoned_task(my_taxi)
+        self.assertEqual(self.test_dispatch.check_task_status(claimed_task), 'abandoned')
+        self.assertEqual(self.test_dispatch.check_task_status(other_claimed_task), 'abandoned')
+        self.assertEqual(self.test_dispatch.get_all_tasks()[claimed_task.id].by_taxi, 'test1')
+
+
+class TestFindBranches(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dispatch = Dispatcher()
+        
+        # Trunk stream root -> t1 -> t2, forking at t1 to t3; a measurement on each trunk task
+        self.root = Task()
+        self.t1 = Task()
+        self.t2 = Task()
+        self.t3 = Task()
+        for trunk_task in [self.root, self.t1, self.t2, self.t3]:
+            trunk_task.trunk = True
+        self.t1.depends_on = [self.root]
+        self.t2.depends_on = [self.t1]
+        self.t3.depends_on = [self.t1]
+        self.measurements = []
+        for trunk_task in [self.root, self.t1, self.t2, self.t3]:
+            measurement = Task()
+            measurement.depends_on = [trunk_task]
+            self.measurements.append(measurement)
+        self.task_pool = [self.root, self.t1, self.t2, self.t3] + self.measurements
+
+    def test_branches(self):
+        trees = self.test_dispatch.find_branches(self.task_pool)
+        self.assertEqual(len(trees), 2)
+        self.assertEqual(trees[0][:3], [self.root, self.t1, self.measurements[0]])
+        self.assertItemsEqual(trees[0] + trees[1], self.task_pool)
+        self.assertEqual(trees[1][0], self.t3)
+        self.assertItemsEqual(self.t1._dependents, [self.t2, self.t3, self.measurements[1]])
+        
+        stats = self.test_dispatch.branch_stats
+        self.assertEqual(stats['n_tasks'], 8)
+        self.assertEqual(stats['n_dependencies'], 7)
+        self.assertEqual(stats['n_roots'], 1)
+        self.assertEqual(stats['n_branches'], 2)
+        self.assertEqual(stats['longest_chain'], 4)
+        self.assertEqual(stats['n_unbranched'], 0)
+
+    def test_dependencies_outside_pool(self):
+        # Subsets of the forest, with some dependencies as ids, still work
+        self.root.id, self.t1.id = 1, 2
+        self.t2.depends_on = [2]
+        trees = self.test_dispatch.find_branches([self.t1, self.t2, self.t3])
+        self.assertEqual(trees, [[self.t1, self.t2], [self.t3]])
+        self.assertEqual(self.test_dispatch.branch_stats['n_external_dependencies'], 1)
+
+    def test_duplicate_dependencies(self):
+        self.t2.depends_on = [self.t1, self.t1]
+        trees = self.test_dispatch.find_branches(self.task_pool)
+        self.assertEqual(self.test_dispatch.branch_stats['n_duplicate_dependencies'], 1)
+        self.assertEqual(sum([len(tree) for tree in trees]), len(self.task_pool))
+
+    def test_cycle(self):
+        self.root.depends_on = [self.t2]
+        with self.assertRaises(DependencyCycleException):
+            self.test_dispatch.find_branches(self.task_pool)
+
+
+    def test_critical_path_priorities(self):
+        for trunk_task in [self.root, self.t1, self.t2, self.t3]:
+            trunk_task.req_time = 100
+        for measurement in self.measurements:
+            measurement.req_time = 10
+        self.measurements[3].req_time = 500 # Long measurement at the end of the fork
+        self.measurements[0].priority = 0 # User-assigned
+        
+        self.assertEqual(self.test_dispatch._critical_path_lengths(self.task_pool)[:4], [800, 700, 110, 600])
+        
+        self.test_dispatch._assign_priorities(self.task_pool, priority_method='critical_path')
+        self.assertEqual(self.measurements[0].priority, 0)
+        self.assertTrue(self.root.priority < self.t1.priority < self.t3.priority < self.t2.priority)
+        self.assertTrue(self.t2.priority < self.measurements[2].priority)
+
 
 if __name__ == '__main__':
     suite1 = unittest.TestLoader().loadTestsFromTestCase(TestSQLiteEmptyDispatch)
+    suite2 = unittest.TestLoader().loadTestsFromTestCase(TestSQLiteTaskSelection)
+    suite3 = unittest.TestLoader().loadTestsFromTestCase(TestSQLiteDependencyCounters)
+    suite4 = unittest.TestLoader().loadTestsFromTestCase(TestSQLiteTaskCache)
+    suite5 = unittest.TestLoader().loadTestsFromTestCase(TestFindBranches)
+    suite6 = unittest.TestLoader().loadTestsFromTestCase(TestRuntimeModel)
+    suite7 = unittest.TestLoader().loadTestsFromTestCase(TestSplitConfigGenerators)
 
-    all_tests = unittest.TestSuite([suite1])
+    all_tests = unittest.TestSuite([suite1, suite2, suite3, suite4, suite5, suite6, suite7])
     unittest.TextTestRunner(verbosity=2).run(all_tests)
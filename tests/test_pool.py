@@ -86,6 +86,28 @@ class TestSQLiteEmptyPool(TestSQLiteBase):
             self.assertEqual(dupe_pool_obj.work_dir, taxi.expand_path('./tests/work/'))
             self.assertEqual(dupe_pool_obj.log_dir, taxi.expand_path('./tests/log/'))
 
+    def test_persistent_session(self):
+        self.test_pool.open_session()
+        with self.test_pool:
+            session_conn = self.test_pool.conn
+        
+        # Connection and setup are kept between contexts
+        with mock.patch.object(self.test_pool, '_get_or_create_pool') as mock_setup:
+            with self.test_pool:
+                self.assertTrue(self.test_pool.conn is session_conn)
+            self.assertFalse(mock_setup.called)
+        
+        # SQLite errors drop the connection, next context reconnects
+        with self.assertRaises(sqlite3.OperationalError):
+            with self.test_pool:
+                self.test_pool.conn.execute("""SELECT fake_column FROM taxis""")
+        with self.test_pool:
+            self.assertFalse(self.test_pool.conn is session_conn)
+            self.assertEqual(len(self.test_pool.get_all_taxis_in_pool()), 0)
+        
+        self.test_pool.close_session()
+        self.assertTrue(self.test_pool.conn is None)
+
 
 class TestSQLitePoolWithTaxis(TestSQLiteBase):
 
@@ -1,17 +1,32 @@
 #!/usr/bin/env python
 
 import unittest
-#import mock
+import mock
 import os
 #import sqlite3
 import json
 
-from taxi.tasks import Copy # Must import * to get all Task classes in globals() scope
+import taxi.tasks
+from taxi.tasks import Copy, Runner # Must import * to get all Task classes in globals() scope
+import taxi.local.scalar.local_taxi as scalar_local_taxi
+import taxi.local.cu_hep.local_taxi as cu_hep_local_taxi
+import taxi.local.fnal.local_taxi as fnal_local_taxi
 import taxi.apps.mrep_milc.flow as flow
 import taxi.apps.mrep_milc.pure_gauge_ora as pure_gauge_ora
 
 class TestBaseTaskRunner(unittest.TestCase):
-    pass
+
+    def test_core_slice(self):
+        runner = Runner(cores=2, use_mpi=True)
+        with mock.patch.object(taxi.tasks, 'local_taxi', scalar_local_taxi):
+            with mock.patch('os.system') as mock_system:
+                runner.execute(cores=2, core_slice=[2, 3])
+        exec_str = mock_system.call_args[0][0]
+        self.assertTrue(exec_str.startswith("taskset -c 2,3 mpirun -np 2 "))
+        
+        # Every shipped site configuration pins to the slice
+        for site_local_taxi in [scalar_local_taxi, cu_hep_local_taxi, fnal_local_taxi]:
+            self.assertTrue("taskset -c 2,3 " in site_local_taxi.core_slice_str.format(cores="2,3"))
 
 
 class TestCopy(unittest.TestCase):